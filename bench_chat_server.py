@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+多用户聊天服务负载测试
+
+在进程内启动聊天服务（未配置API密钥时使用模拟LLM回复），由多个并发客户端
+通过保持连接的HTTP请求持续对话，统计吞吐量（每秒请求数）和延迟分位数。
+--workers 传入多个值（如 0,1,2,4）时依次测试，并比较吞吐量随工作进程数的扩展情况。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+MESSAGES = [
+    "我最近感到很焦虑。",
+    "主要是因为即将到来的工作面试。",
+    "昨天晚上我几乎没有睡着。",
+    "朋友说我想太多了，这让我有点难过。",
+    "你觉得我应该怎么准备面试？",
+    "有时候我觉得很孤独。",
+]
+
+
+async def _read_response(reader: asyncio.StreamReader) -> int:
+    """读取一个响应（Content-Length或分块编码），返回状态码"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", "0")))
+    return status
+
+
+async def _client(host: str, port: int, user_id: str, turns: int, stream: bool, latencies: list, errors: list):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(turns):
+            body = json.dumps({"user_id": user_id, "message": MESSAGES[i % len(MESSAGES)],
+                               "stream": stream}, ensure_ascii=False).encode("utf-8")
+            request = (f"POST /v1/chat HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                       f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status = await _read_response(reader)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def _load(host: str, port: int, users: int, connections_per_user: int, turns: int, stream: bool):
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        _client(host, port, f"bench_user_{u}", turns, stream, latencies, errors)
+        for u in range(users) for _ in range(connections_per_user)
+    ])
+    return latencies, errors, time.perf_counter() - start
+
+
+def run(users: int, connections_per_user: int, turns: int, concurrency: int, stream: bool, as_json: bool,
+        workers: int = 0):
+    from config import Config
+    Config.DATA_STORAGE_PATH = tempfile.mkdtemp(prefix="bench_chat_server_")
+
+    from chat_server import ChatServer
+    from utils import percentile
+    server = ChatServer(host="127.0.0.1", port=0, max_concurrency=concurrency, workers=workers).start_in_thread()
+    try:
+        # 预热：创建所有会话，避免首次加载计入延迟
+        asyncio.run(_load(server.host, server.port, users, 1, 1, stream))
+        latencies, errors, elapsed = asyncio.run(
+            _load(server.host, server.port, users, connections_per_user, turns, stream))
+        server_stats = server.get_stats()
+    finally:
+        server.stop()
+
+    result = {
+        "users": users,
+        "connections": users * connections_per_user,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "stream": stream,
+        "max_concurrency": concurrency,
+        "workers": workers,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p95": round(percentile(latencies, 95), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies), 2) if latencies else 0.0
+        },
+        "sessions": server_stats["sessions"] or sum(w["users"] for w in server_stats["workers"])
+    }
+    if as_json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return result
+
+    print("多用户聊天服务负载测试")
+    print("=" * 40)
+    print(f"用户数: {users}，连接数: {result['connections']}，每连接轮数: {turns}，"
+          f"并发上限: {concurrency}，工作进程: {workers or '无（服务进程内）'}，流式: {'是' if stream else '否'}")
+    print(f"请求数: {result['requests']}（失败 {result['errors']}），耗时: {result['seconds']}s")
+    print(f"吞吐量: {result['rps']} 请求/秒")
+    latency = result["latency_ms"]
+    print(f"延迟: p50 {latency['p50']}ms，p95 {latency['p95']}ms，p99 {latency['p99']}ms，最大 {latency['max']}ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the multi-user chat server")
+    parser.add_argument("--users", type=int, default=50, help="Number of distinct users")
+    parser.add_argument("--connections-per-user", type=int, default=1,
+                        help="Concurrent connections per user (turns of one user are serialized)")
+    parser.add_argument("--turns", type=int, default=20, help="Turns per connection")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Server concurrency limit (default: SERVER_MAX_CONCURRENCY)")
+    parser.add_argument("--stream", action="store_true", help="Request streamed (SSE) replies")
+    parser.add_argument("--workers", default="0",
+                        help="Worker process counts to test, comma separated (0 runs turns in the server process)")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+
+    from config import Config
+    worker_counts = [int(value) for value in args.workers.split(",")]
+    results = []
+    for workers in worker_counts:
+        results.append(run(args.users, args.connections_per_user, args.turns,
+                           args.concurrency or Config.SERVER_MAX_CONCURRENCY, args.stream, args.json, workers))
+        if not args.json:
+            print()
+    if len(results) > 1 and not args.json:
+        print_scaling(results)
+
+
+def print_scaling(results: list):
+    """比较不同工作进程数的吞吐量（相对于第一项的加速比）"""
+    base = results[0]["rps"] or 1.0
+    print(f"吞吐量扩展（CPU核心数: {os.cpu_count()}）")
+    print(f"{'工作进程':>8} {'请求/秒':>10} {'加速比':>8} {'p99(ms)':>10}")
+    for result in results:
+        print(f"{result['workers']:>8} {result['rps']:>10} {result['rps'] / base:>8.2f} "
+              f"{result['latency_ms']['p99']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+多用户负载生成器与延迟报告
+
+在 DATA_STORAGE_PATH（默认使用临时目录）中生成带有指定数量情景记忆的合成用户
+（经由MemorySystem写入记忆文件和向量数据库，向量数据库放在同一目录下，不影响正式数据），然后让每个用户作为一个并发会话持续对话：用户在启动阶段内陆续上线，
+两轮之间按指数分布的思考时间停顿。可以直接驱动进程内的 AIPsychologist 会话
+（经过会话缓存，记录会话加载、各检索阶段和记忆更新的耗时），也可以通过HTTP驱动聊天服务
+（进程内启动，或用 --url 指向已运行的服务）。结果以终端表格输出吞吐量和各阶段的延迟分位数，
+并可写成JSON。
+
+用法:
+    python bench_multi_user.py --users 100 --history 500 --turns 5 --think-time 2
+    python bench_multi_user.py --target server --workers 4 --users 1000 --stream --json-out report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+MESSAGES = [
+    "我最近感到很焦虑。",
+    "上周我和朋友吵架了，心里一直很难受。",
+    "工作压力很大，晚上经常睡不着。",
+    "昨天和家人聊了聊，感觉好一点了。",
+    "我担心下个月的考试考不好。",
+    "有时候我觉得很孤独。",
+    "今天早上起来还是很紧张。",
+    "谢谢你一直听我说这些。",
+]
+
+# 合成情景记忆使用的素材：(用户消息, 情绪, 话题, 关注问题, 活动)，标签取自记忆系统实际产生的取值
+EVENTS = [
+    ("和同事开会时被批评了，压力很大", ["anxiety"], ["career"], ["stress_and_anxiety"], "实习"),
+    ("周末和朋友去爬山，心情很好", ["happiness"], ["relationships", "health"], [], "运动"),
+    ("和家人因为找工作的事吵了一架，很生气", ["anger"], ["relationships", "career"], [], "其他活动"),
+    ("晚上失眠，一直担心考试", ["anxiety"], ["learning", "health"], ["sleep_issues"], "学习"),
+    ("一个人在宿舍待了一整天，觉得很孤独", ["loneliness", "sadness"], [], [], "休息"),
+    ("面试没通过，有点沮丧", ["sadness"], ["career"], [], "实习"),
+    ("和同学出去旅行了几天，很开心", ["happiness"], ["relationships"], [], "旅行"),
+    ("参加聚会时插不上话，有点难过", ["loneliness", "sadness"], ["relationships"], [], "社交"),
+]
+TIME_REFERENCES = ["昨天", "上周", "上个月", "去年夏天", "前天晚上"]
+
+
+# ---- 合成用户 ----
+
+def _check_vocabulary():
+    """素材中的标签必须是记忆系统实际使用的取值，否则检索和画像的负载不真实"""
+    from keyword_engine import KEYWORD_TABLES
+    from memory_extraction import VALID_CONCERNS, VALID_EMOTIONS, VALID_TOPICS
+    activities = set(KEYWORD_TABLES["activity"]) | {"其他活动"}
+    for _, emotions, topics, concerns, activity in EVENTS:
+        assert set(emotions) <= VALID_EMOTIONS and set(topics) <= VALID_TOPICS
+        assert set(concerns) <= VALID_CONCERNS and activity in activities
+
+
+def _synthetic_episode(rng: random.Random, timestamp: float) -> Dict[str, Any]:
+    message, emotions, topics, concerns, activity = rng.choice(EVENTS)
+    insights = {"emotions": emotions, "topics": topics, "concerns": concerns, "intensity": rng.randint(1, 10)}
+    episode = {
+        "timestamp": timestamp,
+        "interaction": {
+            "user_message": message,
+            "ai_response": "听起来这件事对你影响很大，能多说说当时的感受吗？",
+            "emotional_insights": insights
+        },
+        # 与对话后更新记忆时生成的摘要格式相同
+        "summary": f"用户表达了 {', '.join(emotions)}"
+    }
+    if rng.random() < 0.2:
+        episode["time_reference"] = rng.choice(TIME_REFERENCES)
+        episode["activity"] = activity
+    return episode
+
+
+def _synthetic_profile(episodes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """按合成的情景记忆累计用户画像（与对话后更新画像的方式相同）"""
+    preferences: Dict[str, int] = {}
+    insights: Dict[str, int] = {}
+    history = []
+    for episode in episodes:
+        emotional = episode["interaction"]["emotional_insights"]
+        for emotion in emotional["emotions"]:
+            insights[emotion] = insights.get(emotion, 0) + 1
+        for concern in emotional["concerns"]:
+            history.append({"concern": concern, "timestamp": episode["timestamp"],
+                            "context": episode["interaction"]["user_message"]})
+        for topic in emotional["topics"]:
+            preferences[f"interest_{topic}"] = preferences.get(f"interest_{topic}", 0) + 1
+    return {"user_profile": {"preferences": preferences, "psychological_history": history[-50:],
+                             "personality_insights": insights}}
+
+
+def generate_users(users: int, history: int, seed: int = 0, prefix: str = "load_user") -> List[str]:
+    """
+    在 DATA_STORAGE_PATH 中生成users个合成用户，每人history条情景记忆（时间分布在过去一年内），返回用户ID
+
+    通过MemorySystem批量导入，记忆文件和向量数据库（VECTOR_DB_PATH，可用时）中都有完整的历史；
+    已有同名用户时先清空。
+    """
+    from ai_psychologist import MemorySystem
+    _check_vocabulary()
+    rng = random.Random(seed)
+    now = time.time()
+    user_ids = []
+    for index in range(users):
+        user_id = f"{prefix}_{index}"
+        memory = MemorySystem(user_id)
+        memory.reset_memory()
+        timestamps = sorted(now - rng.uniform(3600, 365 * 86400) for _ in range(history))
+        episodes = [_synthetic_episode(rng, timestamp) for timestamp in timestamps]
+        with memory.mutation():
+            memory.semantic_memory = _synthetic_profile(episodes)
+            memory.add_episodic_memories(episodes)
+        user_ids.append(user_id)
+    return user_ids
+
+
+# ---- 统计 ----
+
+class LatencyRecorder:
+    """按阶段收集耗时样本（毫秒），线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.counts = {"turns": 0, "errors": 0, "rejected": 0, "degraded": 0}
+
+    def add(self, stage: str, ms: float):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(ms)
+
+    def count(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        from utils import percentile
+        result = {}
+        for stage, values in self.samples.items():
+            result[stage] = {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 2),
+                "p50": round(percentile(values, 50), 2),
+                "p95": round(percentile(values, 95), 2),
+                "p99": round(percentile(values, 99), 2),
+                "max": round(max(values), 2)
+            }
+        return result
+
+
+def _think(rng: random.Random, think_time: float) -> float:
+    """下一次思考时间（秒）：均值为think_time的指数分布，0表示不停顿"""
+    return rng.expovariate(1.0 / think_time) if think_time > 0 else 0.0
+
+
+# ---- 进程内驱动 ----
+
+def run_inprocess(user_ids: List[str], turns: int, think_time: float, ramp_up: float, seed: int,
+                  recorder: LatencyRecorder) -> Dict[str, Any]:
+    """每个用户一个线程，直接调用会话缓存中的AIPsychologist，记录各阶段耗时"""
+    from admission import AdmissionRejected
+    from ai_psychologist import AIPsychologist, LLMClient
+    from session_manager import SessionManager
+
+    llm_client = LLMClient()
+    manager = SessionManager(lambda user_id: AIPsychologist(user_id, llm_client=llm_client))
+
+    def simulate(index: int, user_id: str):
+        rng = random.Random(seed * 100003 + index)
+        time.sleep(rng.uniform(0, ramp_up))
+        for turn in range(turns):
+            start = time.perf_counter()
+            session = manager.acquire(user_id)
+            try:
+                recorder.add("session_acquire", (time.perf_counter() - start) * 1000)
+                turn_start = time.perf_counter()
+                session.chat(MESSAGES[(index + turn) % len(MESSAGES)])
+                recorder.add("chat", (time.perf_counter() - turn_start) * 1000)
+                if session.last_turn_stats.get("degraded"):
+                    recorder.count("degraded")
+                for stage, ms in session.turn_timings().items():
+                    recorder.add(stage, ms)
+            except AdmissionRejected:
+                recorder.count("rejected")
+            except Exception as e:
+                recorder.count("errors")
+                print(f"Warning: Turn failed for {user_id}: {e}", file=sys.stderr)
+            finally:
+                manager.release(user_id)
+            recorder.add("turn", (time.perf_counter() - start) * 1000)
+            recorder.count("turns")
+            time.sleep(_think(rng, think_time))
+
+    threads = [threading.Thread(target=simulate, args=(index, user_id), name=f"load-{index}", daemon=True)
+               for index, user_id in enumerate(user_ids)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {"session_cache": manager.get_stats()}
+    finally:
+        manager.close()
+
+
+# ---- 聊天服务驱动 ----
+
+async def _request(host: str, port: int, reader, writer, user_id: str, message: str,
+                   stream: bool) -> Tuple[int, float, Optional[float]]:
+    """发送一轮对话，返回状态码、总耗时和首段回复耗时（毫秒，仅流式）"""
+    body = json.dumps({"user_id": user_id, "message": message, "stream": stream},
+                      ensure_ascii=False).encode("utf-8")
+    request = (f"POST /v1/chat HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+    start = time.perf_counter()
+    writer.write(request)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    first_ms = None
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            await reader.readexactly(size + 2)
+            if first_ms is None:
+                first_ms = (time.perf_counter() - start) * 1000
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", "0")))
+    return status, (time.perf_counter() - start) * 1000, first_ms
+
+
+async def _server_user(host: str, port: int, index: int, user_id: str, turns: int, think_time: float,
+                       ramp_up: float, seed: int, stream: bool, recorder: LatencyRecorder):
+    rng = random.Random(seed * 100003 + index)
+    await asyncio.sleep(rng.uniform(0, ramp_up))
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    recorder.add("connect", (time.perf_counter() - start) * 1000)
+    try:
+        for turn in range(turns):
+            try:
+                status, total_ms, first_ms = await _request(
+                    host, port, reader, writer, user_id, MESSAGES[(index + turn) % len(MESSAGES)], stream)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                recorder.count("errors")
+                print(f"Warning: Request failed for {user_id}: {e}", file=sys.stderr)
+                return
+            recorder.count("turns")
+            recorder.add("request", total_ms)
+            if first_ms is not None:
+                recorder.add("first_delta", first_ms)
+            if status == 503:
+                recorder.count("rejected")
+            elif status != 200:
+                recorder.count("errors")
+            await asyncio.sleep(_think(rng, think_time))
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def run_server(user_ids: List[str], turns: int, think_time: float, ramp_up: float, seed: int,
+               recorder: LatencyRecorder, stream: bool, url: Optional[str] = None,
+               workers: int = 0) -> Dict[str, Any]:
+    """每个用户一个保持连接的HTTP客户端；未指定url时在进程内启动聊天服务"""
+    async def drive(host: str, port: int):
+        await asyncio.gather(*[
+            _server_user(host, port, index, user_id, turns, think_time, ramp_up, seed, stream, recorder)
+            for index, user_id in enumerate(user_ids)
+        ])
+
+    if url:
+        parsed = urlparse(url)
+        asyncio.run(drive(parsed.hostname, parsed.port or 80))
+        import urllib.request
+        with urllib.request.urlopen(f"{url.rstrip('/')}/v1/stats", timeout=30) as response:
+            return {"server": json.loads(response.read())}
+
+    from chat_server import ChatServer
+    server = ChatServer(host="127.0.0.1", port=0, workers=workers).start_in_thread()
+    try:
+        asyncio.run(drive(server.host, server.port))
+        return {"server": server.get_stats()}
+    finally:
+        server.stop()
+
+
+# ---- 报告 ----
+
+def print_report(result: Dict[str, Any]):
+    """以终端表格输出吞吐量和各阶段延迟分位数"""
+    print("多用户负载测试")
+    print("=" * 72)
+    print(f"目标: {result['target']}，用户数: {result['users']}，每人情景记忆: {result['history']} 条，"
+          f"每人轮数: {result['turns_per_user']}，平均思考时间: {result['think_time']}s")
+    print(f"完成轮数: {result['turns']}（失败 {result['errors']}，拒绝 {result['rejected']}，降级 {result['degraded']}），"
+          f"耗时: {result['seconds']}s，吞吐量: {result['turns_per_second']} 轮/秒")
+    print(f"{'阶段':<24} {'次数':>8} {'平均':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'最大':>10}")
+    print("-" * 72)
+    for stage, row in result["stages"].items():
+        print(f"{stage:<24} {row['count']:>8} {row['mean']:>10} {row['p50']:>10} {row['p95']:>10} "
+              f"{row['p99']:>10} {row['max']:>10}")
+    server_stages = (result.get("server") or {}).get("stages")
+    if server_stages:
+        # 服务端记录的各阶段耗时（客户端只能测到连接、整个请求和首段回复）
+        print("-" * 72)
+        print(f"{'服务端阶段':<24} {'次数':>8} {'':>10} {'p50':>10} {'p95':>10} {'p99':>10}")
+        for stage, row in server_stages.items():
+            print(f"{stage:<24} {row['samples']:>8} {'':>10} {row['p50']:>10} {row['p95']:>10} {row['p99']:>10}")
+    print("（单位：毫秒）")
+
+
+def run(target: str, users: int, history: int, turns: int, think_time: float, ramp_up: float, seed: int,
+        data_dir: Optional[str] = None, stream: bool = False, url: Optional[str] = None,
+        workers: int = 0, vector_db_path: Optional[str] = None) -> Dict[str, Any]:
+    """生成合成用户并执行一次负载测试，返回结果字典"""
+    from config import Config
+    Config.DATA_STORAGE_PATH = data_dir or tempfile.mkdtemp(prefix="bench_multi_user_")
+    # 向量数据库同样放在测试目录下（必须在首次打开向量数据库之前设置），不写入正式的向量库
+    Config.VECTOR_DB_PATH = vector_db_path or os.path.join(Config.DATA_STORAGE_PATH, "vector_db")
+    start = time.perf_counter()
+    user_ids = generate_users(users, history, seed)
+    generation_seconds = time.perf_counter() - start
+
+    recorder = LatencyRecorder()
+    start = time.perf_counter()
+    if target == "server":
+        extra = run_server(user_ids, turns, think_time, ramp_up, seed, recorder, stream, url, workers)
+    else:
+        extra = run_inprocess(user_ids, turns, think_time, ramp_up, seed, recorder)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "target": target,
+        "users": users,
+        "history": history,
+        "turns_per_user": turns,
+        "think_time": think_time,
+        "ramp_up": ramp_up,
+        "data_dir": Config.DATA_STORAGE_PATH,
+        "vector_db_path": Config.VECTOR_DB_PATH,
+        "generation_seconds": round(generation_seconds, 3),
+        **recorder.counts,
+        "seconds": round(elapsed, 3),
+        "turns_per_second": round(recorder.counts["turns"] / elapsed, 2) if elapsed else 0.0,
+        "stages": recorder.summary(),
+        **extra
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic multi-user load generator with latency report")
+    parser.add_argument("--target", choices=["inprocess", "server"], default="inprocess",
+                        help="Drive AIPsychologist sessions directly or the HTTP chat server")
+    parser.add_argument("--users", type=int, default=100, help="Number of concurrent synthetic users")
+    parser.add_argument("--history", type=int, default=200, help="Episodic memories generated per user")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per user")
+    parser.add_argument("--think-time", type=float, default=1.0,
+                        help="Mean think time between a user's turns in seconds (exponential, 0 disables)")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="Users start at random times within this window")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None,
+                        help="Where synthetic users are written (default: a temporary DATA_STORAGE_PATH)")
+    parser.add_argument("--vector-db-path", default=None,
+                        help="Vector database for the synthetic users (default: <data dir>/vector_db)")
+    parser.add_argument("--stream", action="store_true", help="Request streamed replies (server target)")
+    parser.add_argument("--url", default=None,
+                        help="Existing server to drive, e.g. http://127.0.0.1:8765 (its DATA_STORAGE_PATH and "
+                             "VECTOR_DB_PATH should match --data-dir and --vector-db-path)")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes for the in-process server")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON instead of a table")
+    parser.add_argument("--json-out", default=None, help="Also write the JSON result to this file")
+    args = parser.parse_args()
+
+    result = run(args.target, args.users, args.history, args.turns, args.think_time, args.ramp_up, args.seed,
+                 args.data_dir, args.stream, args.url, args.workers, args.vector_db_path)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+提示前缀缓存基准测试
+
+对一段脚本化的对话逐轮构建上下文，统计相邻两轮之间可复用的提示前缀比例
+（近似于 Ollama 上下文复用 / OpenRouter 提示缓存的命中率），
+并在模型可用时记录服务端返回的提示评估耗时和缓存命中 token 数。
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+CONVERSATION = [
+    "我最近感到很焦虑。",
+    "主要是因为即将到来的工作面试。",
+    "我担心表现不好会让家人失望。",
+    "昨天晚上我几乎没有睡着。",
+    "我试过跑步放松，但效果一般。",
+    "朋友说我想太多了，这让我有点难过。",
+    "今天早上起来还是很紧张。",
+    "你觉得我应该怎么准备面试？",
+    "我今年暑假做了三个月的实习，感觉很累。",
+    "有时候我觉得很孤独。",
+    "谢谢你一直听我说这些。",
+    "下周就要面试了，我该怎么调整状态？",
+]
+
+
+def _serialize(messages):
+    """把消息列表序列化为提供方实际看到的文本形式"""
+    return "".join(f"<{m['role']}>{m['content']}" for m in messages)
+
+
+def _shared_prefix(a: str, b: str) -> int:
+    """返回两个字符串的公共前缀长度"""
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def run(turns: int, think_time: float):
+    from config import Config
+    Config.DATA_STORAGE_PATH = tempfile.mkdtemp(prefix="bench_prompt_cache_")
+
+    from ai_psychologist import AIPsychologist
+    psychologist = AIPsychologist("bench_prompt_cache")
+
+    previous = ""
+    prefix_ratios = []
+    prompt_eval_ms = []
+    cached_tokens = []
+    prompt_tokens = []
+
+    for i in range(turns):
+        message = CONVERSATION[i % len(CONVERSATION)]
+        context = psychologist._build_context(message)
+        serialized = _serialize(context)
+        if previous:
+            prefix_ratios.append(_shared_prefix(previous, serialized) / len(serialized))
+
+        response = psychologist.llm_client.chat_completion(context)
+        usage = response.get("usage") or {}
+        if usage.get("prompt_eval_ms") is not None:
+            prompt_eval_ms.append(usage["prompt_eval_ms"])
+        if usage.get("prompt_tokens"):
+            prompt_tokens.append(usage["prompt_tokens"])
+            cached_tokens.append(usage.get("cached_tokens") or 0)
+
+        psychologist._update_memory(message, response["choices"][0]["message"]["content"])
+        previous = serialized
+        if think_time:
+            time.sleep(think_time)
+
+    report = {
+        "turns": turns,
+        "mean_prefix_reuse": round(sum(prefix_ratios) / len(prefix_ratios), 4) if prefix_ratios else 0.0,
+        "min_prefix_reuse": round(min(prefix_ratios), 4) if prefix_ratios else 0.0,
+        "provider_prompt_eval_ms": round(sum(prompt_eval_ms) / len(prompt_eval_ms), 2) if prompt_eval_ms else None,
+        "provider_cache_hit_rate": round(sum(cached_tokens) / sum(prompt_tokens), 4) if prompt_tokens else None,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure prompt prefix reuse across turns")
+    parser.add_argument("--turns", type=int, default=len(CONVERSATION))
+    parser.add_argument("--think-time", type=float, default=1.1,
+                        help="Seconds to wait between turns (lets the wall clock advance)")
+    args = parser.parse_args()
+
+    report = run(args.turns, args.think_time)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+中文时间表达式解析吞吐量基准测试
+
+在随机生成的消息语料上对比原先的逐个正则搜索实现与预编译交替式 + 缓存解析的吞吐量。
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+FILLERS = [
+    "我最近感到很焦虑", "晚上总是睡不着", "和朋友聊了很久", "工作压力有点大",
+    "我想多运动一下", "考试快到了", "家里人都挺好的", "心情还算不错",
+]
+EXPRESSIONS = [
+    "昨天", "今天", "前天", "上周", "下周", "上个月", "去年", "今年", "明年",
+    "暑假", "寒假", "春节", "2025年7月1日", "7月15日", "2024-03-08", "12/25/2024",
+]
+
+
+def legacy_extract(user_message):
+    """原先的实现：逐个模式调用re.search"""
+    import re
+    patterns = [
+        r'昨天', r'今天', r'明天', r'前天', r'大前天',
+        r'上周', r'这周', r'下周',
+        r'上个月', r'这个月', r'下个月',
+        r'去年', r'今年', r'明年',
+        r'(\d{4})年(\d{1,2})月(\d{1,2})日',
+        r'(\d{1,2})月(\d{1,2})日',
+        r'(\d{4})-(\d{1,2})-(\d{1,2})',
+        r'(\d{1,2})/(\d{1,2})/(\d{4})',
+        r'暑假', r'寒假', r'春节'
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, user_message)
+        if match:
+            return match.group(0)
+    return None
+
+
+def legacy_parse(time_ref):
+    """原先的实现：逐个比较并重新匹配日期模式"""
+    now = datetime.now()
+    if time_ref == '昨天':
+        return (now - timedelta(days=1)).timestamp()
+    elif time_ref == '今天':
+        return now.timestamp()
+    elif time_ref == '前天':
+        return (now - timedelta(days=2)).timestamp()
+    elif time_ref == '去年':
+        return (now - timedelta(days=365)).timestamp()
+    elif time_ref == '今年':
+        return now.timestamp()
+    elif time_ref == '暑假':
+        return now.replace(month=7, day=1).timestamp()
+    elif time_ref == '寒假':
+        return now.replace(month=1, day=1).timestamp()
+    date_patterns = [
+        r'(\d{4})年(\d{1,2})月(\d{1,2})日',
+        r'(\d{4})-(\d{1,2})-(\d{1,2})',
+        r'(\d{1,2})/(\d{1,2})/(\d{4})',
+    ]
+    for pattern in date_patterns:
+        match = re.match(pattern, time_ref)
+        if match:
+            try:
+                if pattern == date_patterns[2]:
+                    month, day, year = map(int, match.groups())
+                else:
+                    year, month, day = map(int, match.groups())
+                return datetime(year, month, day).timestamp()
+            except ValueError:
+                continue
+    return None
+
+
+def build_corpus(size, hit_ratio, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        parts = rng.sample(FILLERS, 3)
+        if rng.random() < hit_ratio:
+            parts.insert(rng.randint(0, 3), rng.choice(EXPRESSIONS))
+        corpus.append("，".join(parts) + "。")
+    return corpus
+
+
+def run(corpus):
+    from time_parser import extract_time_expression, parse_time_expression
+
+    start = time.perf_counter()
+    legacy_hits = 0
+    for message in corpus:
+        ref = legacy_extract(message)
+        if ref and legacy_parse(ref) is not None:
+            legacy_hits += 1
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    hits = 0
+    for message in corpus:
+        ref = extract_time_expression(message)
+        if ref and parse_time_expression(ref) is not None:
+            hits += 1
+    seconds = time.perf_counter() - start
+
+    return {
+        "messages": len(corpus),
+        "legacy_msgs_per_sec": round(len(corpus) / legacy_seconds),
+        "legacy_parsed": legacy_hits,
+        "compiled_msgs_per_sec": round(len(corpus) / seconds),
+        "compiled_parsed": hits,
+        "speedup": round(legacy_seconds / seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Chinese time-expression extraction and parsing")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--hit-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages, args.hit_ratio, args.seed)
+    print(json.dumps(run(corpus), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+"""
+pytest共用的夹具：每个测试使用独立的临时存储目录，结束后恢复配置
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+@pytest.fixture(autouse=True)
+def temp_storage(monkeypatch, tmp_path):
+    """把DATA_STORAGE_PATH指向本测试的临时目录，测试结束后自动恢复原值"""
+    from config import Config
+    monkeypatch.setattr(Config, "DATA_STORAGE_PATH", str(tmp_path))
+    return str(tmp_path)
+
+
+def run_isolated(test):
+    """直接运行测试文件时没有夹具：先把DATA_STORAGE_PATH指向新的临时目录，再执行测试"""
+    from config import Config
+    Config.DATA_STORAGE_PATH = tempfile.mkdtemp(prefix=f"{test.__module__}_")
+    return test()
@@ -0,0 +1,231 @@
+"""
+准入控制模块 - 限制同时进行的对话轮次，过载时排队、拒绝或降级
+
+LLM后端变慢时，如果不限制同时进行的chat()调用，排队的请求越积越多，所有用户的延迟一起恶化。
+准入控制器限制全局和单个用户同时进行的轮次；超出时进入有上限的等待队列，按到达顺序放行
+（某个用户达到自己的上限时不阻塞排在后面的其他用户），等待超过期限或队列已满时拒绝。
+被拒绝的轮次按ADMISSION_OVERLOAD_MODE直接报错，或由调用方返回不调用LLM的降级回复。
+多进程模式下准入控制只在前端执行，上限是所有工作进程合计的并发轮次。
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from cancellation import CancelToken, TurnCancelled
+from config import Config
+
+# 用于计算等待时间分位数的最近样本数
+WAIT_WINDOW = 1024
+
+
+class AdmissionRejected(Exception):
+    """轮次未获准入：reason为 "queue_full" 或 "timeout"，retry_after为建议的重试间隔（秒）"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Admission rejected ({reason}), retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ("user_id", "admitted")
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.admitted = False
+
+
+class AdmissionController:
+    """全局和按用户的并发上限，加上有界、带期限的FIFO等待队列"""
+
+    def __init__(self, max_concurrent: Optional[int] = None, max_per_user: Optional[int] = None,
+                 max_queue: Optional[int] = None, queue_timeout: Optional[float] = None):
+        self.max_concurrent = max_concurrent or Config.ADMISSION_MAX_CONCURRENT
+        self.max_per_user = max_per_user or Config.ADMISSION_MAX_PER_USER
+        self.max_queue = Config.ADMISSION_MAX_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = Config.ADMISSION_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._active_by_user: Dict[str, int] = {}
+        self._queue: Deque[_Ticket] = deque()
+        self._waits: Deque[float] = deque(maxlen=WAIT_WINDOW)
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,             # 需要排队的轮次
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "cancelled": 0,          # 排队期间被取消的轮次
+            "degraded": 0,           # 被拒绝后返回了降级回复的轮次
+            "wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "max_queue_depth": 0,
+            "hold_ms": 0.0           # 已完成轮次占用名额的总时间
+        }
+
+    def _has_capacity(self, user_id: str) -> bool:
+        return (self._active < self.max_concurrent
+                and self._active_by_user.get(user_id, 0) < self.max_per_user)
+
+    def _admit_waiters(self):
+        """在持锁状态下按到达顺序放行所有可以放行的等待者"""
+        admitted = False
+        for ticket in list(self._queue):
+            if self._active >= self.max_concurrent:
+                break
+            if self._has_capacity(ticket.user_id):
+                self._queue.remove(ticket)
+                self._take(ticket.user_id)
+                ticket.admitted = True
+                admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def _take(self, user_id: str):
+        self._active += 1
+        self._active_by_user[user_id] = self._active_by_user.get(user_id, 0) + 1
+        self.stats["admitted"] += 1
+
+    def retry_after(self) -> float:
+        """按最近的平均占用时间估算排队中的请求全部处理完所需的秒数"""
+        completed = self.stats["admitted"] - self._active
+        average_s = self.stats["hold_ms"] / completed / 1000 if completed else 1.0
+        return max(1.0, round(average_s * (len(self._queue) + 1) / self.max_concurrent, 1))
+
+    def acquire(self, user_id: str, timeout: Optional[float] = None,
+                cancel: Optional[CancelToken] = None) -> float:
+        """
+        取得一个名额，返回等待的毫秒数
+
+        队列已满或等待超过timeout（默认queue_timeout）秒时抛出AdmissionRejected；
+        排队期间cancel被取消时离开队列并抛出TurnCancelled。
+        """
+        with self._cond:
+            # 排队中的等待者每次有名额释放时都会被检查，此刻仍在排队说明它们受用户上限限制，
+            # 新到的轮次有名额时可以直接放行
+            if self._has_capacity(user_id):
+                self._take(user_id)
+                self._waits.append(0.0)
+                return 0.0
+            if len(self._queue) >= self.max_queue:
+                self.stats["rejected_queue_full"] += 1
+                raise AdmissionRejected("queue_full", self.retry_after())
+
+            ticket = _Ticket(user_id)
+            self._queue.append(ticket)
+            self.stats["queued"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._queue))
+            start = time.perf_counter()
+            deadline = time.monotonic() + (self.queue_timeout if timeout is None else timeout)
+            if cancel is not None:
+                cancel.add_callback(self._wake)
+            try:
+                while not ticket.admitted:
+                    if cancel is not None and cancel.cancelled:
+                        self._queue.remove(ticket)
+                        self.stats["cancelled"] += 1
+                        raise TurnCancelled()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._queue.remove(ticket)
+                        self.stats["rejected_timeout"] += 1
+                        raise AdmissionRejected("timeout", self.retry_after())
+                    self._cond.wait(remaining)
+            finally:
+                if cancel is not None:
+                    cancel.remove_callback(self._wake)
+
+            waited_ms = (time.perf_counter() - start) * 1000
+            self.stats["wait_ms"] += waited_ms
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], waited_ms)
+            self._waits.append(waited_ms)
+            return waited_ms
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def release(self, user_id: str, held_ms: float = 0.0):
+        """归还名额并放行等待者"""
+        with self._cond:
+            self._active -= 1
+            remaining = self._active_by_user[user_id] - 1
+            if remaining:
+                self._active_by_user[user_id] = remaining
+            else:
+                del self._active_by_user[user_id]
+            self.stats["hold_ms"] += held_ms
+            self._admit_waiters()
+
+    @contextmanager
+    def admit(self, user_id: str, timeout: Optional[float] = None) -> Iterator[float]:
+        """在名额内执行一段代码，产出等待的毫秒数"""
+        waited_ms = self.acquire(user_id, timeout)
+        start = time.perf_counter()
+        try:
+            yield waited_ms
+        finally:
+            self.release(user_id, (time.perf_counter() - start) * 1000)
+
+    def record_degraded(self):
+        with self._cond:
+            self.stats["degraded"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """当前并发数、队列深度、累计计数和最近的等待时间分位数"""
+        with self._cond:
+            waits: List[float] = sorted(self._waits)
+            result = {
+                **self.stats,
+                "active": self._active,
+                "queue_depth": len(self._queue),
+                "max_concurrent": self.max_concurrent,
+                "max_per_user": self.max_per_user,
+                "max_queue": self.max_queue
+            }
+        for name, q in (("p50", 0.5), ("p99", 0.99)):
+            result[f"wait_{name}_ms"] = round(waits[min(len(waits) - 1, int(q * len(waits)))], 2) if waits else 0.0
+        return result
+
+
+@contextmanager
+def admission_slot(controller: Optional[AdmissionController], user_id: str,
+             cancel: Optional[CancelToken] = None) -> Iterator[bool]:
+    """
+    在准入控制的名额内执行一轮，产出是否获准；controller为None时不限制
+
+    过载时按ADMISSION_OVERLOAD_MODE处理：reject（默认）直接抛出AdmissionRejected，
+    degrade产出False（由调用方返回降级回复）。
+    """
+    if controller is None:
+        yield True
+        return
+    try:
+        controller.acquire(user_id, cancel=cancel)
+    except AdmissionRejected:
+        if Config.ADMISSION_OVERLOAD_MODE != "degrade":
+            raise
+        controller.record_degraded()
+        yield False
+        return
+    start = time.perf_counter()
+    try:
+        yield True
+    finally:
+        controller.release(user_id, (time.perf_counter() - start) * 1000)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    """获取进程内共享的准入控制器（所有会话共用同一组上限）"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController()
+        return _controller
@@ -7,8 +7,12 @@ import os
 import json
 import time
 import uuid
+import threading
+from bisect import bisect_left, bisect_right, insort
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterator, List, Any, Optional, Tuple, Union
 
 # Conditional imports - only import if available
 try:
@@ -34,8 +38,62 @@ except ImportError:
     REQUESTS_AVAILABLE = False
     requests = None
 
+from admission import admission_slot, get_admission_controller
+from cancellation import CancelToken, TurnCancelled, raise_if_cancelled
 from config import Config
 from procedural_memory import procedural_memory
+from keyword_engine import KeywordHits, keyword_engine
+from memory_extraction import get_memory_extractor
+from memory_lock import get_user_lock
+from memory_writer import get_memory_writer
+from session_summary import SessionSummarizer
+from time_parser import TimeSpan, extract_time_expression, parse_time_expression
+from token_budget import (
+    MESSAGE_OVERHEAD, TokenBudget, count_tokens, fit_text, tokenizer_name
+)
+from working_memory import WorkingMemoryBuffer, WorkingMemoryItem, WorkingMemoryView
+
+# Simple empathetic responses based on keywords (关键词见keyword_engine中的mock_response表)
+MOCK_RESPONSES = {
+    "sad": "我感觉到你有些难过。有这种感觉很正常，我会陪伴你一起面对。",
+    "depress": "我听到你正在经历困难时期。抑郁确实很有挑战性，但你并不孤单。",
+    "anxious": "焦虑会让人感到不堪重负。让我们一起深呼吸，探索一下是什么引起了这些感受。",
+    "happy": "很高兴听到你感到积极！是什么让你感到快乐呢？",
+    "stress": "压力确实会对我们产生影响。让我们找出压力的来源，并找到应对的方法。",
+    "angry": "愤怒是一种自然的情绪。让我们探索一下是什么触发了这些感受，并找到健康的方式来表达它们。",
+    "lonely": "感到孤独确实很难受。你并不孤单，我会陪伴你并提供支持。",
+}
+
+# Default empathetic response
+DEFAULT_MOCK_RESPONSE = "我听到了你的话，我会陪伴你一起面对。你能告诉我更多关于你的感受吗？"
+
+
+class StreamInterrupted(RuntimeError):
+    """流式输出在产出部分内容之后失败：已输出的回复不完整，本轮不应写入记忆"""
+
+
+def mock_completion(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    """根据最后一条用户消息中的关键词生成模拟回复，供API不可用时回退使用"""
+    user_message = messages[-1]["content"] if messages else ""
+    keyword = keyword_engine.scan(user_message).first("mock_response")
+    return {
+        "choices": [{
+            "message": {
+                "role": "assistant",
+                "content": MOCK_RESPONSES.get(keyword, DEFAULT_MOCK_RESPONSE)
+            }
+        }]
+    }
+
+
+def mock_stream(messages: List[Dict[str, str]], chunk_chars: int = 4,
+                cancel: Optional[CancelToken] = None) -> Iterator[str]:
+    """把模拟回复按固定字数切块输出，模拟流式接口"""
+    content = mock_completion(messages)["choices"][0]["message"]["content"]
+    for i in range(0, len(content), chunk_chars):
+        raise_if_cancelled(cancel)
+        yield content[i:i + chunk_chars]
+
 
 class OpenRouterClient:
     def __init__(self, api_key: Optional[str] = None):
@@ -63,6 +121,7 @@ class OpenRouterClient:
             try:
                 self._ensure_client_initialized()
                 if self.client is not None:
+                    start = time.perf_counter()
                     response = self.client.chat.completions.create(
                         model=model,
                         messages=messages
@@ -73,7 +132,8 @@ class OpenRouterClient:
                                 "role": "assistant",
                                 "content": response.choices[0].message.content
                             }
-                        }]
+                        }],
+                        "usage": self._extract_usage(response, (time.perf_counter() - start) * 1000)
                     }
             except Exception as e:
                 # Fallback to mock response if API fails
@@ -83,48 +143,144 @@ class OpenRouterClient:
         # Use mock response if OpenAI not available or no API key
         return self._mock_response(messages)
     
-    def _mock_response(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    def chat_completion_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                               usage: Optional[Dict[str, Any]] = None,
+                               cancel: Optional[CancelToken] = None) -> Iterator[str]:
         """
-        Mock implementation for fallback when API is not available
+        流式输出回复片段，提供方返回的用量写入usage
+        在输出任何内容之前失败时退回模拟回复，之后失败时抛出StreamInterrupted；
+        cancel被取消时关闭连接并抛出TurnCancelled
         """
-        # Simple response generation based on the last user message
-        user_message = messages[-1]["content"] if messages else ""
-        
-        # Simple empathetic responses based on keywords
-        responses = {
-            "sad": "我感觉到你有些难过。有这种感觉很正常，我会陪伴你一起面对。",
-            "depress": "我听到你正在经历困难时期。抑郁确实很有挑战性，但你并不孤单。",
-            "anxious": "焦虑会让人感到不堪重负。让我们一起深呼吸，探索一下是什么引起了这些感受。",
-            "happy": "很高兴听到你感到积极！是什么让你感到快乐呢？",
-            "stress": "压力确实会对我们产生影响。让我们找出压力的来源，并找到应对的方法。",
-            "angry": "愤怒是一种自然的情绪。让我们探索一下是什么触发了这些感受，并找到健康的方式来表达它们。",
-            "lonely": "感到孤独确实很难受。你并不孤单，我会陪伴你并提供支持。",
-        }
-        
-        # Default empathetic response
-        response_text = "我听到了你的话，我会陪伴你一起面对。你能告诉我更多关于你的感受吗？"
-        
-        # Try to match keywords in the user message
-        user_message_lower = user_message.lower()
-        for keyword, response in responses.items():
-            if keyword in user_message_lower:
-                response_text = response
-                break
+        if model is None:
+            model = Config.DEFAULT_MODEL
         
+        emitted = False
+        if OPENAI_AVAILABLE and self.api_key:
+            try:
+                self._ensure_client_initialized()
+                if self.client is not None:
+                    start = time.perf_counter()
+                    stream = self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+                    if cancel is not None:
+                        cancel.add_callback(stream.close)
+                    for chunk in stream:
+                        raise_if_cancelled(cancel)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            emitted = True
+                            yield chunk.choices[0].delta.content
+                        if getattr(chunk, "usage", None) is not None and usage is not None:
+                            usage.update(self._extract_usage(chunk, (time.perf_counter() - start) * 1000))
+                    raise_if_cancelled(cancel)
+                    return
+            except TurnCancelled:
+                raise
+            except Exception as e:
+                # 取消时关闭连接会让读取出错，这不是提供方的故障
+                if cancel is not None and cancel.cancelled:
+                    raise TurnCancelled() from e
+                print(f"Warning: Streaming API call failed: {e}")
+                if emitted:
+                    raise StreamInterrupted(str(e)) from e
+        
+        yield from mock_stream(messages, cancel=cancel)
+    
+    def warm_up(self):
+        """在线模型无需预加载"""
+        pass
+    
+    def is_ready(self) -> bool:
+        """在线模型始终就绪"""
+        return True
+    
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """在线模型始终就绪"""
+        return True
+    
+    def _extract_usage(self, response: Any, elapsed_ms: float) -> Dict[str, Any]:
+        """提取token用量，其中cached_tokens为提供方提示缓存命中的token数"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return {"request_ms": elapsed_ms}
+        details = getattr(usage, "prompt_tokens_details", None)
         return {
-            "choices": [{
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                }
-            }]
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+            "cached_tokens": getattr(details, "cached_tokens", None) if details else None,
+            "request_ms": elapsed_ms
         }
+    
+    def _mock_response(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """
+        Mock implementation for fallback when API is not available
+        """
+        return mock_completion(messages)
 
 class OllamaClient:
     def __init__(self, base_url: Optional[str] = None, model: Optional[str] = None):
         self.base_url = base_url or Config.OLLAMA_BASE_URL
         self.model = model or Config.OLLAMA_MODEL
         self.available = REQUESTS_AVAILABLE
+        self.keep_alive = self._parse_keep_alive(Config.OLLAMA_KEEP_ALIVE)
+        
+        # 就绪状态: "cold" -> "loading" -> "ready" / "unavailable"
+        self.readiness = "cold" if self.available else "unavailable"
+        self._ready = threading.Event()
+        self._warm_up_thread = None
+        if not self.available:
+            self._ready.set()
+    
+    @staticmethod
+    def _parse_keep_alive(value: str):
+        """Ollama接受时长字符串或秒数，纯数字按秒数发送"""
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+    
+    def warm_up(self):
+        """在后台线程中预加载模型，不阻塞调用方"""
+        if self._ready.is_set() or self._warm_up_thread is not None:
+            return
+        self.readiness = "loading"
+        self._warm_up_thread = threading.Thread(target=self._warm_up, name="ollama-warm-up", daemon=True)
+        self._warm_up_thread.start()
+    
+    def _warm_up(self):
+        """发送不含prompt的generate请求，Ollama会加载模型并按keep_alive保持驻留"""
+        try:
+            response = requests.post(
+                f"{self.base_url}/api/generate",
+                json={
+                    "model": self.model,
+                    "keep_alive": self.keep_alive
+                },
+                timeout=Config.OLLAMA_WARMUP_TIMEOUT
+            )
+            if response.status_code == 200:
+                self.readiness = "ready"
+            else:
+                print(f"Warning: Ollama warm-up failed with status {response.status_code}")
+                self.readiness = "unavailable"
+        except Exception as e:
+            print(f"Warning: Ollama warm-up failed, will fall back to mock responses: {e}")
+            self.readiness = "unavailable"
+        finally:
+            self._ready.set()
+    
+    def is_ready(self) -> bool:
+        """模型是否已驻留（或已确认不可用，此时使用模拟回复）"""
+        return self._ready.is_set()
+    
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直到预加载结束，未调用warm_up时立即返回"""
+        if self._warm_up_thread is None:
+            return True
+        return self._ready.wait(timeout)
     
     def chat_completion(self, messages: List[Dict[str, str]], model: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -149,7 +305,8 @@ class OllamaClient:
                 json={
                     "model": model_name,
                     "messages": ollama_messages,
-                    "stream": False
+                    "stream": False,
+                    "keep_alive": self.keep_alive
                 },
                 timeout=120  # 2分钟超时
             )
@@ -162,7 +319,8 @@ class OllamaClient:
                             "role": "assistant",
                             "content": data["message"]["content"]
                         }
-                    }]
+                    }],
+                    "usage": self._extract_usage(data)
                 }
             else:
                 print(f"Warning: Ollama API call failed with status {response.status_code}")
@@ -171,42 +329,79 @@ class OllamaClient:
             print(f"Warning: Ollama API call failed, using mock response: {e}")
             return self._mock_response(messages)
     
-    def _mock_response(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+    def chat_completion_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                               usage: Optional[Dict[str, Any]] = None,
+                               cancel: Optional[CancelToken] = None) -> Iterator[str]:
         """
-        Mock implementation for fallback when Ollama is not available
+        流式输出回复片段（Ollama按行返回JSON），最后一行中的用量写入usage
+        在输出任何内容之前失败时退回模拟回复，之后失败时抛出StreamInterrupted；
+        cancel被取消时关闭连接并抛出TurnCancelled（Ollama在连接断开后停止生成）
         """
-        # Simple response generation based on the last user message
-        user_message = messages[-1]["content"] if messages else ""
-        
-        # Simple empathetic responses based on keywords
-        responses = {
-            "sad": "我感觉到你有些难过。有这种感觉很正常，我会陪伴你一起面对。",
-            "depress": "我听到你正在经历困难时期。抑郁确实很有挑战性，但你并不孤单。",
-            "anxious": "焦虑会让人感到不堪重负。让我们一起深呼吸，探索一下是什么引起了这些感受。",
-            "happy": "很高兴听到你感到积极！是什么让你感到快乐呢？",
-            "stress": "压力确实会对我们产生影响。让我们找出压力的来源，并找到应对的方法。",
-            "angry": "愤怒是一种自然的情绪。让我们探索一下是什么触发了这些感受，并找到健康的方式来表达它们。",
-            "lonely": "感到孤独确实很难受。你并不孤单，我会陪伴你并提供支持。",
-        }
-        
-        # Default empathetic response
-        response_text = "我听到了你的话，我会陪伴你一起面对。你能告诉我更多关于你的感受吗？"
+        if not self.available:
+            yield from mock_stream(messages, cancel=cancel)
+            return
         
-        # Try to match keywords in the user message
-        user_message_lower = user_message.lower()
-        for keyword, response in responses.items():
-            if keyword in user_message_lower:
-                response_text = response
-                break
+        emitted = False
+        try:
+            response = requests.post(
+                f"{self.base_url}/api/chat",
+                json={
+                    "model": model or self.model,
+                    "messages": [{"role": msg["role"], "content": msg["content"]} for msg in messages],
+                    "stream": True,
+                    "keep_alive": self.keep_alive
+                },
+                timeout=120,
+                stream=True
+            )
+            if cancel is not None:
+                cancel.add_callback(response.close)
+            if response.status_code != 200:
+                print(f"Warning: Ollama API call failed with status {response.status_code}")
+            else:
+                for line in response.iter_lines():
+                    raise_if_cancelled(cancel)
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    content = data.get("message", {}).get("content")
+                    if content:
+                        emitted = True
+                        yield content
+                    if data.get("done"):
+                        if usage is not None:
+                            usage.update(self._extract_usage(data))
+                        break
+                raise_if_cancelled(cancel)
+                return
+        except TurnCancelled:
+            raise
+        except Exception as e:
+            if cancel is not None and cancel.cancelled:
+                raise TurnCancelled() from e
+            print(f"Warning: Ollama streaming call failed: {e}")
+            if emitted:
+                raise StreamInterrupted(str(e)) from e
         
+        yield from mock_stream(messages, cancel=cancel)
+    
+    def _extract_usage(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        提取token用量和提示评估耗时
+        Ollama复用上下文时只评估未命中的后缀，因此prompt_eval_count会随前缀命中而减少
+        """
+        prompt_eval_duration = data.get("prompt_eval_duration")
         return {
-            "choices": [{
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                }
-            }]
+            "prompt_tokens": data.get("prompt_eval_count"),
+            "completion_tokens": data.get("eval_count"),
+            "prompt_eval_ms": prompt_eval_duration / 1e6 if prompt_eval_duration is not None else None
         }
+    
+    def _mock_response(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """
+        Mock implementation for fallback when Ollama is not available
+        """
+        return mock_completion(messages)
 
 class LLMClient:
     """统一的LLM客户端，支持多种模型提供商"""
@@ -224,11 +419,65 @@ class LLMClient:
             self.client = OpenRouterClient()
             self.provider = "openrouter"
     
-    def chat_completion(self, messages: List[Dict[str, str]], model: Optional[str] = None) -> Dict[str, Any]:
+    def chat_completion(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                        cancel: Optional[CancelToken] = None) -> Dict[str, Any]:
         """
         统一的聊天完成接口
+        
+        传入cancel时改用流式请求并拼接回复：取消后立即关闭连接，而不是等待完整回复生成完毕；
+        流式输出中途失败时与非流式请求一样退回模拟回复，不返回不完整的回复。
         """
-        return self.client.chat_completion(messages, model)
+        if cancel is None:
+            return self.client.chat_completion(messages, model)
+        usage: Dict[str, Any] = {}
+        try:
+            content = "".join(self.client.chat_completion_stream(messages, model, usage, cancel))
+        except StreamInterrupted:
+            return mock_completion(messages)
+        return {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": usage
+        }
+    
+    def chat_completion_stream(self, messages: List[Dict[str, str]], model: Optional[str] = None,
+                               usage: Optional[Dict[str, Any]] = None,
+                               cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        """统一的流式聊天接口，逐段产出回复文本"""
+        return self.client.chat_completion_stream(messages, model, usage, cancel)
+    
+    def warm_up(self):
+        """在后台预加载模型"""
+        self.client.warm_up()
+    
+    def is_ready(self) -> bool:
+        """模型是否可以立即响应"""
+        return self.client.is_ready()
+    
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """等待模型加载完成，超时返回False"""
+        return self.client.wait_until_ready(timeout)
+
+_vector_resources = None
+_vector_resources_lock = threading.Lock()
+
+
+def get_vector_resources():
+    """
+    进程内共享的向量数据库客户端和嵌入函数
+    
+    同一进程服务多个用户时只打开一次数据库、只加载一次嵌入模型；
+    返回 (client, embedding_function)，初始化失败时抛出异常。
+    """
+    global _vector_resources
+    with _vector_resources_lock:
+        if _vector_resources is None:
+            client = chromadb.PersistentClient(path=Config.VECTOR_DB_PATH)
+            embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+                model_name="all-MiniLM-L6-v2"
+            )
+            _vector_resources = (client, embedding_function)
+        return _vector_resources
+
 
 class MemorySystem:
     """Multi-layered memory system for the AI Psychologist"""
@@ -245,9 +494,24 @@ class MemorySystem:
         self._init_vector_db()
         
         # Initialize memory layers
-        self.working_memory = []  # Short-term conversation context
+        # Short-term conversation context，按消息条数和token数限制
+        self.working_memory = WorkingMemoryBuffer(Config.WORKING_MEMORY_SIZE, Config.WORKING_MEMORY_TOKENS)
         self.episodic_memory = []  # Time-stamped events and experiences
         self.semantic_memory = {}  # Facts, knowledge, and user profile
+        # 移出工作记忆的对话折叠成的会话摘要，以及尚未折叠的消息
+        self.session_summary = ""
+        self.summary_pending: List[Dict[str, str]] = []
+        
+        # 情景记忆的时间索引：按时间戳排序的 (timestamp, id) 列表、id -> 记忆、time_reference -> ids
+        self._time_index = []
+        self._episodes_by_id = {}
+        self._ids_by_time_reference = {}
+        
+        # 对话线程与后台提取线程都会修改记忆，修改时需持有此锁；同一用户的所有实例共用一把锁，
+        # 修改并保存记忆文件时通过mutation()同时持有跨进程文件锁
+        self.lock = get_user_lock(user_id, self.user_dir)
+        # 上次加载或保存时记忆文件的 (mtime_ns, size)，用于发现其他进程或实例写入的修改
+        self._disk_signature = None
         
         # Load existing memories
         self._load_memories()
@@ -260,14 +524,12 @@ class MemorySystem:
                 import os
                 os.environ['HF_HUB_OFFLINE'] = '1'
                 
-                chroma_client = chromadb.PersistentClient(path=Config.VECTOR_DB_PATH)
                 # 尝试使用国内镜像源
                 try:
+                    chroma_client, embedding_function = get_vector_resources()
                     self.collection = chroma_client.get_or_create_collection(
                         name=f"user_{self.user_id}_memories",
-                        embedding_function=embedding_functions.SentenceTransformerEmbeddingFunction(
-                            model_name="all-MiniLM-L6-v2"
-                        )
+                        embedding_function=embedding_function
                     )
                     print("✓ 向量数据库初始化成功")
                 except Exception as e:
@@ -291,6 +553,24 @@ class MemorySystem:
     
     def _load_memories(self):
         """Load existing memories from storage"""
+        self._load_memory_files()
+        
+        # 恢复上次会话的工作记忆和会话摘要（一次小文件读取，不扫描情景记忆）
+        self._load_session_state()
+    
+    def _memory_file_signature(self) -> Tuple:
+        signature = []
+        for filename in ("semantic_memory.json", "episodic_memory.json"):
+            try:
+                stat = os.stat(os.path.join(self.user_dir, filename))
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+    
+    def _load_memory_files(self):
+        """读取语义记忆和情景记忆文件（先记录文件签名，读取期间文件被替换时下次修改前会重新加载）"""
+        self._disk_signature = self._memory_file_signature()
         # Load semantic memory (user profile and facts)
         semantic_file = os.path.join(self.user_dir, "semantic_memory.json")
         if os.path.exists(semantic_file):
@@ -308,159 +588,442 @@ class MemorySystem:
                     self.episodic_memory = json.load(f)
             except Exception as e:
                 print(f"Warning: Could not load episodic memory: {e}")
+        self._rebuild_time_index()
     
-    def save_memories(self):
-        """Save all memories to persistent storage"""
-        # Save semantic memory
-        semantic_file = os.path.join(self.user_dir, "semantic_memory.json")
+    @contextmanager
+    def mutation(self) -> Iterator[None]:
+        """
+        修改语义记忆或情景记忆的临界区
+        
+        进程内与同一用户的其他线程互斥，并持有跨进程文件锁；进入最外层时如果记忆文件已被
+        其他进程（或同一用户的其他实例）修改，先重新加载，使读-改-写基于最新的数据，不丢失更新。
+        """
+        with self.lock.exclusive() as outermost:
+            if outermost and self._memory_file_signature() != self._disk_signature:
+                self.semantic_memory = {}
+                self.episodic_memory = []
+                self._load_memory_files()
+            yield
+    
+    def _session_state_file(self) -> str:
+        return os.path.join(self.user_dir, "session_state.json")
+    
+    def _load_session_state(self):
+        """从紧凑快照恢复工作记忆、会话摘要和尚未折叠的消息"""
+        state_file = self._session_state_file()
+        if not os.path.exists(state_file):
+            return
         try:
-            with open(semantic_file, 'w', encoding='utf-8') as f:
-                json.dump(self.semantic_memory, f, ensure_ascii=False, indent=2)
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.working_memory.restore(state.get("working_memory", []),
+                                        recount=state.get("tokenizer") != tokenizer_name())
+            self.session_summary = state.get("summary", "")
+            self.summary_pending = state.get("summary_pending", [])
         except Exception as e:
-            print(f"Error saving semantic memory: {e}")
-        
-        # Save episodic memory
-        episodic_file = os.path.join(self.user_dir, "episodic_memory.json")
+            print(f"Warning: Could not load session state: {e}")
+    
+    def save_session_state(self):
+        """保存工作记忆、会话摘要和尚未折叠的消息的紧凑快照，先写临时文件再原子替换"""
+        state_file = self._session_state_file()
+        tmp_file = f"{state_file}.{threading.get_ident()}.tmp"
+        # 持锁写入，保证较新的快照不会被较旧的覆盖
+        with self.lock:
+            state = {
+                "version": 1,
+                "tokenizer": tokenizer_name(),
+                "summary": self.session_summary,
+                "summary_pending": list(self.summary_pending),
+                "working_memory": self.working_memory.to_state()
+            }
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(state, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp_file, state_file)
+            except Exception as e:
+                print(f"Error saving session state: {e}")
+    
+    def _rebuild_time_index(self):
+        """根据episodic_memory重建时间索引"""
+        self._time_index = []
+        self._episodes_by_id = {}
+        self._ids_by_time_reference = {}
+        for memory in self.episodic_memory:
+            self._index_episode(memory)
+    
+    def _index_episode(self, memory: Dict[str, Any]):
+        """把一条情景记忆加入时间索引"""
+        episode_id = memory.get("id")
+        if episode_id is None or episode_id in self._episodes_by_id:
+            return
+        self._episodes_by_id[episode_id] = memory
+        if memory.get("timestamp") is not None:
+            insort(self._time_index, (memory["timestamp"], episode_id))
+        if memory.get("time_reference"):
+            self._ids_by_time_reference.setdefault(memory["time_reference"], []).append(episode_id)
+    
+    def _unindex_episode(self, memory: Dict[str, Any]):
+        """把一条情景记忆从时间索引中移除"""
+        episode_id = memory.get("id")
+        if self._episodes_by_id.pop(episode_id, None) is None:
+            return
+        if memory.get("timestamp") is not None:
+            key = (memory["timestamp"], episode_id)
+            i = bisect_left(self._time_index, key)
+            if i < len(self._time_index) and self._time_index[i] == key:
+                del self._time_index[i]
+        ids = self._ids_by_time_reference.get(memory.get("time_reference"))
+        if ids and episode_id in ids:
+            ids.remove(episode_id)
+            if not ids:
+                del self._ids_by_time_reference[memory["time_reference"]]
+    
+    def _time_window(self, start: float, end: float, include_end: bool = True) -> range:
+        """时间戳落在 [start, end]（include_end为False时为 [start, end)）内的索引位置"""
+        lo = bisect_left(self._time_index, (start,))
+        hi = bisect_right(self._time_index, (end, chr(0x10FFFF))) if include_end else bisect_left(self._time_index, (end,))
+        return range(lo, hi)
+    
+    def _nearest_episode(self, timestamp: float, tolerance: float) -> Optional[Dict[str, Any]]:
+        """在容差范围内查找时间戳最接近的情景记忆，等距时取较早的一条"""
+        best_match = None
+        best_diff = float('inf')
+        for i in self._time_window(timestamp - tolerance, timestamp + tolerance):
+            memory_timestamp, episode_id = self._time_index[i]
+            diff = abs(memory_timestamp - timestamp)
+            if diff < best_diff:
+                best_match = self._episodes_by_id[episode_id]
+                best_diff = diff
+            elif memory_timestamp > timestamp:
+                break
+        return best_match
+    
+    def save_memories(self):
+        """Save all memories to persistent storage（先写临时文件再原子替换，其他进程不会读到写了一半的文件）"""
+        # 只加锁不检查文件签名：调用方已在mutation()中完成修改，这里不能用磁盘上的旧数据覆盖它
+        with self.lock.exclusive():
+            # Save semantic memory
+            self._write_json_atomic("semantic_memory.json", self.semantic_memory, "semantic memory")
+            
+            # Save episodic memory
+            self._write_json_atomic("episodic_memory.json", self.episodic_memory, "episodic memory")
+            self._disk_signature = self._memory_file_signature()
+    
+    def _write_json_atomic(self, filename: str, data: Any, label: str):
+        file_path = os.path.join(self.user_dir, filename)
+        tmp_file = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
         try:
-            with open(episodic_file, 'w', encoding='utf-8') as f:
-                json.dump(self.episodic_memory, f, ensure_ascii=False, indent=2)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, file_path)
         except Exception as e:
-            print(f"Error saving episodic memory: {e}")
-    
-    def add_working_memory(self, message: Dict[str, str]):
-        """Add a message to working memory"""
-        self.working_memory.append({
-            "id": str(uuid.uuid4()),
-            "timestamp": time.time(),
-            "message": message
-        })
-        
-        # Keep only the last N messages in working memory
-        if len(self.working_memory) > Config.WORKING_MEMORY_SIZE:
-            self.working_memory = self.working_memory[-Config.WORKING_MEMORY_SIZE:]
-    
-    def add_episodic_memory(self, event: Dict[str, Any]):
-        """Add an event to episodic memory"""
-        event_entry = {
-            "id": str(uuid.uuid4()),
-            "timestamp": time.time(),
-            "datetime": datetime.now().isoformat(),
-            **event
-        }
-        self.episodic_memory.append(event_entry)
+            print(f"Error saving {label}: {e}")
+    
+    def add_working_memory(self, message: Dict[str, str], persist: bool = True) -> List[WorkingMemoryItem]:
+        """Add a message to working memory, returns the messages evicted by the message/token limits"""
+        evicted = self.working_memory.append(message)
+        if persist:
+            self.save_session_state()
+        return evicted
+    
+    def add_episodic_memory(self, event: Dict[str, Any]) -> str:
+        """Add an event to episodic memory, returns the id of the new entry"""
+        with self.mutation():
+            event_entry = {
+                "id": str(uuid.uuid4()),
+                "timestamp": time.time(),
+                "datetime": datetime.now().isoformat(),
+                **event
+            }
+            self.episodic_memory.append(event_entry)
+            self._index_episode(event_entry)
         
-        # Add to vector database if available
-        if self.collection and "summary" in event:
-            try:
-                # 将复杂对象转换为字符串以避免向量数据库错误
-                metadata = {
-                    "summary": event["summary"],
-                    "timestamp": event_entry["timestamp"],
-                    "datetime": event_entry["datetime"]
-                }
+            # Add to vector database if available
+            if self.collection and "summary" in event:
+                try:
+                    # 将复杂对象转换为字符串以避免向量数据库错误
+                    metadata = {
+                        "summary": event["summary"],
+                        "timestamp": event_entry["timestamp"],
+                        "datetime": event_entry["datetime"]
+                    }
                 
-                # 如果有交互信息，将其转换为字符串
-                if "interaction" in event:
-                    interaction_str = json.dumps(event["interaction"], ensure_ascii=False)
-                    metadata["interaction"] = interaction_str
+                    # 如果有交互信息，将其转换为字符串
+                    if "interaction" in event:
+                        interaction_str = json.dumps(event["interaction"], ensure_ascii=False)
+                        metadata["interaction"] = interaction_str
                 
-                self.collection.add(
-                    documents=[event["summary"]],
-                    metadatas=[metadata],  # 使用简化后的metadata
-                    ids=[event_entry["id"]]
-                )
-            except Exception as e:
-                print(f"Warning: Could not add to vector database: {e}")
+                    self.collection.add(
+                        documents=[event["summary"]],
+                        metadatas=[metadata],  # 使用简化后的metadata
+                        ids=[event_entry["id"]]
+                    )
+                except Exception as e:
+                    print(f"Warning: Could not add to vector database: {e}")
         
-        # Save to persistent storage
-        self.save_memories()
+            # Save to persistent storage
+            self.save_memories()
+            return event_entry["id"]
     
-    def add_time_based_episodic_memory(self, time_ref: str, event_details: Dict[str, Any]):
-        """添加基于时间参考的情景记忆"""
-        # 解析时间参考
-        timestamp = self._parse_time_reference(time_ref)
-        if not timestamp:
-            print(f"无法解析时间参考: {time_ref}")
-            return
+    def add_episodic_memories(self, events: List[Dict[str, Any]], batch_size: int = 500) -> List[str]:
+        """
+        批量导入情景记忆（如回填历史或生成测试数据），返回新记忆的id
         
-        # 创建时间点记录，使用统一的数据结构
-        event_entry = {
-            "id": str(uuid.uuid4()),
-            "timestamp": timestamp,
-            "datetime": datetime.fromtimestamp(timestamp).isoformat() if timestamp else datetime.now().isoformat(),
-            "time_reference": time_ref,  # 添加时间参考字段
-            "interaction": {
-                "user_message": event_details.get("user_message", ""),
-                "ai_response": event_details.get("ai_response", ""),
-                "emotional_insights": event_details.get("emotional_insights", {})
-            },
-            "activity": event_details.get("activity", "其他活动"),  # 添加活动字段
-            "summary": self._summarize_time_events([event_details])
-        }
+        事件中已有的timestamp/datetime保留不变；向量数据库按批写入，记忆文件只保存一次。
+        """
+        with self.mutation():
+            now = time.time()
+            entries = []
+            for event in events:
+                timestamp = event.get("timestamp", now)
+                entry = {
+                    "id": str(uuid.uuid4()),
+                    "datetime": datetime.fromtimestamp(timestamp).isoformat(),
+                    **event,
+                    "timestamp": timestamp
+                }
+                entries.append(entry)
+                self.episodic_memory.append(entry)
+                self._index_episode(entry)
+            
+            if self.collection:
+                with_summary = [entry for entry in entries if "summary" in entry]
+                for start in range(0, len(with_summary), batch_size):
+                    batch = with_summary[start:start + batch_size]
+                    try:
+                        self.collection.add(
+                            documents=[entry["summary"] for entry in batch],
+                            metadatas=[{
+                                "summary": entry["summary"],
+                                "timestamp": entry["timestamp"],
+                                "datetime": entry["datetime"],
+                                "interaction": json.dumps(entry.get("interaction", {}), ensure_ascii=False)
+                            } for entry in batch],
+                            ids=[entry["id"] for entry in batch]
+                        )
+                    except Exception as e:
+                        print(f"Warning: Could not add to vector database: {e}")
+                        break
+            
+            self.save_memories()
+            return [entry["id"] for entry in entries]
+    
+    def add_time_based_episodic_memory(self, time_ref: str, event_details: Dict[str, Any]) -> Optional[str]:
+        """添加基于时间参考的情景记忆，返回新建或合并后的记忆id"""
+        with self.mutation():
+            # 解析时间参考
+            timestamp = self._parse_time_reference(time_ref)
+            if not timestamp:
+                print(f"无法解析时间参考: {time_ref}")
+                return None
+        
+            # 创建时间点记录，使用统一的数据结构
+            event_entry = {
+                "id": str(uuid.uuid4()),
+                "timestamp": timestamp,
+                "datetime": datetime.fromtimestamp(timestamp).isoformat() if timestamp else datetime.now().isoformat(),
+                "time_reference": time_ref,  # 添加时间参考字段
+                "interaction": {
+                    "user_message": event_details.get("user_message", ""),
+                    "ai_response": event_details.get("ai_response", ""),
+                    "emotional_insights": event_details.get("emotional_insights", {})
+                },
+                "activity": event_details.get("activity", "其他活动"),  # 添加活动字段
+                "summary": self._summarize_time_events([event_details])
+            }
         
-        # 检查是否已存在该时间点的记忆
-        existing_index = None
-        for i, memory in enumerate(self.episodic_memory):
-            if abs(memory["timestamp"] - timestamp) < 24 * 60 * 60:  # 24小时容差
-                existing_index = i
-                break
+            # 检查是否已存在该时间点的记忆（24小时容差）
+            existing = self._nearest_episode(timestamp, 24 * 60 * 60)
+            if existing is not None and abs(existing["timestamp"] - timestamp) >= 24 * 60 * 60:
+                existing = None
         
-        if existing_index is not None:
-            # 合并事件详情，使用统一的数据结构
-            existing = self.episodic_memory[existing_index]
+            if existing is not None:
+                # 合并事件详情，使用统一的数据结构
             
-            # 确保existing有统一的结构
-            if "interaction" not in existing:
-                existing["interaction"] = {
-                    "user_message": "",
-                    "ai_response": "",
-                    "emotional_insights": {}
-                }
+                # 确保existing有统一的结构
+                if "interaction" not in existing:
+                    existing["interaction"] = {
+                        "user_message": "",
+                        "ai_response": "",
+                        "emotional_insights": {}
+                    }
             
-            # 添加时间参考字段（如果不存在）
-            if "time_reference" not in existing:
-                existing["time_reference"] = time_ref
+                # 添加时间参考字段（如果不存在）
+                if "time_reference" not in existing:
+                    existing["time_reference"] = time_ref
+                    self._ids_by_time_reference.setdefault(time_ref, []).append(existing["id"])
             
-            # 添加活动字段（如果不存在）
-            if "activity" not in existing:
-                existing["activity"] = "其他活动"
+                # 添加活动字段（如果不存在）
+                if "activity" not in existing:
+                    existing["activity"] = "其他活动"
             
-            # 添加新的交互记录到现有记录中
-            # 注意：这里我们保持单个interaction，而不是details数组
-            # 如果需要记录多个交互，可以考虑其他方式
-            existing["interaction"] = {
-                "user_message": event_details.get("user_message", ""),
-                "ai_response": event_details.get("ai_response", ""),
-                "emotional_insights": event_details.get("emotional_insights", {})
-            }
+                # 添加新的交互记录到现有记录中
+                # 注意：这里我们保持单个interaction，而不是details数组
+                # 如果需要记录多个交互，可以考虑其他方式
+                existing["interaction"] = {
+                    "user_message": event_details.get("user_message", ""),
+                    "ai_response": event_details.get("ai_response", ""),
+                    "emotional_insights": event_details.get("emotional_insights", {})
+                }
             
-            # 更新活动信息
-            existing["activity"] = event_details.get("activity", existing.get("activity", "其他活动"))
+                # 更新活动信息
+                existing["activity"] = event_details.get("activity", existing.get("activity", "其他活动"))
             
-            # 重新生成摘要
-            existing["summary"] = self._summarize_time_events([event_details])
-        else:
-            # 添加新的时间点记录
-            self.episodic_memory.append(event_entry)
+                # 重新生成摘要
+                existing["summary"] = self._summarize_time_events([event_details])
+                episode_id = existing["id"]
+            else:
+                # 添加新的时间点记录
+                self.episodic_memory.append(event_entry)
+                self._index_episode(event_entry)
+                episode_id = event_entry["id"]
         
-        # 保存到持久化存储
-        self.save_memories()
+            # 保存到持久化存储
+            self.save_memories()
         
-        # 添加到向量数据库（如果可用）
-        if self.collection:
-            try:
-                self.collection.add(
-                    documents=[event_entry["summary"]],
-                    metadatas=[{
-                        "summary": event_entry["summary"],
-                        "timestamp": event_entry["timestamp"],
-                        "time_reference": event_entry["time_reference"],
-                        "datetime": event_entry["datetime"]
-                    }],
-                    ids=[event_entry["id"]]
-                )
-            except Exception as e:
-                print(f"Warning: Could not add to vector database: {e}")
+            # 添加到向量数据库（如果可用）
+            if self.collection:
+                try:
+                    self.collection.add(
+                        documents=[event_entry["summary"]],
+                        metadatas=[{
+                            "summary": event_entry["summary"],
+                            "timestamp": event_entry["timestamp"],
+                            "time_reference": event_entry["time_reference"],
+                            "datetime": event_entry["datetime"]
+                        }],
+                        ids=[event_entry["id"]]
+                    )
+                except Exception as e:
+                    print(f"Warning: Could not add to vector database: {e}")
+        
+            return episode_id
+
+    def get_episode(self, episode_id: str) -> Optional[Dict[str, Any]]:
+        """根据id获取情景记忆"""
+        return self._episodes_by_id.get(episode_id)
+    
+    def iter_episodes_in_range(self, start: Union[float, datetime], end: Union[float, datetime],
+                               order: str = "asc", chunk_size: int = 256) -> Iterator[Dict[str, Any]]:
+        """
+        按时间顺序流式返回时间戳在 [start, end) 内的情景记忆
+        
+        每次只在锁内复制一小段索引，遍历过程中新增或删除的记忆不会导致重复或遗漏已遍历的部分。
+        """
+        if order not in ("asc", "desc"):
+            raise ValueError(f"order must be 'asc' or 'desc', got {order!r}")
+        start = start.timestamp() if isinstance(start, datetime) else start
+        end = end.timestamp() if isinstance(end, datetime) else end
+        if end <= start:
+            return
+        
+        cursor = None  # 上一段最后一个 (timestamp, id)
+        while True:
+            with self.lock:
+                window = self._time_window(start, end, include_end=False)
+                if order == "asc":
+                    lo = window.start if cursor is None else max(window.start, bisect_right(self._time_index, cursor))
+                    keys = self._time_index[lo:min(lo + chunk_size, window.stop)]
+                else:
+                    hi = window.stop if cursor is None else min(window.stop, bisect_left(self._time_index, cursor))
+                    keys = self._time_index[max(window.start, hi - chunk_size):hi][::-1]
+                chunk = [self._episodes_by_id[episode_id] for _, episode_id in keys]
+            if not chunk:
+                return
+            yield from chunk
+            cursor = keys[-1]
+    
+    def get_episodes_in_range(self, start: Union[float, datetime], end: Union[float, datetime],
+                              limit: Optional[int] = None, order: str = "asc") -> List[Dict[str, Any]]:
+        """获取时间戳在 [start, end) 内的情景记忆，order为"asc"（由早到晚）或"desc"（由晚到早）"""
+        episodes = []
+        for episode in self.iter_episodes_in_range(start, end, order):
+            if limit is not None and len(episodes) >= limit:
+                break
+            episodes.append(episode)
+        return episodes
+    
+    def remove_episodic_memory(self, episode_id: str) -> bool:
+        """删除一条情景记忆，返回是否存在"""
+        with self.mutation():
+            memory = self._episodes_by_id.get(episode_id)
+            if memory is None:
+                return False
+            self._unindex_episode(memory)
+            self.episodic_memory = [m for m in self.episodic_memory if m is not memory]
+            if self.collection:
+                try:
+                    self.collection.delete(ids=[episode_id])
+                except Exception as e:
+                    print(f"Warning: Could not delete from vector database: {e}")
+            self.save_memories()
+            return True
+
+    def apply_extracted_insights(self, episode_id: str, extracted: Dict[str, Any],
+                                 keyword_results: Dict[str, Any], user_message: str = ""):
+        """
+        写回LLM批量提取的结果
+        
+        keyword_results是该轮关键词提取已经计入档案的情绪、话题和关注点，
+        这里只补充关键词没有识别出的部分，避免重复计数。
+        """
+        with self.mutation():
+            episode = self.get_episode(episode_id)
+            if episode is not None:
+                insights = {
+                    "emotions": extracted["emotions"],
+                    "topics": extracted["topics"],
+                    "intensity": extracted["intensity"],
+                    "source": "llm"
+                }
+                episode.setdefault("interaction", {})["emotional_insights"] = insights
+                if "time_reference" in episode:
+                    if extracted["activity"]:
+                        episode["activity"] = extracted["activity"]
+                    episode["summary"] = self._summarize_time_events([{
+                        "emotional_insights": insights,
+                        "activity": episode.get("activity", "其他活动")
+                    }])
+                else:
+                    episode["summary"] = f"用户表达了 {', '.join(insights['emotions']) if insights['emotions'] else '感受'}"
+                
+                if self.collection:
+                    try:
+                        self.collection.update(
+                            ids=[episode_id],
+                            documents=[episode["summary"]],
+                            metadatas=[{"summary": episode["summary"], "timestamp": episode["timestamp"],
+                                        "datetime": episode["datetime"]}]
+                        )
+                    except Exception as e:
+                        print(f"Warning: Could not update vector database: {e}")
+            
+            user_profile = self.get_user_profile()
+            personality_insights = user_profile.get("personality_insights", {})
+            for emotion in extracted["emotions"]:
+                if emotion not in keyword_results.get("emotions", []):
+                    personality_insights[emotion] = personality_insights.get(emotion, 0) + 1
+            user_profile["personality_insights"] = personality_insights
+            
+            preferences = user_profile.get("preferences", {})
+            preferences.update(extracted["preferences"])
+            for topic in extracted["topics"]:
+                if topic not in keyword_results.get("topics", []):
+                    preferences[f"interest_{topic}"] = preferences.get(f"interest_{topic}", 0) + 1
+            user_profile["preferences"] = preferences
+            
+            psychological_history = user_profile.get("psychological_history", [])
+            for concern in extracted["concerns"]:
+                if concern not in keyword_results.get("concerns", []):
+                    psychological_history.append({
+                        "concern": concern,
+                        "timestamp": time.time(),
+                        "context": user_message[:100] + "..." if len(user_message) > 100 else user_message
+                    })
+            user_profile["psychological_history"] = psychological_history[-50:]
+            
+            self.semantic_memory["user_profile"] = user_profile
+            self.save_memories()
 
     def _summarize_time_events(self, events: List[Dict[str, Any]]) -> str:
         """自动总结时间点事件"""
@@ -476,12 +1039,13 @@ class MemorySystem:
 
     def update_semantic_memory(self, key: str, value: Any):
         """Update semantic memory with a key-value pair"""
-        self.semantic_memory[key] = value
-        self.save_memories()
+        with self.mutation():
+            self.semantic_memory[key] = value
+            self.save_memories()
     
-    def get_working_memory_context(self) -> List[Dict[str, str]]:
-        """Get the current working memory as context"""
-        return [item["message"] for item in self.working_memory]
+    def get_working_memory_context(self) -> WorkingMemoryView:
+        """Get the current working memory as context (a read-only view, not a copy)"""
+        return self.working_memory.view()
     
     def get_relevant_episodic_memories(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
         """Get relevant episodic memories based on a query"""
@@ -515,99 +1079,43 @@ class MemorySystem:
     
     def reset_memory(self):
         """Reset all memory for the user"""
-        self.working_memory = []
-        self.episodic_memory = []
-        self.semantic_memory = {}
-        
-        # Clear vector database collection
-        if self.collection:
-            try:
-                self.collection.delete(ids=[mem["id"] for mem in self.episodic_memory])
-            except Exception as e:
-                print(f"Warning: Could not clear vector database: {e}")
-        
-        # Remove memory files
-        for filename in ["semantic_memory.json", "episodic_memory.json"]:
-            file_path = os.path.join(self.user_dir, filename)
-            if os.path.exists(file_path):
+        with self.mutation():
+            # Clear vector database collection
+            if self.collection and self.episodic_memory:
                 try:
-                    os.remove(file_path)
+                    self.collection.delete(ids=[mem["id"] for mem in self.episodic_memory])
                 except Exception as e:
-                    print(f"Warning: Could not remove {filename}: {e}")
+                    print(f"Warning: Could not clear vector database: {e}")
+            
+            self.working_memory.clear()
+            self.session_summary = ""
+            self.summary_pending = []
+            self.episodic_memory = []
+            self.semantic_memory = {}
+            self._rebuild_time_index()
+            
+            # Remove memory files
+            for filename in ["semantic_memory.json", "episodic_memory.json", "session_state.json"]:
+                file_path = os.path.join(self.user_dir, filename)
+                if os.path.exists(file_path):
+                    try:
+                        os.remove(file_path)
+                    except Exception as e:
+                        print(f"Warning: Could not remove {filename}: {e}")
+            self._disk_signature = self._memory_file_signature()
     
     def _extract_time_reference(self, user_message: str) -> Optional[str]:
         """从用户消息中提取时间参考"""
-        import re
-        
-        # 时间表达式模式
-        patterns = [
-            r'昨天', r'今天', r'明天', r'前天', r'大前天',
-            r'上周', r'这周', r'下周',
-            r'上个月', r'这个月', r'下个月',
-            r'去年', r'今年', r'明年',
-            r'(\d{4})年(\d{1,2})月(\d{1,2})日',  # YYYY年MM月DD日
-            r'(\d{1,2})月(\d{1,2})日',           # MM月DD日
-            r'(\d{4})-(\d{1,2})-(\d{1,2})',      # YYYY-MM-DD
-            r'(\d{1,2})/(\d{1,2})/(\d{4})',      # MM/DD/YYYY
-            r'暑假', r'寒假', r'春节'  # 特殊时间点
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, user_message)
-            if match:
-                return match.group(0)
-        
-        return None
+        return extract_time_expression(user_message)
+
+    def _parse_time_span(self, time_ref: str) -> Optional[TimeSpan]:
+        """将时间参考解析为时间段"""
+        return parse_time_expression(time_ref)
 
     def _parse_time_reference(self, time_ref: str) -> Optional[float]:
-        """将时间参考解析为时间戳"""
-        from datetime import datetime, timedelta
-        import re
-        
-        now = datetime.now()
-        
-        # 相对时间
-        if time_ref == '昨天':
-            return (now - timedelta(days=1)).timestamp()
-        elif time_ref == '今天':
-            return now.timestamp()
-        elif time_ref == '前天':
-            return (now - timedelta(days=2)).timestamp()
-        elif time_ref == '去年':
-            return (now - timedelta(days=365)).timestamp()
-        elif time_ref == '今年':
-            return now.timestamp()  # 今年应该返回年初的时间戳
-        elif time_ref == '暑假':
-            # 假设暑假是7-8月
-            return now.replace(month=7, day=1).timestamp()
-        elif time_ref == '寒假':
-            # 假设寒假是1-2月
-            return now.replace(month=1, day=1).timestamp()
-        
-        # 绝对时间
-        date_patterns = [
-            r'(\d{4})年(\d{1,2})月(\d{1,2})日',
-            r'(\d{4})-(\d{1,2})-(\d{1,2})',
-            r'(\d{1,2})/(\d{1,2})/(\d{4})',
-        ]
-        
-        for pattern in date_patterns:
-            match = re.match(pattern, time_ref)
-            if match:
-                try:
-                    if pattern == date_patterns[0]:  # YYYY年MM月DD日
-                        year, month, day = map(int, match.groups())
-                    elif pattern == date_patterns[1]:  # YYYY-MM-DD
-                        year, month, day = map(int, match.groups())
-                    else:  # MM/DD/YYYY
-                        month, day, year = map(int, match.groups())
-                    
-                    date = datetime(year, month, day)
-                    return date.timestamp()
-                except:
-                    continue
-        
-        return None
+        """将时间参考解析为时间戳（时间段的起点）"""
+        span = self._parse_time_span(time_ref)
+        return span.start if span else None
 
     def get_episodic_memory_by_time(self, time_ref: str) -> Optional[Dict[str, Any]]:
         """根据时间参考获取情景记忆"""
@@ -615,35 +1123,103 @@ class MemorySystem:
         if not timestamp:
             return None
         
-        # 查找最接近的时间点（允许一定的时间误差）
-        tolerance = 24 * 60 * 60  # 24小时容差
-        best_match = None
-        best_diff = float('inf')
+        # 优先返回时间参考完全一致的记忆
+        ids = self._ids_by_time_reference.get(time_ref)
+        if ids:
+            return self._episodes_by_id[ids[0]]
         
-        for memory in self.episodic_memory:
-            # 检查记忆是否有时间参考字段并且匹配
-            if "time_reference" in memory and memory["time_reference"] == time_ref:
-                return memory
-            
-            # 如果没有精确匹配，使用时间戳匹配
-            diff = abs(memory["timestamp"] - timestamp)
-            if diff <= tolerance and diff < best_diff:
-                best_match = memory
-                best_diff = diff
-        
-        return best_match
+        # 如果没有精确匹配，查找最接近的时间点（24小时容差）
+        return self._nearest_episode(timestamp, 24 * 60 * 60)
+
+_context_executor = None
+_context_executor_lock = threading.Lock()
+
+
+def get_context_executor() -> ThreadPoolExecutor:
+    """所有会话共享的上下文检索线程池"""
+    global _context_executor
+    with _context_executor_lock:
+        if _context_executor is None:
+            # 未配置时按并发轮次上限估算：每轮最多有两个阶段（相关记忆、治疗技术）在池中执行
+            workers = Config.CONTEXT_STAGE_WORKERS or 2 * Config.SERVER_MAX_CONCURRENCY
+            _context_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="context-stage")
+        return _context_executor
+
 
 class AIPsychologist:
     """Main AI Psychologist class with long-term memory capabilities"""
     
-    def __init__(self, user_id: str = "default_user"):
+    def __init__(self, user_id: str = "default_user", llm_client: Optional[LLMClient] = None):
         self.user_id = user_id
-        self.llm_client = LLMClient()  # 使用统一的LLM客户端
+        # 多用户服务时传入共享的LLM客户端，由服务端负责预加载
+        if llm_client is None:
+            llm_client = LLMClient()  # 使用统一的LLM客户端
+            # 模型加载与记忆系统初始化并行进行
+            if Config.OLLAMA_PRELOAD:
+                llm_client.warm_up()
+        self.llm_client = llm_client
         self.memory_system = MemorySystem(user_id)
         
         # Initialize with a default personality
         self.personality = "empathetic"
         
+        # 后台批量LLM记忆提取（可选）
+        self.memory_extractor = get_memory_extractor(self.llm_client) if Config.LLM_EXTRACTION_ENABLED else None
+        
+        # 移出工作记忆的对话在后台折叠进会话摘要
+        self.session_summarizer = SessionSummarizer(self.memory_system, self.llm_client)
+        
+        # 流水线模式下记忆更新在后台按用户顺序执行
+        self.memory_writer = get_memory_writer() if Config.PIPELINED_MEMORY_UPDATES else None
+        
+        # 进程内所有会话共用的准入控制，过载时排队、拒绝或返回降级回复
+        self.admission = get_admission_controller() if Config.ADMISSION_CONTROL else None
+        
+        # 正在进行的一轮的取消标记，以及被取消的轮次数
+        self._turn_lock = threading.Lock()
+        self._current_turn: Optional[CancelToken] = None
+        self.cancelled_turns = 0
+        self.memory_update_stats = {
+            "turns": 0,
+            "update_ms": 0.0,  # 记忆更新耗时（流水线模式下不计入响应时间）
+            "wait_ms": 0.0,    # 下一轮等待上一轮写入完成的时间
+            "saved_ms": 0.0,   # 从响应路径上省下的时间
+            "last_update_ms": 0.0,
+            "last_wait_ms": 0.0
+        }
+        
+        # 上下文token预算
+        self.context_budget = TokenBudget(
+            total=Config.CONTEXT_TOKEN_BUDGET,
+            section_limits={
+                "profile": Config.CONTEXT_BUDGET_PROFILE,
+                "techniques": Config.CONTEXT_BUDGET_TECHNIQUES,
+                "working_memory": Config.CONTEXT_BUDGET_WORKING_MEMORY,
+                "summary": Config.CONTEXT_BUDGET_SUMMARY,
+                "memories": Config.CONTEXT_BUDGET_MEMORIES
+            },
+            drop_order=["techniques", "memories", "summary", "profile", "working_memory"]
+        )
+        self.last_context_tokens: Dict[str, int] = {}
+        
+        # 上下文检索各阶段的期限（毫秒）和最近一轮的耗时
+        self.context_stage_deadlines: Dict[str, float] = {
+            stage: Config.CONTEXT_STAGE_TIMEOUT_MS for stage in ("time_reference", "episodic", "techniques", "profile")
+        }
+        self.last_context_timings: Dict[str, Dict[str, Any]] = {}
+        
+        # 提示前缀缓存统计
+        self._last_prompt = ""
+        self.last_turn_stats: Dict[str, Any] = {}
+        self.prompt_cache_stats = {
+            "turns": 0,
+            "prompt_chars": 0,
+            "shared_prefix_chars": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "prompt_eval_ms": 0.0
+        }
+        
         # Initialize user profile if it doesn't exist
         if not self.memory_system.get_user_profile():
             self.memory_system.update_semantic_memory("user_profile", {
@@ -652,7 +1228,7 @@ class AIPsychologist:
                 "personality_insights": {}
             })
     
-    def _extract_emotional_insights(self, user_message: str) -> Dict[str, Any]:
+    def _extract_emotional_insights(self, user_message: str, hits: Optional[KeywordHits] = None) -> Dict[str, Any]:
         """Extract emotional insights from user message (simplified)"""
         # In a real implementation, this would use sentiment analysis and NLP
         insights = {
@@ -662,108 +1238,157 @@ class AIPsychologist:
         }
         
         # Simple keyword-based emotion detection
-        emotions = {
-            "sadness": ["sad", "depressed", "unhappy", "down", "blue", "depression", "难过", "沮丧"],
-            "anxiety": ["anxious", "worried", "nervous", "stressed", "concerned", "panic", "焦虑", "担心"],
-            "anger": ["angry", "mad", "frustrated", "irritated", "annoyed", "rage", "愤怒", "生气"],
-            "happiness": ["happy", "joy", "pleased", "delighted", "excited", "glad", "高兴", "快乐"],
-            "loneliness": ["lonely", "alone", "isolated", "by myself", "solitude", "孤独"]
-        }
-        
-        user_message_lower = user_message.lower()
-        for emotion, keywords in emotions.items():
-            for keyword in keywords:
-                if keyword in user_message_lower:
-                    insights["emotions"].append(emotion)
-                    insights["intensity"] = max(insights["intensity"], len(keyword))
+        if hits is None:
+            hits = keyword_engine.scan(user_message)
+        for entry in hits.entries("emotion"):
+            insights["emotions"].append(entry.label)
+            insights["intensity"] = max(insights["intensity"], len(entry.keyword))
         
         return insights
     
+    # 时间段汇总时最多读取的情景记忆条数（取最近的）
+    TIME_RANGE_EPISODE_LIMIT = 50
+
     def _process_time_reference(self, user_message: str) -> Optional[str]:
-        """处理用户消息中的时间参考"""
+        """处理用户消息中的时间参考，汇总该时间段内的全部情景记忆"""
         time_ref = self.memory_system._extract_time_reference(user_message)
-        if time_ref:
-            # 检索相关情景记忆
+        if not time_ref:
+            return None
+        
+        span = self.memory_system._parse_time_span(time_ref)
+        episodes = []
+        if span:
+            episodes = self.memory_system.get_episodes_in_range(
+                span.start, span.end, limit=self.TIME_RANGE_EPISODE_LIMIT, order="desc"
+            )[::-1]
+        if not episodes:
+            # 时间段内没有记录时，退回到时间参考一致或24小时内最接近的一条
             episodic_memory = self.memory_system.get_episodic_memory_by_time(time_ref)
-            if episodic_memory:
-                # 使用统一的数据结构处理
-                try:
-                    # 获取摘要信息
-                    summary = episodic_memory.get("summary", "发生了某些事件")
-                    activity = episodic_memory.get("activity", "进行了某些活动")
-                    
-                    return f"根据我们之前在{time_ref}的对话记录：{summary}"
-                except Exception as e:
-                    # 如果出现任何错误，打印错误信息并返回默认响应
-                    print(f"处理时间参考时出错: {e}")
-                    return None
+            episodes = [episodic_memory] if episodic_memory else []
+        if not episodes:
+            return None
         
-        return None
+        try:
+            return f"根据我们之前在{time_ref}的对话记录：{self._summarize_period(episodes)}"
+        except Exception as e:
+            # 如果出现任何错误，打印错误信息并返回默认响应
+            print(f"处理时间参考时出错: {e}")
+            return None
+    
+    def _summarize_period(self, episodes: List[Dict[str, Any]]) -> str:
+        """把一个时间段内的多条情景记忆汇总成一句话，episodes按时间由早到晚排列"""
+        if len(episodes) == 1:
+            return episodes[0].get("summary", "发生了某些事件")
+        
+        activities = {}
+        emotions = {}
+        for episode in episodes:
+            activity = episode.get("activity")
+            if activity:
+                activities[activity] = activities.get(activity, 0) + 1
+            insights = episode.get("interaction", {}).get("emotional_insights", {})
+            for emotion in insights.get("emotions", []):
+                emotions[emotion] = emotions.get(emotion, 0) + 1
+        
+        parts = [f"共{len(episodes)}条记录"]
+        if activities:
+            parts.append("活动：" + "、".join(
+                f"{name}×{count}" if count > 1 else name
+                for name, count in sorted(activities.items(), key=lambda item: -item[1])
+            ))
+        if emotions:
+            parts.append("情绪：" + "、".join(
+                name for name, _ in sorted(emotions.items(), key=lambda item: -item[1])
+            ))
+        parts.append(f"最近一次：{episodes[-1].get('summary', '发生了某些事件')}")
+        return "；".join(parts)
+
+    # 固定的系统人设，放在上下文最前面，保证所有请求共享同一个前缀
+    SYSTEM_PROMPT = "你是一位AI心理学家，运用你的专业知识解决用户的心理问题，必须遵守安全原则，你是具有长期记忆的（系统会给你）。"
 
     def _build_context(self, user_message: str) -> List[Dict[str, str]]:
-        """Build context for the LLM using multi-layered memory"""
-        # Start with working memory (recent conversation)
-        context = self.memory_system.get_working_memory_context()
+        """
+        Build context for the LLM using multi-layered memory
         
-        # Add the main system prompt with current time
-        from datetime import datetime
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        main_system_prompt = f"你是一位AI心理学家，运用你的专业知识解决用户的心理问题，必须遵守安全原则，现在的时间是{current_time}，你是具有长期记忆的（系统会给你）。"
+        各部分按变化频率从低到高排列，使相邻请求共享尽可能长的前缀，
+        以便命中Ollama的上下文复用和OpenRouter的提示缓存：
+        固定人设 -> 用户档案 -> 会话摘要 -> 工作记忆 -> 治疗技术 -> 当前时间与相关记忆 -> 当前消息
+        用户档案去掉了每轮都会变化的计数和时间戳（见_stable_profile）；治疗技术按当前消息检索，放在工作记忆之后。
         
-        context.insert(0, {
-            "role": "system",
-            "content": main_system_prompt
+        各区段受token预算约束，超出全局上限时按 治疗技术 -> 相关记忆 -> 会话摘要 -> 用户档案 -> 工作记忆
+        的顺序压缩，每轮的token分布记录在last_context_tokens中。
+        """
+        # 易变信息：粗粒度的当前时间、时间参考和相关过往对话
+        current_time = datetime.now().strftime(Config.PROMPT_TIME_FORMAT)
+        time_line = f"现在的时间是{current_time}。"
+        
+        # 互不依赖的检索阶段并发执行，超过期限的阶段本轮不使用
+        stages = self._run_context_stages({
+            "time_reference": lambda: self._process_time_reference(user_message),
+            "episodic": lambda: self._relevant_memory_summary(user_message),
+            "techniques": lambda: self._technique_fragments(user_message),
+            "profile": self._profile_snapshot
         })
         
-        # 检查是否有时间参考
-        time_context = self._process_time_reference(user_message)
-        if time_context:
-            context.insert(1, {  # 插入到主系统提示之后
-                "role": "system",
-                "content": f"历史背景: {time_context}"
-            })
+        memory_parts = []
+        if stages.get("time_reference"):
+            memory_parts.append(f"历史背景: {stages['time_reference']}")
+        if stages.get("episodic"):
+            memory_parts.append(f"历史背景: {stages['episodic']}")
+        technique_fragments = stages.get("techniques") or []
+        session_summary = self.memory_system.session_summary
+        user_profile = stages.get("profile") or {}
+        
+        # 系统人设、当前时间和当前消息不参与裁剪
+        reserved = (count_tokens(self.SYSTEM_PROMPT) + count_tokens(time_line) +
+                    count_tokens(user_message) + 3 * MESSAGE_OVERHEAD)
+        sections, report = self.context_budget.fit({
+            "profile": lambda limit: self._fit_profile(user_profile, limit),
+            "techniques": lambda limit: self._fit_techniques(technique_fragments, limit),
+            "summary": lambda limit: fit_text(session_summary, limit, prefix="之前对话的摘要:\n"),
+            "working_memory": lambda limit: self.memory_system.working_memory.fit(limit),
+            "memories": lambda limit: fit_text("\n".join(memory_parts), limit)
+        }, reserved=reserved)
+        self.last_context_tokens = report
+        if Config.LOG_CONTEXT_TOKENS:
+            print(f"上下文token分布: {report}")
+        
+        context = [{
+            "role": "system",
+            "content": self.SYSTEM_PROMPT
+        }]
         
-        # Add relevant therapeutic techniques based on user message
-        relevant_techniques = procedural_memory.get_relevant_techniques(user_message)
-        if relevant_techniques:
-            technique_info = "可用的治疗技术:\n"
-            for name, technique in list(relevant_techniques.items())[:3]:  # Limit to 3 techniques
-                technique_info += procedural_memory.format_technique_for_prompt(name, technique) + "\n"
-            
-            context.insert(1, {  # 插入到主系统提示之后
+        # Add user profile information (变化缓慢，键排序保证序列化结果稳定)
+        if sections["profile"]:
+            context.append({
                 "role": "system",
-                "content": f"治疗技术参考:\n{technique_info}"
+                "content": sections["profile"]
             })
         
-        # Add relevant episodic memories
-        relevant_memories = self.memory_system.get_relevant_episodic_memories(user_message)
-        if relevant_memories:
-            memory_summary = "相关的过往对话:\n"
-            for mem in relevant_memories[-3:]:  # Last 3 memories
-                # 使用统一的数据结构处理
-                if "interaction" in mem:
-                    # 新的统一结构
-                    summary = mem.get("summary", "对话")
-                else:
-                    # 旧的结构或其他结构
-                    summary = mem.get("summary", "对话")
-                
-                memory_summary += f"- {summary}\n"
-            
-            context.insert(1, {  # 插入到主系统提示之后
+        # 会话摘要只在有对话移出工作记忆时更新
+        if sections["summary"]:
+            context.append({
                 "role": "system",
-                "content": f"历史背景: {memory_summary}"
+                "content": sections["summary"]
             })
         
-        # Add user profile information
-        user_profile = self.memory_system.get_user_profile()
-        if user_profile:
-            profile_info = f"用户档案: {json.dumps(user_profile, ensure_ascii=False)}"
-            context.insert(1, {  # 插入到主系统提示之后
+        # Working memory (recent conversation) 只在末尾追加，前缀保持不变
+        context.extend(sections["working_memory"])
+        
+        if sections["techniques"]:
+            context.append({
                 "role": "system",
-                "content": profile_info
+                "content": sections["techniques"]
             })
         
+        volatile_parts = [time_line]
+        if sections["memories"]:
+            volatile_parts.append(sections["memories"])
+        context.append({
+            "role": "system",
+            "content": "\n".join(volatile_parts)
+        })
+        
         # Add the current user message
         context.append({
             "role": "user",
@@ -772,21 +1397,241 @@ class AIPsychologist:
         
         return context
 
+    # 只读取内存中数据的检索阶段（不访问向量库、不调用编码模型），在请求线程上执行
+    INLINE_CONTEXT_STAGES = ("time_reference", "profile")
+
+    def _run_context_stages(self, stages: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        在共享线程池上并发执行各检索阶段，每个阶段在各自的期限内等待
+        
+        INLINE_CONTEXT_STAGES中的阶段只读取内存中的数据，直接在请求线程上执行，不受期限约束；
+        超时或出错的阶段结果为None（仍在后台运行的阶段结果被丢弃），
+        各阶段的耗时和状态记录在last_context_timings中。
+        """
+        start = time.perf_counter()
+        finished = {}
+        
+        def timed(name, fn):
+            def run():
+                stage_start = time.perf_counter()
+                try:
+                    return fn()
+                finally:
+                    finished[name] = (time.perf_counter() - stage_start) * 1000
+            return run
+        
+        executor = get_context_executor()
+        futures = {name: executor.submit(timed(name, fn))
+                   for name, fn in stages.items() if name not in self.INLINE_CONTEXT_STAGES}
+        results = {}
+        timings = {}
+        # 轻量阶段在请求线程上执行，与线程池中的阶段重叠，不在池中排队
+        for name, fn in stages.items():
+            if name not in self.INLINE_CONTEXT_STAGES:
+                continue
+            try:
+                results[name] = timed(name, fn)()
+                timings[name] = {"status": "ok", "ms": finished[name]}
+            except Exception as e:
+                results[name] = None
+                timings[name] = {"status": "error", "ms": finished[name]}
+                print(f"Warning: Context stage '{name}' failed: {e}")
+        for name, future in futures.items():
+            deadline = self.context_stage_deadlines.get(name, Config.CONTEXT_STAGE_TIMEOUT_MS) / 1000
+            remaining = max(0.0, deadline - (time.perf_counter() - start))
+            try:
+                results[name] = future.result(timeout=remaining)
+                timings[name] = {"status": "ok", "ms": finished.get(name, 0.0)}
+            except FutureTimeoutError:
+                results[name] = None
+                timings[name] = {"status": "timeout", "ms": (time.perf_counter() - start) * 1000}
+                print(f"Warning: Context stage '{name}' exceeded {deadline * 1000:.0f}ms, skipped for this turn")
+            except Exception as e:
+                results[name] = None
+                timings[name] = {"status": "error", "ms": finished.get(name, 0.0)}
+                print(f"Warning: Context stage '{name}' failed: {e}")
+        timings["total"] = {"status": "ok", "ms": (time.perf_counter() - start) * 1000}
+        self.last_context_timings = timings
+        return results
+    
+    def _relevant_memory_summary(self, user_message: str) -> Optional[str]:
+        """检索与当前消息相关的过往对话"""
+        relevant_memories = self.memory_system.get_relevant_episodic_memories(user_message)
+        if not relevant_memories:
+            return None
+        memory_summary = "相关的过往对话:\n"
+        for mem in relevant_memories[-3:]:  # Last 3 memories
+            memory_summary += f"- {mem.get('summary', '对话')}\n"
+        return memory_summary
+    
+    def _technique_fragments(self, user_message: str) -> List[Tuple[str, int]]:
+        """检索相关治疗技术，返回预先格式化的提示片段及其token数"""
+        # 检索和取片段使用同一个快照，期间发生的热加载不影响本轮
+        library = procedural_memory.snapshot()
+        return [library.fragments[name] for name in library.search(user_message)]
+    
+    def _profile_snapshot(self) -> Dict[str, Any]:
+        """序列化出一份用户档案快照，避免与后台写入同时修改"""
+        with self.memory_system.lock:
+            profile = json.loads(json.dumps(self.memory_system.get_user_profile(), ensure_ascii=False))
+        return self._stable_profile(profile)
+    
+    @staticmethod
+    def _stable_profile(user_profile: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        把用户档案中每轮都会变化的字段换成稳定的形式，使档案区段可以留在缓存的提示前缀中
+        
+        计数（兴趣、情绪等）改为按次数从高到低排列的名称列表，只在排名变化时改变；
+        心理历史去掉时间戳，只在末尾追加。
+        """
+        stable = {}
+        for key, value in user_profile.items():
+            if key == "psychological_history" and isinstance(value, list):
+                stable[key] = [{k: v for k, v in entry.items() if k != "timestamp"} if isinstance(entry, dict) else entry
+                               for entry in value]
+            elif isinstance(value, dict):
+                counts = {k: v for k, v in value.items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+                stable[key] = {k: v for k, v in value.items() if k not in counts}
+                if counts:
+                    stable[key]["by_frequency"] = sorted(counts, key=lambda k: (-counts[k], k))
+            else:
+                stable[key] = value
+        return stable
+    
+    def _fit_profile(self, user_profile: Dict[str, Any], max_tokens: int):
+        """裁剪用户档案：优先丢弃最旧的心理历史记录，仍超出预算时截断文本"""
+        if not user_profile:
+            return None, 0
+        
+        def render(keep: int) -> str:
+            profile = user_profile
+            history = user_profile.get("psychological_history")
+            if history and keep < len(history):
+                profile = dict(user_profile, psychological_history=history[len(history) - keep:])
+            return f"用户档案: {json.dumps(profile, ensure_ascii=False, sort_keys=True)}"
+        
+        history_length = len(user_profile.get("psychological_history") or [])
+        content = render(history_length)
+        tokens = count_tokens(content) + MESSAGE_OVERHEAD
+        if tokens <= max_tokens:
+            return content, tokens
+        
+        # token数随保留条数单调增加，二分查找能放下的最多条数
+        low, high = 0, history_length - 1
+        best = None
+        while low <= high:
+            keep = (low + high) // 2
+            candidate = render(keep)
+            candidate_tokens = count_tokens(candidate) + MESSAGE_OVERHEAD
+            if candidate_tokens <= max_tokens:
+                best = (candidate, candidate_tokens)
+                low = keep + 1
+            else:
+                high = keep - 1
+        if best:
+            return best
+        return fit_text(render(0), max_tokens)
+
+    TECHNIQUES_HEADER = "治疗技术参考:\n可用的治疗技术:\n"
+    TECHNIQUES_HEADER_TOKENS = count_tokens(TECHNIQUES_HEADER)
+
+    def _fit_techniques(self, fragments: List[Tuple[str, int]], max_tokens: int):
+        """按相关度顺序放入完整的治疗技术（使用缓存的token数），放不下的整段丢弃"""
+        if not fragments:
+            return None, 0
+        used = self.TECHNIQUES_HEADER_TOKENS + MESSAGE_OVERHEAD
+        selected = []
+        for fragment, fragment_tokens in fragments:
+            if used + fragment_tokens + 1 > max_tokens:
+                break
+            selected.append(fragment)
+            used += fragment_tokens + 1
+        if not selected:
+            # 连一个完整技术都放不下时，截断最相关的那一个
+            return fit_text(fragments[0][0], max_tokens, prefix=self.TECHNIQUES_HEADER)
+        return self.TECHNIQUES_HEADER + "".join(fragment + "\n" for fragment in selected), used
+
+    def _record_prompt_cache_stats(self, context: List[Dict[str, str]], usage: Optional[Dict[str, Any]]):
+        """记录与上一轮请求共享的提示前缀比例以及提供方返回的用量"""
+        prompt = "".join(f"<{m['role']}>{m['content']}" for m in context)
+        shared = len(os.path.commonprefix([self._last_prompt, prompt])) if self._last_prompt else 0
+        self._last_prompt = prompt
+        
+        stats = self.prompt_cache_stats
+        stats["turns"] += 1
+        stats["prompt_chars"] += len(prompt)
+        stats["shared_prefix_chars"] += shared
+        if usage:
+            if usage.get("prompt_tokens"):
+                stats["prompt_tokens"] += usage["prompt_tokens"]
+                stats["cached_tokens"] += usage.get("cached_tokens") or 0
+            if usage.get("prompt_eval_ms") is not None:
+                stats["prompt_eval_ms"] += usage["prompt_eval_ms"]
+        
+        self.last_turn_stats = {
+            "prefix_reuse": shared / len(prompt) if prompt else 0.0,
+            "context_tokens": self.last_context_tokens,
+            "usage": usage or {}
+        }
+
     def _update_memory(self, user_message: str, ai_response: str):
         """Update memory systems with the current interaction"""
+        start = time.perf_counter()
+        with self.memory_system.mutation():
+            episode_id, keyword_results = self._apply_memory_update(user_message, ai_response)
+        
+        # 关键词提取之外，排队等待后台批量LLM精炼
+        if self.memory_extractor is not None:
+            self.memory_extractor.submit(self.memory_system, episode_id, user_message, ai_response, keyword_results)
+        
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats = self.memory_update_stats
+        stats["turns"] += 1
+        stats["update_ms"] += elapsed_ms
+        stats["last_update_ms"] = elapsed_ms
+        if self.memory_writer is not None:
+            stats["saved_ms"] += elapsed_ms
+    
+    def sync_memory(self, timeout: Optional[float] = None) -> bool:
+        """等待后台记忆更新完成，之后读取的记忆包含所有已返回的对话轮次"""
+        if self.memory_writer is None:
+            return True
+        return self.memory_writer.wait(self.user_id, timeout)
+
+    def turn_timings(self) -> Dict[str, float]:
+        """
+        最近一轮各阶段的耗时（毫秒）：上下文检索各阶段（context.<阶段>），以及同步执行时的记忆更新
+        
+        降级或被取消的轮次没有阶段耗时，返回空字典。
+        """
+        if self.last_turn_stats.get("degraded") or self.last_turn_stats.get("cancelled"):
+            return {}
+        timings = {f"context.{stage}": timing["ms"] for stage, timing in self.last_context_timings.items()}
+        if self.memory_writer is None:
+            timings["memory_update"] = self.memory_update_stats["last_update_ms"]
+        return timings
+
+    def _apply_memory_update(self, user_message: str, ai_response: str):
+        """执行关键词提取并写入各层记忆，返回情景记忆id和关键词提取结果"""
         # Add to working memory
-        self.memory_system.add_working_memory({
+        evicted = self.memory_system.add_working_memory({
             "role": "user",
             "content": user_message
-        })
+        }, persist=False)
         
-        self.memory_system.add_working_memory({
+        evicted += self.memory_system.add_working_memory({
             "role": "assistant",
             "content": ai_response
-        })
+        }, persist=False)
+        # 被淘汰的消息先登记为待折叠，再保存快照，两者始终一起写入
+        self.session_summarizer.add([item.message for item in evicted])
+        self.memory_system.save_session_state()
+        
+        # 所有关键词提取共用一次扫描结果
+        hits = keyword_engine.scan(user_message)
         
         # Extract and store emotional insights
-        emotional_insights = self._extract_emotional_insights(user_message)
+        emotional_insights = self._extract_emotional_insights(user_message, hits)
         
         # 检查用户是否提到特定时间点
         time_ref = self.memory_system._extract_time_reference(user_message)
@@ -796,14 +1641,14 @@ class AIPsychologist:
                 "user_message": user_message,
                 "ai_response": ai_response,
                 "emotional_insights": emotional_insights,
-                "activity": self._extract_activity(user_message)
+                "activity": self._extract_activity(user_message, hits)
             }
             
             # 添加到基于时间的情景记忆
-            self.memory_system.add_time_based_episodic_memory(time_ref, activity_info)
+            episode_id = self.memory_system.add_time_based_episodic_memory(time_ref, activity_info)
         else:
             # 添加到普通情景记忆
-            self.memory_system.add_episodic_memory({
+            episode_id = self.memory_system.add_episodic_memory({
                 "interaction": {
                     "user_message": user_message,
                     "ai_response": ai_response,
@@ -823,64 +1668,61 @@ class AIPsychologist:
             user_profile["personality_insights"] = personality_insights
         
         # 提取并存储用户偏好信息
-        self._extract_and_store_preferences(user_message, user_profile)
+        topics = self._extract_and_store_preferences(user_message, user_profile, hits)
         
         # 提取并存储用户兴趣和关注点
-        self._extract_and_store_interests(user_message, user_profile)
+        concerns = self._extract_and_store_interests(user_message, user_profile, hits)
         
         self.memory_system.update_semantic_memory("user_profile", user_profile)
+        
+        return episode_id, {
+            "emotions": emotional_insights["emotions"],
+            "topics": topics,
+            "concerns": concerns
+        }
 
-    def _extract_and_store_preferences(self, user_message: str, user_profile: Dict[str, Any]):
-        """提取并存储用户偏好信息"""
+    def _extract_and_store_preferences(self, user_message: str, user_profile: Dict[str, Any],
+                                       hits: Optional[KeywordHits] = None) -> List[str]:
+        """提取并存储用户偏好信息，返回识别出的话题"""
         # 简单实现：基于关键词提取偏好
         preferences = user_profile.get("preferences", {})
+        if hits is None:
+            hits = keyword_engine.scan(user_message)
         
         # 通信偏好
-        if any(word in user_message.lower() for word in ["文字", "打字", "聊天"]):
-            preferences["communication_style"] = "text"
-        elif any(word in user_message.lower() for word in ["语音", "说话", "讲话"]):
-            preferences["communication_style"] = "voice"
+        communication_style = hits.first("communication_style")
+        if communication_style:
+            preferences["communication_style"] = communication_style
             
         # 时间偏好
-        if any(word in user_message.lower() for word in ["晚上", "夜间", "深夜"]):
-            preferences["preferred_time"] = "evening"
-        elif any(word in user_message.lower() for word in ["早上", "上午", "早晨"]):
-            preferences["preferred_time"] = "morning"
+        preferred_time = hits.first("preferred_time")
+        if preferred_time:
+            preferences["preferred_time"] = preferred_time
             
         # 话题偏好
-        topic_keywords = {
-            "career": ["工作", "职业", "面试", "升职", "实习"],
-            "relationships": ["朋友", "家人", "恋人", "关系", "社交"],
-            "health": ["健康", "锻炼", "运动", "身体", "睡眠"],
-            "learning": ["学习", "知识", "读书", "教育", "技能","考试"]
-        }
-        
-        user_message_lower = user_message.lower()
-        for topic, keywords in topic_keywords.items():
-            if any(keyword in user_message_lower for keyword in keywords):
-                current_count = preferences.get(f"interest_{topic}", 0)
-                preferences[f"interest_{topic}"] = current_count + 1
+        topics = hits.labels("topic")
+        for topic in topics:
+            current_count = preferences.get(f"interest_{topic}", 0)
+            preferences[f"interest_{topic}"] = current_count + 1
         
         user_profile["preferences"] = preferences
+        return topics
 
-    def _extract_and_store_interests(self, user_message: str, user_profile: Dict[str, Any]):
-        """提取并存储用户兴趣和关注点"""
+    def _extract_and_store_interests(self, user_message: str, user_profile: Dict[str, Any],
+                                     hits: Optional[KeywordHits] = None) -> List[str]:
+        """提取并存储用户兴趣和关注点，返回识别出的关注点"""
         # 这里可以实现更复杂的兴趣提取逻辑
         # 目前只是一个简单的示例
         
         psychological_history = user_profile.get("psychological_history", [])
+        if hits is None:
+            hits = keyword_engine.scan(user_message)
         
         # 基于情绪和话题的简单历史记录
-        if "压力" in user_message or "焦虑" in user_message:
-            psychological_history.append({
-                "concern": "stress_and_anxiety",
-                "timestamp": time.time(),
-                "context": user_message[:100] + "..." if len(user_message) > 100 else user_message
-            })
-        
-        if "睡眠" in user_message or "失眠" in user_message:
+        concerns = hits.labels("concern")
+        for concern in concerns:
             psychological_history.append({
-                "concern": "sleep_issues",
+                "concern": concern,
                 "timestamp": time.time(),
                 "context": user_message[:100] + "..." if len(user_message) > 100 else user_message
             })
@@ -890,44 +1732,140 @@ class AIPsychologist:
             psychological_history = psychological_history[-50:]
             
         user_profile["psychological_history"] = psychological_history
+        return concerns
 
-    def _extract_activity(self, user_message: str) -> str:
+    def _extract_activity(self, user_message: str, hits: Optional[KeywordHits] = None) -> str:
         """从用户消息中提取活动信息"""
         # 简单实现：基于关键词提取活动
-        activities = {
-            "实习": ["实习", "工作", "上班"],
-            "学习": ["学习", "复习", "上课", "考试"],
-            "旅行": ["旅行", "旅游", "游玩"],
-            "休息": ["休息", "放松", "睡觉"],
-            "运动": ["运动", "跑步", "健身"],
-            "社交": ["聚会", "朋友", "聊天"]
-        }
+        if hits is None:
+            hits = keyword_engine.scan(user_message)
+        return hits.first("activity") or "其他活动"
+
+    def chat(self, user_message: str, cancel: Optional[CancelToken] = None) -> str:
+        """
+        Process a user message and generate a response
         
-        user_message_lower = user_message.lower()
-        for activity, keywords in activities.items():
-            for keyword in keywords:
-                if keyword in user_message_lower:
-                    return activity
+        本轮被取消（cancel被取消、被同一会话的新消息取代或调用了cancel_turn()）时抛出TurnCancelled，不写入记忆。
+        只有传入cancel或开启CANCEL_SUPERSEDED_TURNS时本轮才可取消（此时以流式请求LLM，以便中途关闭连接），
+        否则使用普通的非流式请求。
+        """
+        with self._turn(cancel, cancellable=Config.CANCEL_SUPERSEDED_TURNS) as cancel, \
+                self._admitted(cancel) as admitted:
+            if not admitted:
+                return self._degraded_reply(user_message)
+            raise_if_cancelled(cancel)
+            context = self._begin_turn(user_message)
+            
+            # Get response from LLM
+            response = self.llm_client.chat_completion(context, cancel=cancel)
+            ai_response = response["choices"][0]["message"]["content"]
+            raise_if_cancelled(cancel)
+            self._finish_turn(user_message, ai_response, context, response.get("usage"))
+            return ai_response
+    
+    def chat_stream(self, user_message: str, cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        """
+        流式处理一条用户消息，逐段产出回复
         
-        return "其他活动"
-
-    def chat(self, user_message: str) -> str:
-        """Process a user message and generate a response"""
-        # Build context using multi-layered memory
-        context = self._build_context(user_message)
+        全部输出完成后才更新记忆；调用方中途停止迭代、本轮被取消或输出中途失败（StreamInterrupted）时不写入记忆。
+        """
+        with self._turn(cancel) as cancel, self._admitted(cancel) as admitted:
+            if not admitted:
+                yield self._degraded_reply(user_message)
+                return
+            cancel.raise_if_cancelled()
+            context = self._begin_turn(user_message)
+            usage: Dict[str, Any] = {}
+            parts = []
+            for delta in self.llm_client.chat_completion_stream(context, usage=usage, cancel=cancel):
+                parts.append(delta)
+                yield delta
+            cancel.raise_if_cancelled()
+            self._finish_turn(user_message, "".join(parts), context, usage)
+    
+    @contextmanager
+    def _turn(self, cancel: Optional[CancelToken] = None, cancellable: bool = True) -> Iterator[Optional[CancelToken]]:
+        """
+        登记当前轮次的取消标记（调用方未传入且cancellable时新建一个，否则本轮不可取消，产出None）
         
-        # Get response from LLM
-        response = self.llm_client.chat_completion(context)
-        ai_response = response["choices"][0]["message"]["content"]
+        CANCEL_SUPERSEDED_TURNS开启时，新的一轮开始即取消同一会话中仍在进行的上一轮。
+        """
+        if cancel is None and cancellable:
+            cancel = CancelToken()
+        with self._turn_lock:
+            previous, self._current_turn = self._current_turn, cancel
+        if previous is not None and Config.CANCEL_SUPERSEDED_TURNS:
+            previous.cancel()
+        try:
+            yield cancel
+        except TurnCancelled:
+            self.cancelled_turns += 1
+            self.last_turn_stats = {"cancelled": True}
+            raise
+        finally:
+            with self._turn_lock:
+                if self._current_turn is cancel:
+                    self._current_turn = None
+    
+    def cancel_turn(self) -> bool:
+        """取消正在进行的一轮（可在其他线程中调用），返回是否有被取消的轮次；不可取消的chat()轮次不受影响"""
+        with self._turn_lock:
+            current = self._current_turn
+        return current is not None and current.cancel()
+    
+    @contextmanager
+    def _admitted(self, cancel: Optional[CancelToken] = None) -> Iterator[bool]:
+        """在准入控制的名额内执行一轮，产出是否获准（过载时的处理见admission_slot）"""
+        with admission_slot(self.admission, self.user_id, cancel) as ok:
+            yield ok
+    
+    def _degraded_reply(self, user_message: str) -> str:
+        """过载时不调用LLM、不写入记忆，返回与API不可用时相同的模拟回复"""
+        self.last_turn_stats = {"degraded": True}
+        return mock_completion([{"role": "user", "content": user_message}])["choices"][0]["message"]["content"]
+    
+    def _begin_turn(self, user_message: str) -> List[Dict[str, str]]:
+        """等待上一轮的记忆写入并构建本轮上下文"""
+        # 先等待上一轮的后台记忆更新，保证本轮能读到；等待时间计入响应延迟
+        if self.memory_writer is not None:
+            start = time.perf_counter()
+            self.sync_memory()
+            waited_ms = (time.perf_counter() - start) * 1000
+            stats = self.memory_update_stats
+            stats["wait_ms"] += waited_ms
+            stats["saved_ms"] -= waited_ms
+            stats["last_wait_ms"] = waited_ms
         
-        # Update memory with this interaction
-        self._update_memory(user_message, ai_response)
+        # Build context using multi-layered memory
+        return self._build_context(user_message)
+    
+    def _finish_turn(self, user_message: str, ai_response: str, context: List[Dict[str, str]],
+                     usage: Optional[Dict[str, Any]]):
+        """记录本轮统计并更新记忆"""
+        self._record_prompt_cache_stats(context, usage)
+        if self.memory_writer is not None:
+            # 上一轮的记忆更新已在后台完成，扣除本轮为它等待的时间即为省下的响应延迟
+            stats = self.memory_update_stats
+            self.last_turn_stats["memory_update_saved_ms"] = max(0.0, stats["last_update_ms"] - stats["last_wait_ms"])
         
-        return ai_response
+        # Update memory with this interaction
+        if self.memory_writer is not None:
+            self.memory_writer.submit(self.user_id, self._update_memory, user_message, ai_response)
+        else:
+            self._update_memory(user_message, ai_response)
     
     def reset_memory(self):
         """Reset all memory for the user"""
+        self.sync_memory()
+        self.session_summarizer.reset()
         self.memory_system.reset_memory()
+    
+    def close(self):
+        """结束会话前等待后台任务把结果写回"""
+        self.sync_memory()
+        self.session_summarizer.flush()
+        if self.memory_extractor is not None:
+            self.memory_extractor.flush()
 
 
 # Example usage
@@ -0,0 +1,236 @@
+"""
+批量对话回放 - 把JSONL语料中的消息逐条送入系统，用于回填记忆、离线评估和负载特征分析
+
+每行一条记录：{"user_id": "...", "message": "...", "timestamp": ...}，timestamp可选
+（Unix秒数或ISO 8601字符串）。字段名默认还识别 "user"/"text"/"content"，
+以及 requests.jsonl 这类以 "request_id"/"body" 为字段的文件，也可以通过参数指定。
+
+不同用户并行处理，同一用户的消息逐条执行：记录都带时间戳时按时间戳排序，否则保持文件中的顺序。
+用户ID与聊天服务的要求相同（字母、数字、下划线和连字符，最长64个字符），
+不符合的记录作为失败写出，不会用来创建记忆目录。
+每轮完成后立即写出一行JSONL结果，结束时报告吞吐量和延迟分位数。
+回放在当前时间执行，时间戳只决定顺序并原样写入结果，不会改写记忆中的时间。
+
+用法:
+    python src/main.py --replay conversations.jsonl --output replies.jsonl [--max-concurrency 8] [--workers 4]
+"""
+
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, IO, List, Optional
+
+from config import Config
+from utils import USER_ID_PATTERN, percentile
+
+# 未指定字段名时依次尝试的字段
+USER_FIELDS = ("user_id", "user", "request_id")
+MESSAGE_FIELDS = ("message", "text", "content", "body")
+TIMESTAMP_FIELDS = ("timestamp", "time", "created_at")
+
+
+def _field(record: Dict[str, Any], name: Optional[str], candidates) -> Any:
+    if name:
+        return record.get(name)
+    for candidate in candidates:
+        if record.get(candidate) not in (None, ""):
+            return record[candidate]
+    return None
+
+
+def parse_timestamp(value: Any) -> Optional[float]:
+    """Unix秒数或ISO 8601字符串转换为Unix秒数，无法识别时返回None"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def load_records(lines, user_field: Optional[str] = None, message_field: Optional[str] = None,
+                 timestamp_field: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    读取JSONL记录并按用户分组（按用户首次出现的顺序）
+
+    缺少用户或消息的行跳过并给出警告；每个用户的记录都带时间戳时按时间戳稳定排序。
+    """
+    by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"Warning: Skipping line {line_no}, invalid JSON: {e}", file=sys.stderr)
+            continue
+        user_id = _field(record, user_field, USER_FIELDS)
+        message = _field(record, message_field, MESSAGE_FIELDS)
+        if user_id in (None, "") or not isinstance(message, str) or not message.strip():
+            print(f"Warning: Skipping line {line_no}, missing user or message", file=sys.stderr)
+            continue
+        raw_timestamp = _field(record, timestamp_field, TIMESTAMP_FIELDS)
+        timestamp = parse_timestamp(raw_timestamp)
+        if raw_timestamp is not None and timestamp is None:
+            print(f"Warning: Line {line_no} has an unrecognized timestamp: {raw_timestamp!r}", file=sys.stderr)
+        by_user.setdefault(str(user_id), []).append({
+            "line": line_no,
+            "user_id": str(user_id),
+            "message": message,
+            "timestamp": raw_timestamp,
+            "_sort": timestamp
+        })
+
+    for records in by_user.values():
+        if all(record["_sort"] is not None for record in records):
+            records.sort(key=lambda record: record["_sort"])
+    return by_user
+
+
+class BatchReplayer:
+    """
+    按用户并行回放消息
+
+    chat(user_id, message)执行一轮对话（进程内的会话缓存或分片工作进程池），
+    最多concurrency个用户同时回放，每个用户的消息在同一个线程中按顺序执行。
+    """
+
+    def __init__(self, chat: Callable[[str, str], str], concurrency: int, output: IO[str]):
+        self.chat = chat
+        self.concurrency = max(1, concurrency)
+        self.output = output
+        self._output_lock = threading.Lock()
+        self._latencies: List[float] = []
+        self.stats = {"users": 0, "turns": 0, "errors": 0}
+
+    def _write(self, result: Dict[str, Any]):
+        with self._output_lock:
+            self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.output.flush()
+            self.stats["turns"] += 1
+            if "error" in result:
+                self.stats["errors"] += 1
+            else:
+                self._latencies.append(result["latency_ms"])
+
+    def _replay_user(self, records: List[Dict[str, Any]]):
+        if not USER_ID_PATTERN.match(records[0]["user_id"]):
+            # 用户ID会成为DATA_STORAGE_PATH下的目录名，不能包含路径分隔符或 ".."
+            for record in records:
+                result = {key: record[key] for key in ("line", "user_id", "timestamp", "message")}
+                self._write({**result, "error": "Invalid user_id", "latency_ms": 0.0})
+            return
+        for record in records:
+            result = {key: record[key] for key in ("line", "user_id", "timestamp", "message")}
+            start = time.perf_counter()
+            try:
+                result["reply"] = self.chat(record["user_id"], record["message"])
+            except Exception as e:
+                # 失败的一轮记录下来，继续回放该用户的后续消息
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            self._write(result)
+
+    def run(self, by_user: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """回放全部用户，返回吞吐量和延迟统计"""
+        self.stats["users"] = len(by_user)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="replay") as executor:
+            for future in [executor.submit(self._replay_user, records) for records in by_user.values()]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        return {
+            **self.stats,
+            "concurrency": self.concurrency,
+            "seconds": round(elapsed, 3),
+            "turns_per_second": round(self.stats["turns"] / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(self._latencies, 50), 2),
+                "p95": round(percentile(self._latencies, 95), 2),
+                "p99": round(percentile(self._latencies, 99), 2),
+                "max": round(max(self._latencies), 2) if self._latencies else 0.0
+            }
+        }
+
+
+def replay(input_path: str, output: IO[str], concurrency: Optional[int] = None, workers: Optional[int] = None,
+           user_field: Optional[str] = None, message_field: Optional[str] = None,
+           timestamp_field: Optional[str] = None, session_factory=None) -> Dict[str, Any]:
+    """
+    回放input_path中的全部消息，结果逐行写入output，返回统计
+
+    workers大于0时对话轮次在分片工作进程中执行；会话在结束时写回磁盘。
+    """
+    with open(input_path, encoding="utf-8") as f:
+        by_user = load_records(f, user_field, message_field, timestamp_field)
+    concurrency = concurrency or Config.SERVER_MAX_CONCURRENCY
+    workers = Config.SERVER_WORKERS if workers is None else workers
+
+    if workers > 0:
+        from worker_pool import ShardedSessionPool
+        pool = ShardedSessionPool(workers)
+        pool.start()
+        try:
+            result = BatchReplayer(pool.chat, concurrency, output).run(by_user)
+        finally:
+            pool.close()
+    else:
+        from session_manager import SessionManager
+        if session_factory is None:
+            session_factory = _shared_client_factory()
+        manager = SessionManager(session_factory)
+
+        def chat(user_id: str, message: str) -> str:
+            session = manager.acquire(user_id)
+            try:
+                return session.chat(message)
+            finally:
+                manager.release(user_id)
+
+        try:
+            result = BatchReplayer(chat, concurrency, output).run(by_user)
+        finally:
+            manager.close()
+    result["workers"] = workers
+    return result
+
+
+def _shared_client_factory():
+    """所有会话共用一个LLM客户端（与聊天服务相同）"""
+    from ai_psychologist import AIPsychologist, LLMClient
+    lock = threading.Lock()
+    shared = []
+
+    def factory(user_id: str):
+        with lock:
+            if not shared:
+                shared.append(LLMClient())
+        return AIPsychologist(user_id, llm_client=shared[0])
+    return factory
+
+
+def run_replay(input_path: str, output_path: Optional[str] = None, concurrency: Optional[int] = None,
+               workers: Optional[int] = None, **fields) -> Dict[str, Any]:
+    """命令行入口：结果写入output_path（未指定或为 - 时写到标准输出），统计打印到标准错误"""
+    output = sys.stdout if output_path in (None, "-") else open(output_path, "w", encoding="utf-8")
+    try:
+        result = replay(input_path, output, concurrency, workers, **fields)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    latency = result["latency_ms"]
+    print(f"回放完成: {result['users']} 个用户，{result['turns']} 轮（失败 {result['errors']}），"
+          f"耗时 {result['seconds']}s，吞吐量 {result['turns_per_second']} 轮/秒", file=sys.stderr)
+    print(f"延迟: p50 {latency['p50']}ms，p95 {latency['p95']}ms，p99 {latency['p99']}ms，"
+          f"最大 {latency['max']}ms", file=sys.stderr)
+    return result
@@ -0,0 +1,71 @@
+"""
+取消模块 - 协作式取消正在进行的对话轮次
+
+同一会话在上一轮还没完成时收到新消息（或语音输入重新触发），旧的一轮已经没有意义。
+每一轮持有一个CancelToken；取消时运行登记的回调（例如关闭到模型提供方的流式连接，
+让阻塞中的读取立即返回），处理流程在各个检查点发现已取消后抛出TurnCancelled，
+不再写入记忆，并释放占用的线程、连接和准入名额。
+"""
+
+import threading
+from typing import Callable, List, Optional
+
+
+class TurnCancelled(Exception):
+    """本轮已被取消（通常是被同一用户的新消息取代）"""
+
+    def __init__(self, message: str = "Turn was superseded by a newer message"):
+        super().__init__(message)
+
+
+class CancelToken:
+    """一轮对话的取消标记，可在任意线程中取消"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> bool:
+        """取消本轮并运行登记的回调，返回是否是首次取消"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Warning: Cancel callback failed: {e}")
+        return True
+
+    def add_callback(self, callback: Callable[[], None]):
+        """登记取消时运行的回调；已经取消时立即运行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        """注销不再需要的回调（例如等待已经结束），同一个标记多次登记时回调不会越积越多"""
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TurnCancelled()
+
+
+def raise_if_cancelled(cancel: Optional[CancelToken]):
+    """cancel可以为None（不可取消的调用）"""
+    if cancel is not None:
+        cancel.raise_if_cancelled()
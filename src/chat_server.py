@@ -0,0 +1,748 @@
+#!/usr/bin/env python3
+"""
+多用户聊天服务 - 在一个进程内同时为多个用户提供对话
+
+基于asyncio实现的HTTP/1.1和WebSocket服务（只依赖标准库）。所有会话共享同一个LLM客户端、
+向量数据库连接和嵌入模型，每个用户拥有自己的记忆系统。对话在线程池中执行，
+同一用户的请求按到达顺序逐个处理，同时处理的请求总数受 SERVER_MAX_CONCURRENCY 限制。
+
+接口:
+    POST /v1/chat       {"user_id": "...", "message": "...", "stream": false}
+                        stream为true时以 text/event-stream 逐段返回回复
+    GET  /ws?user_id=   WebSocket，每条文本消息为一轮对话，回复逐段推送
+    GET  /v1/stats      会话数、请求数、延迟分位数和会话缓存命中率（?sessions=1 附带每个会话的内存估算）
+    GET  /healthz
+
+以 --workers N 启动时，对话轮次按用户哈希分配给N个工作进程执行（见worker_pool），
+本进程只负责连接、协议和同一用户轮次的排序。
+
+CANCEL_SUPERSEDED_TURNS开启时，同一用户的新消息会取消该用户正在执行和排队中的轮次，
+被取消的请求返回409（流式请求收到 cancelled 事件，WebSocket收到 {"type": "cancelled"}）。
+
+用法:
+    python src/main.py --serve --port 8765 [--workers 4]
+    curl -N -d '{"user_id": "alice", "message": "我最近很焦虑", "stream": true}' http://127.0.0.1:8765/v1/chat
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import struct
+import threading
+import time
+import urllib.parse
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from admission import AdmissionRejected, get_admission_controller
+from ai_psychologist import AIPsychologist, LLMClient
+from cancellation import CancelToken, TurnCancelled
+from config import Config
+from memory_lock import lock_stats
+from session_manager import SessionManager
+from utils import USER_ID_PATTERN, percentile
+from worker_pool import ShardedSessionPool
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_CONTINUATION, WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+STATUS_TEXT = {
+    101: "Switching Protocols", 200: "OK", 400: "Bad Request", 404: "Not Found",
+    405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable"
+}
+
+# 请求头的大小上限（字节）
+MAX_HEADER_BYTES = 16384
+# 用于计算延迟分位数的最近请求数
+LATENCY_WINDOW = 4096
+
+
+class HTTPError(Exception):
+    """返回给客户端的HTTP错误"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class WebSocketError(Exception):
+    """需要以close_code关闭WebSocket连接的协议错误"""
+
+    def __init__(self, close_code: int, message: str):
+        super().__init__(message)
+        self.close_code = close_code
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    query: Dict[str, str]
+    headers: Dict[str, str]
+    body: bytes
+    version: str
+
+
+async def read_request(reader: asyncio.StreamReader, max_body: int) -> Optional[Request]:
+    """读取一个HTTP请求，连接在请求之间关闭时返回None"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HTTPError(400, "Incomplete request")
+    except asyncio.LimitOverrunError:
+        raise HTTPError(431, "Request headers too large")
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HTTPError(400, "Malformed header")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(400, "Chunked request bodies are not supported")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length < 0:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length > max_body:
+        raise HTTPError(413, f"Request body exceeds {max_body} bytes")
+    body = await reader.readexactly(length) if length else b""
+
+    url = urllib.parse.urlsplit(target)
+    return Request(method.upper(), url.path, dict(urllib.parse.parse_qsl(url.query)), headers, body, version)
+
+
+def _response_head(status: int, headers: Dict[str, str]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Unknown')}"]
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def _unmask(payload: bytes, mask: bytes) -> bytes:
+    """按整数一次异或整个负载，比逐字节循环快得多"""
+    n = len(payload)
+    if not n:
+        return payload
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(n, "big")
+
+
+def encode_frame(opcode: int, payload: bytes) -> bytes:
+    """编码一个不分片、不加掩码的WebSocket帧（服务端发出的帧不加掩码）"""
+    n = len(payload)
+    if n < 126:
+        head = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return head + payload
+
+
+async def read_frame(reader: asyncio.StreamReader, max_bytes: int) -> Tuple[bool, int, bytes]:
+    """
+    读取一个客户端发来的WebSocket帧，返回 (是否为最后一片, 操作码, 负载)
+
+    帧超过max_bytes时抛出WebSocketError(1009)；客户端的帧必须加掩码（RFC 6455 5.1），否则抛出WebSocketError(1002)。
+    """
+    first, second = await reader.readexactly(2)
+    if not second & 0x80:
+        raise WebSocketError(1002, "Client frames must be masked")
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > max_bytes:
+        raise WebSocketError(1009, f"WebSocket message exceeds {max_bytes} bytes")
+    mask = await reader.readexactly(4)
+    payload = _unmask(await reader.readexactly(length), mask)
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+class ChatServer:
+    """
+    在一个asyncio事件循环中复用多个用户会话的聊天服务
+
+    会话由SessionManager按LRU缓存，空闲或超出容量的会话写回后移出；服务停止时统一写回。
+    workers大于0时会话不在本进程中，而是由ShardedSessionPool的工作进程持有。
+    """
+
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None,
+                 max_concurrency: Optional[int] = None, worker_threads: Optional[int] = None,
+                 llm_client: Optional[LLMClient] = None,
+                 session_factory: Optional[Callable[[str], AIPsychologist]] = None,
+                 session_manager: Optional[SessionManager] = None, workers: Optional[int] = None):
+        self.host = Config.SERVER_HOST if host is None else host
+        self.port = Config.SERVER_PORT if port is None else port
+        self.max_concurrency = max_concurrency or Config.SERVER_MAX_CONCURRENCY
+        self.max_request_bytes = Config.SERVER_MAX_REQUEST_BYTES
+        self.llm_client = llm_client
+        self._client_lock = threading.Lock()
+        self.session_manager = session_manager or SessionManager(session_factory or self._create_session)
+        self.executor = ThreadPoolExecutor(max_workers=worker_threads or Config.SERVER_WORKER_THREADS,
+                                           thread_name_prefix="chat-server")
+        self.workers = Config.SERVER_WORKERS if workers is None else workers
+        self.worker_pool = ShardedSessionPool(self.workers, self._record_timings) if self.workers > 0 else None
+
+        # 以下状态只在事件循环线程中访问
+        # 用户 -> [锁, 等待或持有该锁的请求数, 这些请求的取消标记]，没有请求时删除
+        self._user_locks: Dict[str, list] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        # 处理中的连接 -> 对应的写入端，停止服务时逐个关闭并等待处理结束
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        # 各阶段（上下文检索、记忆更新）最近的耗时，在工作线程中写入
+        self._stage_latencies: Dict[str, Deque[float]] = {}
+        self._stage_lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "streamed": 0,
+            "errors": 0,
+            "active": 0,
+            "websocket_connections": 0,
+            "rejected": 0,  # 准入控制拒绝的轮次（ADMISSION_OVERLOAD_MODE=reject）
+            "cancelled": 0,  # 被同一用户的新消息取代的轮次（CANCEL_SUPERSEDED_TURNS）
+            # 同一用户的轮次排队等待的次数和总时间
+            "user_lock_waits": 0,
+            "user_lock_wait_ms": 0.0
+        }
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- 会话 ----
+
+    def _create_session(self, user_id: str) -> AIPsychologist:
+        with self._client_lock:
+            if self.llm_client is None:
+                self.llm_client = LLMClient()
+                if Config.OLLAMA_PRELOAD:
+                    self.llm_client.warm_up()
+        return AIPsychologist(user_id, llm_client=self.llm_client)
+
+    @property
+    def sessions(self) -> Dict[str, AIPsychologist]:
+        """当前缓存中的会话（多进程模式下会话在工作进程中，这里为空）"""
+        return self.session_manager.sessions()
+
+    def _chat_turn(self, user_id: str, message: str, cancel: Optional[CancelToken] = None) -> str:
+        """在工作线程中取得会话（不在缓存中时加载）并执行一轮对话"""
+        if self.worker_pool is not None:
+            return self.worker_pool.chat(user_id, message, cancel)
+        session = self.session_manager.acquire(user_id)
+        try:
+            reply = session.chat(message, cancel=cancel)
+            self._record_timings(session.turn_timings())
+            return reply
+        finally:
+            self.session_manager.release(user_id)
+
+    def _stream_turn(self, user_id: str, message: str, cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        if self.worker_pool is not None:
+            yield from self.worker_pool.stream(user_id, message, cancel)
+            return
+        session = self.session_manager.acquire(user_id)
+        try:
+            yield from session.chat_stream(message, cancel=cancel)
+            self._record_timings(session.turn_timings())
+        finally:
+            self.session_manager.release(user_id)
+
+    def _record_timings(self, timings: Dict[str, float]):
+        """记录一轮各阶段的耗时（多进程模式下由工作进程随回复一起返回）"""
+        with self._stage_lock:
+            for stage, ms in timings.items():
+                samples = self._stage_latencies.get(stage)
+                if samples is None:
+                    samples = self._stage_latencies[stage] = deque(maxlen=LATENCY_WINDOW)
+                samples.append(ms)
+
+    @asynccontextmanager
+    async def _user_turn(self, user_id: str, cancel: CancelToken):
+        """
+        同一用户的轮次按到达顺序逐个执行
+
+        CANCEL_SUPERSEDED_TURNS开启时，新的一轮到达即取消该用户正在执行和排队中的轮次。
+        """
+        slot = self._user_locks.get(user_id)
+        if slot is None:
+            slot = self._user_locks[user_id] = [asyncio.Lock(), 0, []]
+        if Config.CANCEL_SUPERSEDED_TURNS:
+            for older in slot[2]:
+                older.cancel()
+        slot[1] += 1
+        slot[2].append(cancel)
+        try:
+            if slot[0].locked():
+                start = time.perf_counter()
+                await slot[0].acquire()
+                self.stats["user_lock_waits"] += 1
+                self.stats["user_lock_wait_ms"] += (time.perf_counter() - start) * 1000
+            else:
+                await slot[0].acquire()
+            try:
+                yield
+            finally:
+                slot[0].release()
+        finally:
+            slot[1] -= 1
+            slot[2].remove(cancel)
+            if not slot[1]:
+                del self._user_locks[user_id]
+
+    # ---- 对话 ----
+
+    async def run_turn(self, user_id: str, message: str,
+                       on_delta: Optional[Callable[[str], Awaitable[None]]] = None) -> Tuple[str, float]:
+        """
+        执行一轮对话，返回 (回复, 延迟毫秒)
+
+        同一用户的轮次串行执行；传入on_delta时流式生成，每段回复产生后立即回调。
+        被同一用户的新消息取代时抛出TurnCancelled。
+        """
+        start = time.perf_counter()
+        cancel = CancelToken()
+        async with self._user_turn(user_id, cancel):
+            cancel.raise_if_cancelled()
+            async with self._semaphore:
+                self.stats["active"] += 1
+                try:
+                    cancel.raise_if_cancelled()
+                    if on_delta is None:
+                        loop = asyncio.get_running_loop()
+                        # 非流式轮次只有在可能被取代时才需要取消标记（否则无需改用流式请求）
+                        reply = await loop.run_in_executor(self.executor, self._chat_turn, user_id, message,
+                                                           cancel if Config.CANCEL_SUPERSEDED_TURNS else None)
+                    else:
+                        parts = []
+                        deltas = self._iterate_in_thread(lambda: self._stream_turn(user_id, message, cancel), cancel)
+                        try:
+                            async for delta in deltas:
+                                parts.append(delta)
+                                await on_delta(delta)
+                        finally:
+                            # 发送失败（客户端断开）时立即取消本轮，而不是等垃圾回收关闭生成器
+                            await deltas.aclose()
+                        reply = "".join(parts)
+                finally:
+                    self.stats["active"] -= 1
+        latency_ms = (time.perf_counter() - start) * 1000
+        self.stats["requests"] += 1
+        self._latencies.append(latency_ms)
+        return reply, latency_ms
+
+    async def _iterate_in_thread(self, make_iterator: Callable[[], Iterator[str]],
+                                 cancel: Optional[CancelToken] = None) -> AsyncIterator[str]:
+        """
+        在线程池中迭代同步生成器，把产出的片段转交给事件循环
+
+        调用方提前停止（如客户端断开）时取消cancel（立即关闭到模型提供方的连接并释放名额）、
+        通知生成器停止，并等待工作线程退出后才返回，保证同一用户的下一轮不会与未结束的本轮并发执行。
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stopped = threading.Event()
+        done = object()
+
+        def produce():
+            iterator = None
+            try:
+                iterator = make_iterator()
+                for item in iterator:
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+                return
+            finally:
+                close = getattr(iterator, "close", None) if iterator is not None else None
+                if close is not None:
+                    close()
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        future = loop.run_in_executor(self.executor, produce)
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    finished = True
+                    break
+                if isinstance(item, Exception):
+                    finished = True
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            if not finished and cancel is not None:
+                cancel.cancel()
+            await asyncio.shield(future)
+
+    # ---- HTTP ----
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_request_bytes)
+                except HTTPError as e:
+                    # 请求体可能未读完，回复错误后关闭连接
+                    await self._send_json(writer, e.status, {"error": e.message}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                if request.path == "/ws":
+                    await self._handle_websocket(request, reader, writer)
+                    break
+                keep_alive = self._keep_alive(request)
+                try:
+                    await self._dispatch(request, writer, keep_alive)
+                except HTTPError as e:
+                    self.stats["errors"] += 1
+                    await self._send_json(writer, e.status, {"error": e.message}, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _keep_alive(request: Request) -> bool:
+        connection = request.headers.get("connection", "").lower()
+        if request.version.upper() == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    async def _handle_stats(self, request: Request, writer: asyncio.StreamWriter, keep_alive: bool):
+        per_session = request.query.get("sessions") == "1"
+        stats = self.get_stats(per_session=per_session)
+        if self.worker_pool is not None:
+            loop = asyncio.get_running_loop()
+            stats["worker_stats"] = await loop.run_in_executor(self.executor, self.worker_pool.worker_stats,
+                                                               per_session)
+        await self._send_json(writer, 200, stats, keep_alive)
+
+    async def _dispatch(self, request: Request, writer: asyncio.StreamWriter, keep_alive: bool):
+        routes = {
+            "/healthz": ("GET", lambda: self._send_json(writer, 200, {"status": "ok"}, keep_alive)),
+            "/v1/stats": ("GET", lambda: self._handle_stats(request, writer, keep_alive)),
+            "/v1/chat": ("POST", lambda: self._handle_chat(request, writer, keep_alive))
+        }
+        route = routes.get(request.path)
+        if route is None:
+            raise HTTPError(404, f"Unknown path: {request.path}")
+        method, handler = route
+        if request.method != method:
+            raise HTTPError(405, f"{request.path} only accepts {method}")
+        await handler()
+
+    @staticmethod
+    def _parse_turn(payload: Any, user_id: Optional[str] = None) -> Tuple[str, str]:
+        """校验一轮对话的用户ID和消息"""
+        if not isinstance(payload, dict):
+            raise HTTPError(400, "Request body must be a JSON object")
+        user_id = user_id or payload.get("user_id")
+        message = payload.get("message")
+        if not isinstance(user_id, str) or not USER_ID_PATTERN.match(user_id):
+            raise HTTPError(400, "user_id must be 1-64 characters of letters, digits, '_' or '-'")
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(400, "message must be a non-empty string")
+        return user_id, message.strip()
+
+    async def _handle_chat(self, request: Request, writer: asyncio.StreamWriter, keep_alive: bool):
+        try:
+            payload = json.loads(request.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Request body is not valid JSON")
+        user_id, message = self._parse_turn(payload)
+
+        if not payload.get("stream"):
+            try:
+                reply, latency_ms = await self.run_turn(user_id, message)
+            except AdmissionRejected as e:
+                self.stats["rejected"] += 1
+                await self._send_json(writer, 503, self._busy_payload(e), keep_alive,
+                                      {"Retry-After": str(math.ceil(e.retry_after))})
+                return
+            except TurnCancelled:
+                self.stats["cancelled"] += 1
+                await self._send_json(writer, 409, {"error": "Superseded by a newer message", "cancelled": True},
+                                      keep_alive)
+                return
+            except Exception as e:
+                print(f"Warning: Chat turn failed for {user_id}: {e}")
+                raise HTTPError(500, "Chat turn failed")
+            await self._send_json(writer, 200, {"user_id": user_id, "reply": reply,
+                                                "latency_ms": round(latency_ms, 2)}, keep_alive)
+            return
+
+        # 流式回复：Server-Sent Events，按分块传输编码逐段写出
+        writer.write(_response_head(200, {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Transfer-Encoding": "chunked",
+            "Connection": "keep-alive" if keep_alive else "close"
+        }))
+
+        async def send_event(data: Dict[str, Any], event: Optional[str] = None):
+            text = (f"event: {event}\n" if event else "") + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            chunk = text.encode("utf-8")
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+
+        self.stats["streamed"] += 1
+        try:
+            reply, latency_ms = await self.run_turn(user_id, message,
+                                                    on_delta=lambda delta: send_event({"delta": delta}))
+            await send_event({"user_id": user_id, "reply": reply, "latency_ms": round(latency_ms, 2)}, "done")
+        except ConnectionError:
+            raise
+        except AdmissionRejected as e:
+            self.stats["rejected"] += 1
+            await send_event(self._busy_payload(e), "error")
+        except TurnCancelled:
+            self.stats["cancelled"] += 1
+            await send_event({"user_id": user_id, "cancelled": True}, "cancelled")
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Warning: Streaming chat turn failed for {user_id}: {e}")
+            await send_event({"error": "Chat turn failed"}, "error")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _busy_payload(error: AdmissionRejected) -> Dict[str, Any]:
+        return {"error": "Server busy", "reason": error.reason, "retry_after": error.retry_after}
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any],
+                         keep_alive: bool = True, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(_response_head(status, {
+            "Content-Type": "application/json; charset=utf-8",
+            "Content-Length": str(len(body)),
+            "Connection": "keep-alive" if keep_alive else "close",
+            **(headers or {})
+        }) + body)
+        await writer.drain()
+
+    # ---- WebSocket ----
+
+    async def _handle_websocket(self, request: Request, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        key = request.headers.get("sec-websocket-key")
+        user_id = request.query.get("user_id", "")
+        if request.method != "GET" or "websocket" not in request.headers.get("upgrade", "").lower() or not key:
+            await self._send_json(writer, 400, {"error": "Expected a WebSocket upgrade request"}, keep_alive=False)
+            return
+        if not USER_ID_PATTERN.match(user_id):
+            await self._send_json(writer, 400, {"error": "Invalid user_id"}, keep_alive=False)
+            return
+
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        writer.write(_response_head(101, {
+            "Upgrade": "websocket",
+            "Connection": "Upgrade",
+            "Sec-WebSocket-Accept": accept
+        }))
+        await writer.drain()
+        self.stats["websocket_connections"] += 1
+
+        async def send(data: Dict[str, Any]):
+            writer.write(encode_frame(WS_TEXT, json.dumps(data, ensure_ascii=False).encode("utf-8")))
+            await writer.drain()
+
+        async def close(code: int):
+            writer.write(encode_frame(WS_CLOSE, struct.pack("!H", code)))
+            await writer.drain()
+
+        # 分片消息拼接后的总长度同样受max_request_bytes限制
+        fragments: List[bytes] = []
+        fragments_size = 0
+        while True:
+            try:
+                fin, opcode, payload = await read_frame(reader, self.max_request_bytes)
+            except WebSocketError as e:
+                await close(e.close_code)
+                return
+            if opcode == WS_CLOSE:
+                writer.write(encode_frame(WS_CLOSE, payload[:2]))
+                await writer.drain()
+                return
+            if opcode == WS_PING:
+                writer.write(encode_frame(WS_PONG, payload))
+                await writer.drain()
+                continue
+            if opcode == WS_PONG:
+                continue
+            fragments_size += len(payload)
+            if fragments_size > self.max_request_bytes:
+                await close(1009)
+                return
+            fragments.append(payload)
+            if not fin:
+                continue
+            text = b"".join(fragments).decode("utf-8", errors="replace")
+            fragments = []
+            fragments_size = 0
+
+            # 文本消息可以是纯文本，也可以是 {"message": "..."} 形式的JSON
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                data = {"message": text}
+            try:
+                _, message = self._parse_turn(data, user_id)
+            except HTTPError as e:
+                await send({"type": "error", "error": e.message})
+                continue
+
+            self.stats["streamed"] += 1
+            try:
+                reply, latency_ms = await self.run_turn(
+                    user_id, message, on_delta=lambda delta: send({"type": "delta", "content": delta}))
+            except ConnectionError:
+                raise
+            except AdmissionRejected as e:
+                self.stats["rejected"] += 1
+                await send({"type": "error", **self._busy_payload(e)})
+                continue
+            except TurnCancelled:
+                self.stats["cancelled"] += 1
+                await send({"type": "cancelled"})
+                continue
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Warning: WebSocket chat turn failed for {user_id}: {e}")
+                await send({"type": "error", "error": "Chat turn failed"})
+                continue
+            await send({"type": "done", "reply": reply, "latency_ms": round(latency_ms, 2)})
+
+    # ---- 统计与生命周期 ----
+
+    def get_stats(self, per_session: bool = False) -> Dict[str, Any]:
+        latencies = list(self._latencies)
+        with self._stage_lock:
+            stages = {stage: list(samples) for stage, samples in self._stage_latencies.items()}
+        return {
+            **self.stats,
+            "sessions": len(self.session_manager),
+            "session_cache": self.session_manager.get_stats(per_session),
+            "memory_locks": lock_stats(),
+            "admission": get_admission_controller().get_stats() if Config.ADMISSION_CONTROL else None,
+            "workers": self.worker_pool.get_stats() if self.worker_pool is not None else [],
+            "max_concurrency": self.max_concurrency,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50), 2),
+                "p99": round(percentile(latencies, 99), 2),
+                "samples": len(latencies)
+            },
+            "stages": {stage: {
+                "p50": round(percentile(samples, 50), 2),
+                "p95": round(percentile(samples, 95), 2),
+                "p99": round(percentile(samples, 99), 2),
+                "samples": len(samples)
+            } for stage, samples in stages.items()}
+        }
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        """开始监听；端口为0时使用系统分配的端口"""
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.worker_pool is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.worker_pool.start)
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"✓ 聊天服务已启动: {self.url}（并发上限 {self.max_concurrency}）")
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        """停止监听、断开连接，并把所有会话的记忆写回"""
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections.values()):
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.session_manager.close)
+        if self.worker_pool is not None:
+            await loop.run_in_executor(self.executor, self.worker_pool.close)
+
+    def start_in_thread(self) -> "ChatServer":
+        """在后台线程的事件循环中运行服务，便于测试和基准脚本使用"""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="chat-server", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self.executor.shutdown(wait=True)
+
+
+def run_server(host: Optional[str] = None, port: Optional[int] = None,
+               max_concurrency: Optional[int] = None, workers: Optional[int] = None):
+    """运行聊天服务直到按下Ctrl+C"""
+    server = ChatServer(host, port, max_concurrency, workers=workers)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("\n聊天服务已停止")
+    finally:
+        server.executor.shutdown(wait=True)
@@ -16,7 +16,7 @@ class Config:
     
     # API 配置
     OPENROUTER_API_KEY: str = os.getenv("OPENROUTER_API_KEY", "")
-    OPENROUTER_BASE_URL: str = "https://openrouter.ai/api/v1"
+    OPENROUTER_BASE_URL: str = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
     
     # 模型配置
     DEFAULT_MODEL: str = os.getenv("DEFAULT_MODEL", "openrouter/auto")
@@ -24,6 +24,11 @@ class Config:
     # Ollama 配置
     OLLAMA_BASE_URL: str = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
     OLLAMA_MODEL: str = os.getenv("OLLAMA_MODEL", "llama3.2:latest")
+    # 模型在显存中的驻留时间，支持 "30m"、"1h" 或秒数，"-1" 表示常驻
+    OLLAMA_KEEP_ALIVE: str = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+    # 启动时在后台预加载模型，避免首轮对话承担模型加载耗时
+    OLLAMA_PRELOAD: bool = os.getenv("OLLAMA_PRELOAD", "true").lower() in ("1", "true", "yes")
+    OLLAMA_WARMUP_TIMEOUT: int = int(os.getenv("OLLAMA_WARMUP_TIMEOUT", "300"))
     
     # 模型选择配置
     MODEL_PROVIDER: str = os.getenv("MODEL_PROVIDER", "openrouter")  # "openrouter" 或 "ollama"
@@ -34,10 +39,83 @@ class Config:
     
     # 内存配置
     WORKING_MEMORY_SIZE: int = int(os.getenv("WORKING_MEMORY_SIZE", "10"))
+    # 工作记忆的token上限，超出时从最旧的消息开始淘汰
+    WORKING_MEMORY_TOKENS: int = int(os.getenv("WORKING_MEMORY_TOKENS", "2000"))
+    # 移出工作记忆的对话折叠进会话摘要：每批消息数、摘要token上限、是否使用LLM（否则为抽取式摘要）
+    SESSION_SUMMARY_BATCH: int = int(os.getenv("SESSION_SUMMARY_BATCH", "4"))
+    SESSION_SUMMARY_TOKENS: int = int(os.getenv("SESSION_SUMMARY_TOKENS", "300"))
+    SESSION_SUMMARY_LLM: bool = os.getenv("SESSION_SUMMARY_LLM", "false").lower() in ("1", "true", "yes")
     EPISODIC_MEMORY_LIMIT: int = int(os.getenv("EPISODIC_MEMORY_LIMIT", "100"))
     
+    # 提示词配置
+    # 写入上下文的当前时间精度，越粗前缀缓存越容易命中
+    PROMPT_TIME_FORMAT: str = os.getenv("PROMPT_TIME_FORMAT", "%Y-%m-%d %H:00")
+    
+    # 上下文token预算：全局上限与各区段上限
+    CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+    CONTEXT_BUDGET_PROFILE: int = int(os.getenv("CONTEXT_BUDGET_PROFILE", "800"))
+    CONTEXT_BUDGET_TECHNIQUES: int = int(os.getenv("CONTEXT_BUDGET_TECHNIQUES", "900"))
+    CONTEXT_BUDGET_WORKING_MEMORY: int = int(os.getenv("CONTEXT_BUDGET_WORKING_MEMORY", "2000"))
+    CONTEXT_BUDGET_MEMORIES: int = int(os.getenv("CONTEXT_BUDGET_MEMORIES", "400"))
+    CONTEXT_BUDGET_SUMMARY: int = int(os.getenv("CONTEXT_BUDGET_SUMMARY", "300"))
+    # 每轮打印上下文各区段的token分布
+    LOG_CONTEXT_TOKENS: bool = os.getenv("LOG_CONTEXT_TOKENS", "false").lower() in ("1", "true", "yes")
+    # 上下文各检索阶段并发执行，超过期限的阶段本轮直接丢弃
+    CONTEXT_STAGE_TIMEOUT_MS: float = float(os.getenv("CONTEXT_STAGE_TIMEOUT_MS", "250"))
+    # 检索线程池大小，0表示按SERVER_MAX_CONCURRENCY的两倍分配
+    CONTEXT_STAGE_WORKERS: int = int(os.getenv("CONTEXT_STAGE_WORKERS", "0"))
+    
+    # 后台批量LLM记忆提取：攒够批量或超过间隔后一次性提交多轮对话
+    LLM_EXTRACTION_ENABLED: bool = os.getenv("LLM_EXTRACTION_ENABLED", "false").lower() in ("1", "true", "yes")
+    LLM_EXTRACTION_BATCH_SIZE: int = int(os.getenv("LLM_EXTRACTION_BATCH_SIZE", "8"))
+    LLM_EXTRACTION_FLUSH_SECONDS: float = float(os.getenv("LLM_EXTRACTION_FLUSH_SECONDS", "30"))
+    
+    # 流水线模式：回复生成后立即返回，记忆更新放入按用户保序的后台队列
+    PIPELINED_MEMORY_UPDATES: bool = os.getenv("PIPELINED_MEMORY_UPDATES", "false").lower() in ("1", "true", "yes")
+    MEMORY_WRITER_THREADS: int = int(os.getenv("MEMORY_WRITER_THREADS", "4"))
+    # 修改记忆文件时加跨进程文件锁（fcntl，Windows上只有进程内锁），以及等待其他进程释放锁的最长秒数（超时则本次修改失败）
+    MEMORY_FILE_LOCKS: bool = os.getenv("MEMORY_FILE_LOCKS", "true").lower() in ("1", "true", "yes")
+    MEMORY_LOCK_TIMEOUT: float = float(os.getenv("MEMORY_LOCK_TIMEOUT", "10"))
+    
+    # 准入控制：进程内同时进行的对话轮次上限（全局和每个用户）、等待队列长度和排队期限（秒），
+    # 过载时的处理方式：reject 拒绝并给出建议的重试间隔，degrade 返回不调用LLM的降级回复（用户无法分辨）
+    ADMISSION_CONTROL: bool = os.getenv("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+    ADMISSION_MAX_CONCURRENT: int = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+    ADMISSION_MAX_PER_USER: int = int(os.getenv("ADMISSION_MAX_PER_USER", "1"))
+    ADMISSION_MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+    ADMISSION_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+    ADMISSION_OVERLOAD_MODE: str = os.getenv("ADMISSION_OVERLOAD_MODE", "reject").lower()
+    # 同一会话收到新消息时取消仍在进行的上一轮（关闭模型请求，不写入记忆）
+    CANCEL_SUPERSEDED_TURNS: bool = os.getenv("CANCEL_SUPERSEDED_TURNS", "false").lower() in ("1", "true", "yes")
+    
+    # 关键词词典：在内置关键词表之外追加的词条（JSON，格式为 表名 -> 标签 -> 关键词列表）
+    KEYWORD_DICTIONARY_FILE: str = os.getenv("KEYWORD_DICTIONARY_FILE", "")
+    
     # 程序性记忆配置
     THERAPEUTIC_TECHNIQUES_FILE: str = os.getenv(
         "THERAPEUTIC_TECHNIQUES_FILE", 
         "./config/therapeutic_techniques.json"
-    )
\ No newline at end of file
+    )
+    # 治疗技术检索：返回的技术数量，以及是否在倒排索引之外使用句向量重新排序
+    PROCEDURAL_TOP_K: int = int(os.getenv("PROCEDURAL_TOP_K", "3"))
+    PROCEDURAL_EMBEDDINGS: bool = os.getenv("PROCEDURAL_EMBEDDINGS", "false").lower() in ("1", "true", "yes")
+    PROCEDURAL_EMBEDDING_MODEL: str = os.getenv("PROCEDURAL_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+    PROCEDURAL_EMBEDDING_WEIGHT: float = float(os.getenv("PROCEDURAL_EMBEDDING_WEIGHT", "0.5"))
+    # 治疗技术文件修改后自动重新加载，按间隔（秒）检查修改时间
+    PROCEDURAL_HOT_RELOAD: bool = os.getenv("PROCEDURAL_HOT_RELOAD", "true").lower() in ("1", "true", "yes")
+    PROCEDURAL_RELOAD_INTERVAL: float = float(os.getenv("PROCEDURAL_RELOAD_INTERVAL", "2"))
+    
+    # 多用户聊天服务（python src/main.py --serve）：监听地址、同时处理的请求数上限、
+    # 执行对话的线程数以及单个请求体的大小上限（字节）
+    SERVER_HOST: str = os.getenv("SERVER_HOST", "127.0.0.1")
+    SERVER_PORT: int = int(os.getenv("SERVER_PORT", "8765"))
+    SERVER_MAX_CONCURRENCY: int = int(os.getenv("SERVER_MAX_CONCURRENCY", "32"))
+    SERVER_WORKER_THREADS: int = int(os.getenv("SERVER_WORKER_THREADS", "16"))
+    SERVER_MAX_REQUEST_BYTES: int = int(os.getenv("SERVER_MAX_REQUEST_BYTES", "65536"))
+    # 处理对话的工作进程数（用户按哈希固定分配给一个进程），0表示在服务进程内处理
+    SERVER_WORKERS: int = int(os.getenv("SERVER_WORKERS", "0"))
+    # 活跃会话缓存：最多缓存的会话数、估算内存上限（MB），空闲多少秒后写回并移出缓存，以及检查间隔（秒）
+    SESSION_CACHE_MAX_SESSIONS: int = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "256"))
+    SESSION_CACHE_MAX_MB: float = float(os.getenv("SESSION_CACHE_MAX_MB", "256"))
+    SESSION_IDLE_TTL: float = float(os.getenv("SESSION_IDLE_TTL", "900"))
+    SESSION_REAPER_INTERVAL: float = float(os.getenv("SESSION_REAPER_INTERVAL", "30"))
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+本地模拟LLM服务 - 用于离线的负载与延迟测试
+
+同时实现OpenAI兼容的 /v1/chat/completions 接口和Ollama的 /api/chat、/api/generate 接口，
+均支持流式输出。可以配置首token延迟分布、生成速度、错误注入和并发上限，
+让OpenRouterClient和OllamaClient在没有真实API的情况下走完整的网络调用路径。
+
+用法:
+    python src/fake_llm_server.py --port 11434 --latency lognormal:-1.5,0.5 --tokens-per-second 40
+    OLLAMA_BASE_URL=http://127.0.0.1:11434 MODEL_PROVIDER=ollama python src/main.py --user-id test
+    OPENROUTER_BASE_URL=http://127.0.0.1:11434/v1 OPENROUTER_API_KEY=fake python src/main.py --user-id test
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from token_budget import count_tokens
+
+DEFAULT_REPLY = "我听到了你的话，我会陪伴你一起面对。你能告诉我更多关于你的感受吗？"
+
+
+class LatencyDistribution:
+    """
+    首token延迟分布（秒）
+
+    规格字符串格式:
+        fixed:0.2            固定延迟
+        uniform:0.1,0.5      均匀分布
+        normal:0.3,0.05      正态分布（均值, 标准差）
+        lognormal:-1.5,0.5   对数正态分布（mu, sigma）
+        exp:0.3              指数分布（均值）
+    """
+
+    KINDS = ("fixed", "uniform", "normal", "lognormal", "exp")
+
+    def __init__(self, spec: str = "fixed:0", rng: Optional[random.Random] = None):
+        kind, _, params = spec.partition(":")
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")] if params else [0.0]
+        self.rng = rng or random.Random()
+
+    def sample(self) -> float:
+        p = self.params
+        if self.kind == "fixed":
+            value = p[0]
+        elif self.kind == "uniform":
+            value = self.rng.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            value = self.rng.gauss(p[0], p[1])
+        elif self.kind == "lognormal":
+            value = self.rng.lognormvariate(p[0], p[1])
+        else:
+            value = self.rng.expovariate(1.0 / p[0]) if p[0] > 0 else 0.0
+        return max(0.0, value)
+
+
+class FakeLLMBackend:
+    """模拟推理后端：负责延迟、错误注入、并发控制和前缀缓存模拟"""
+
+    def __init__(self, latency: str = "fixed:0", tokens_per_second: float = 0.0,
+                 prompt_tokens_per_second: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500, max_concurrency: int = 0, overflow: str = "queue",
+                 load_time: float = 0.0, reply: str = DEFAULT_REPLY, seed: Optional[int] = None):
+        self.rng = random.Random(seed)
+        self.latency = LatencyDistribution(latency, self.rng)
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.overflow = overflow
+        self.load_time = load_time
+        self.reply = reply
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self._lock = threading.Lock()
+        self._loaded_models = set()
+        # 与Ollama类似，每个模型缓存上一次请求的提示，下一次请求只评估未命中的后缀
+        self._prompt_cache: Dict[str, str] = {}
+        self.metrics = {
+            "requests": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "errors_injected": 0,
+            "rejected": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0
+        }
+
+    # --- 并发控制 ---
+
+    def acquire(self) -> bool:
+        if self._slots is not None:
+            if not self._slots.acquire(blocking=self.overflow == "queue"):
+                with self._lock:
+                    self.metrics["rejected"] += 1
+                return False
+        with self._lock:
+            self.metrics["requests"] += 1
+            self.metrics["in_flight"] += 1
+            self.metrics["max_in_flight"] = max(self.metrics["max_in_flight"], self.metrics["in_flight"])
+        return True
+
+    def release(self):
+        with self._lock:
+            self.metrics["in_flight"] -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            fail = self.error_rate > 0 and self.rng.random() < self.error_rate
+            if fail:
+                self.metrics["errors_injected"] += 1
+        return fail
+
+    # --- 模拟推理 ---
+
+    def ensure_loaded(self, model: str) -> float:
+        """首次使用模型时模拟加载耗时，返回加载秒数"""
+        with self._lock:
+            if model in self._loaded_models:
+                return 0.0
+            self._loaded_models.add(model)
+        if self.load_time:
+            time.sleep(self.load_time)
+        return self.load_time
+
+    def evaluate_prompt(self, model: str, messages: List[Dict[str, str]]) -> Dict[str, int]:
+        """计算提示token数以及命中前缀缓存的token数，并模拟提示评估耗时"""
+        prompt = "".join(f"<{m.get('role', '')}>{m.get('content', '')}" for m in messages)
+        with self._lock:
+            previous = self._prompt_cache.get(model, "")
+            self._prompt_cache[model] = prompt
+        shared = os.path.commonprefix([previous, prompt])
+        prompt_tokens = count_tokens(prompt)
+        cached_tokens = count_tokens(shared)
+        evaluated = max(0, prompt_tokens - cached_tokens)
+        if self.prompt_tokens_per_second > 0:
+            time.sleep(evaluated / self.prompt_tokens_per_second)
+        with self._lock:
+            self.metrics["prompt_tokens"] += prompt_tokens
+            self.metrics["cached_tokens"] += cached_tokens
+        return {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "evaluated_tokens": evaluated}
+
+    def generate(self):
+        """按配置的首token延迟和生成速度逐个产出token"""
+        time.sleep(self.latency.sample())
+        interval = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        for i, token in enumerate(self.reply):
+            if interval and i:
+                time.sleep(interval)
+            yield token
+
+
+class FakeLLMRequestHandler(BaseHTTPRequestHandler):
+    """同时处理OpenAI兼容接口和Ollama接口的请求"""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def backend(self) -> FakeLLMBackend:
+        return self.server.backend
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- 基础工具 ---
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body) if body else {}
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def _write_chunk(self, data: str):
+        payload = data.encode("utf-8")
+        self.wfile.write(f"{len(payload):X}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    # --- 路由 ---
+
+    def do_GET(self):
+        if self.path in ("/health", "/"):
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send_json(200, dict(self.backend.metrics))
+        elif self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": name} for name in sorted(self.backend._loaded_models)]})
+        elif self.path.endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        try:
+            request = self._read_json()
+        except ValueError:
+            self._send_json(400, {"error": "invalid json"})
+            return
+
+        if self.path.endswith("/chat/completions"):
+            handler = self._handle_openai_chat
+        elif self.path == "/api/chat":
+            handler = self._handle_ollama_chat
+        elif self.path == "/api/generate":
+            handler = self._handle_ollama_generate
+        else:
+            self._send_json(404, {"error": "not found"})
+            return
+
+        if not self.backend.acquire():
+            self._send_json(429, {"error": "too many concurrent requests"})
+            return
+        try:
+            if self.backend.should_fail():
+                self._send_json(self.backend.error_status, {"error": "injected failure"})
+                return
+            handler(request)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开（例如取消了请求）
+            pass
+        finally:
+            self.backend.release()
+
+    # --- OpenAI兼容接口 ---
+
+    def _handle_openai_chat(self, request: Dict[str, Any]):
+        model = request.get("model", "fake-model")
+        usage = self.backend.evaluate_prompt(model, request.get("messages", []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        if request.get("stream"):
+            self._start_stream("text/event-stream")
+            for token in self.backend.generate():
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+                }
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            }
+            self._write_chunk(f"data: {json.dumps(final)}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self._end_stream()
+            return
+
+        content = "".join(self.backend.generate())
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": usage["prompt_tokens"],
+                "completion_tokens": count_tokens(content),
+                "total_tokens": usage["prompt_tokens"] + count_tokens(content),
+                "prompt_tokens_details": {"cached_tokens": usage["cached_tokens"]}
+            }
+        })
+
+    # --- Ollama接口 ---
+
+    def _ollama_stats(self, usage: Dict[str, int], content: str, load_seconds: float,
+                      started: float) -> Dict[str, Any]:
+        prompt_eval_ns = 0
+        if self.backend.prompt_tokens_per_second > 0:
+            prompt_eval_ns = int(usage["evaluated_tokens"] / self.backend.prompt_tokens_per_second * 1e9)
+        return {
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            "load_duration": int(load_seconds * 1e9),
+            "prompt_eval_count": usage["evaluated_tokens"],
+            "prompt_eval_duration": prompt_eval_ns,
+            "eval_count": count_tokens(content)
+        }
+
+    def _handle_ollama_chat(self, request: Dict[str, Any]):
+        started = time.perf_counter()
+        model = request.get("model", "fake-model")
+        load_seconds = self.backend.ensure_loaded(model)
+        usage = self.backend.evaluate_prompt(model, request.get("messages", []))
+        created_at = datetime.now(timezone.utc).isoformat()
+
+        # Ollama默认使用流式输出
+        if request.get("stream", True):
+            self._start_stream("application/x-ndjson")
+            content = ""
+            for token in self.backend.generate():
+                content += token
+                chunk = {
+                    "model": model,
+                    "created_at": created_at,
+                    "message": {"role": "assistant", "content": token},
+                    "done": False
+                }
+                self._write_chunk(json.dumps(chunk, ensure_ascii=False) + "\n")
+            final = {
+                "model": model,
+                "created_at": created_at,
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                **self._ollama_stats(usage, content, load_seconds, started)
+            }
+            self._write_chunk(json.dumps(final) + "\n")
+            self._end_stream()
+            return
+
+        content = "".join(self.backend.generate())
+        self._send_json(200, {
+            "model": model,
+            "created_at": created_at,
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            **self._ollama_stats(usage, content, load_seconds, started)
+        })
+
+    def _handle_ollama_generate(self, request: Dict[str, Any]):
+        started = time.perf_counter()
+        model = request.get("model", "fake-model")
+        load_seconds = self.backend.ensure_loaded(model)
+        prompt = request.get("prompt") or ""
+        created_at = datetime.now(timezone.utc).isoformat()
+
+        # 不带prompt的请求只加载模型（预热）
+        content = "".join(self.backend.generate()) if prompt else ""
+        usage = {"evaluated_tokens": count_tokens(prompt)}
+        self._send_json(200, {
+            "model": model,
+            "created_at": created_at,
+            "response": content,
+            "done": True,
+            **self._ollama_stats(usage, content, load_seconds, started)
+        })
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """可在进程内启动的模拟LLM服务，便于测试和基准脚本使用"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 backend: Optional[FakeLLMBackend] = None, verbose: bool = False):
+        super().__init__((host, port), FakeLLMRequestHandler)
+        self.backend = backend or FakeLLMBackend()
+        self.verbose = verbose
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeLLMServer":
+        """在后台线程中运行服务"""
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-llm-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI/Ollama-compatible LLM server for offline benchmarking")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", default="fixed:0",
+                        help="Time-to-first-token distribution, e.g. fixed:0.2, uniform:0.1,0.5, "
+                             "normal:0.3,0.05, lognormal:-1.5,0.5, exp:0.3")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Generation speed; 0 returns the whole reply at once")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=0.0,
+                        help="Prompt evaluation speed for uncached prompt tokens; 0 disables")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--max-concurrency", type=int, default=0, help="0 means unlimited")
+    parser.add_argument("--overflow", choices=["queue", "reject"], default="queue",
+                        help="Queue or reject (429) requests beyond --max-concurrency")
+    parser.add_argument("--load-time", type=float, default=0.0, help="Simulated model load time in seconds")
+    parser.add_argument("--reply", default=DEFAULT_REPLY)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    backend = FakeLLMBackend(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        prompt_tokens_per_second=args.prompt_tokens_per_second,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        max_concurrency=args.max_concurrency,
+        overflow=args.overflow,
+        load_time=args.load_time,
+        reply=args.reply,
+        seed=args.seed
+    )
+    server = FakeLLMServer(args.host, args.port, backend, verbose=args.verbose)
+    print(f"Fake LLM server listening on {server.url}")
+    print(f"  OpenAI-compatible: {server.url}/v1/chat/completions")
+    print(f"  Ollama:            {server.url}/api/chat")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
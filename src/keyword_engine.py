@@ -0,0 +1,206 @@
+"""
+关键词引擎 - 基于Aho-Corasick自动机的单遍多模式匹配
+
+所有提取器使用的关键词表在导入时编译成一个自动机，每条消息只扫描一次，
+得到的命中列表按关键词表顺序供情绪、偏好、兴趣、活动提取以及模拟回复使用。
+扫描耗时与消息长度成线性关系，与关键词总数无关，可支持数万条关键词。
+"""
+
+import json
+import os
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from config import Config
+
+# 关键词表: 表名 -> 标签 -> 关键词列表，标签和关键词的顺序即优先级
+KEYWORD_TABLES: Dict[str, Dict[str, List[str]]] = {
+    "emotion": {
+        "sadness": ["sad", "depressed", "unhappy", "down", "blue", "depression", "难过", "沮丧"],
+        "anxiety": ["anxious", "worried", "nervous", "stressed", "concerned", "panic", "焦虑", "担心"],
+        "anger": ["angry", "mad", "frustrated", "irritated", "annoyed", "rage", "愤怒", "生气"],
+        "happiness": ["happy", "joy", "pleased", "delighted", "excited", "glad", "高兴", "快乐"],
+        "loneliness": ["lonely", "alone", "isolated", "by myself", "solitude", "孤独"]
+    },
+    "communication_style": {
+        "text": ["文字", "打字", "聊天"],
+        "voice": ["语音", "说话", "讲话"]
+    },
+    "preferred_time": {
+        "evening": ["晚上", "夜间", "深夜"],
+        "morning": ["早上", "上午", "早晨"]
+    },
+    "topic": {
+        "career": ["工作", "职业", "面试", "升职", "实习"],
+        "relationships": ["朋友", "家人", "恋人", "关系", "社交"],
+        "health": ["健康", "锻炼", "运动", "身体", "睡眠"],
+        "learning": ["学习", "知识", "读书", "教育", "技能", "考试"]
+    },
+    "concern": {
+        "stress_and_anxiety": ["压力", "焦虑"],
+        "sleep_issues": ["睡眠", "失眠"]
+    },
+    "activity": {
+        "实习": ["实习", "工作", "上班"],
+        "学习": ["学习", "复习", "上课", "考试"],
+        "旅行": ["旅行", "旅游", "游玩"],
+        "休息": ["休息", "放松", "睡觉"],
+        "运动": ["运动", "跑步", "健身"],
+        "社交": ["聚会", "朋友", "聊天"]
+    },
+    "mock_response": {
+        "sad": ["sad"],
+        "depress": ["depress"],
+        "anxious": ["anxious"],
+        "happy": ["happy"],
+        "stress": ["stress"],
+        "angry": ["angry"],
+        "lonely": ["lonely"]
+    }
+}
+
+
+class KeywordEntry(NamedTuple):
+    """自动机中的一个关键词，order为其在所有关键词表中的全局顺序"""
+    order: int
+    table: str
+    label: str
+    keyword: str
+
+
+class KeywordHit(NamedTuple):
+    """一次命中：关键词及其在消息中的位置"""
+    entry: KeywordEntry
+    start: int
+    end: int
+
+
+class AhoCorasickAutomaton:
+    """Aho-Corasick多模式匹配自动机"""
+
+    def __init__(self, patterns: Iterable[Tuple[str, KeywordEntry]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[KeywordEntry]] = [[]]
+        self.size = 0
+        for pattern, payload in patterns:
+            self._add(pattern, payload)
+        self._build_failure_links()
+
+    def _add(self, pattern: str, payload: KeywordEntry):
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(payload)
+        self.size += 1
+
+    def _build_failure_links(self):
+        """按BFS顺序计算失败指针，并把后缀状态的输出合并到当前状态"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                if self._output[self._fail[next_state]]:
+                    self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def iter_matches(self, text: str):
+        """遍历文本一次，产出 (结束位置, 关键词条目)"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for payload in output[state]:
+                    yield index + 1, payload
+
+
+class KeywordHits:
+    """一条消息的全部命中结果，供各提取器按关键词表读取"""
+
+    def __init__(self, hits: Tuple[KeywordHit, ...]):
+        self.hits = hits
+        # 按全局顺序去重后的关键词条目，与逐表逐词扫描的结果顺序一致
+        self._entries = sorted({hit.entry for hit in hits})
+
+    def __len__(self) -> int:
+        return len(self.hits)
+
+    def entries(self, table: str) -> List[KeywordEntry]:
+        """某个关键词表中命中的关键词（去重，按表内顺序）"""
+        return [entry for entry in self._entries if entry.table == table]
+
+    def labels(self, table: str) -> List[str]:
+        """某个关键词表中命中的标签（去重，按表内顺序）"""
+        return list(dict.fromkeys(entry.label for entry in self.entries(table)))
+
+    def first(self, table: str) -> Optional[str]:
+        """某个关键词表中优先级最高的命中标签"""
+        for entry in self._entries:
+            if entry.table == table:
+                return entry.label
+        return None
+
+    def has(self, table: str, label: str) -> bool:
+        return any(entry.table == table and entry.label == label for entry in self._entries)
+
+
+class KeywordEngine:
+    """编译所有关键词表并对消息做单遍扫描"""
+
+    def __init__(self, tables: Dict[str, Dict[str, List[str]]], cache_size: int = 256):
+        self.tables = tables
+        entries = []
+        for table, labels in tables.items():
+            for label, keywords in labels.items():
+                for keyword in keywords:
+                    entries.append((keyword.lower(), KeywordEntry(len(entries), table, label, keyword.lower())))
+        self.automaton = AhoCorasickAutomaton(entries)
+        # 同一条消息会被对话路径和模拟回复各自请求一次，缓存保证只扫描一遍
+        self.scan = lru_cache(maxsize=cache_size)(self._scan)
+
+    def _scan(self, text: str) -> KeywordHits:
+        hits = tuple(
+            KeywordHit(entry, end - len(entry.keyword), end)
+            for end, entry in self.automaton.iter_matches(text.lower())
+        )
+        return KeywordHits(hits)
+
+
+def load_keyword_tables(path: str) -> Dict[str, Dict[str, List[str]]]:
+    """合并内置关键词表与外部词典文件（格式同KEYWORD_TABLES），外部词条追加在内置词条之后"""
+    tables = {table: {label: list(keywords) for label, keywords in labels.items()}
+              for table, labels in KEYWORD_TABLES.items()}
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                extra = json.load(f)
+            for table, labels in extra.items():
+                for label, keywords in labels.items():
+                    tables.setdefault(table, {}).setdefault(label, []).extend(keywords)
+        except Exception as e:
+            print(f"Warning: Could not load keyword dictionary {path}: {e}")
+    return tables
+
+
+# 全局实例，导入时编译一次
+keyword_engine = KeywordEngine(load_keyword_tables(Config.KEYWORD_DICTIONARY_FILE))
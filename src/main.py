@@ -4,12 +4,15 @@ Main entry point for the AI Psychologist application
 """
 
 import argparse
+import math
 import sys
 import traceback
 import os
 
 # 导入模块
+from admission import AdmissionRejected
 from ai_psychologist import AIPsychologist
+from config import Config
 
 def select_model_provider():
     """让用户选择模型提供商"""
@@ -32,27 +35,66 @@ def select_model_provider():
 
 def main():
     parser = argparse.ArgumentParser(description="AI Psychologist with Long-Term Memory")
-    parser.add_argument("--user-id", required=True, help="User ID for memory isolation")
+    parser.add_argument("--user-id", help="User ID for memory isolation (required unless --serve or --replay)")
     parser.add_argument("--model", choices=["openrouter", "ollama"], 
                        help="Model provider to use (openrouter or ollama)")
     parser.add_argument("--voice", action="store_true",
                        help="Enable voice input mode")
     parser.add_argument("--voice-model", type=str, default=None,
                        help="Path to Vosk voice model (e.g., models/vosk-model-small-cn-0.22)")
+    parser.add_argument("--serve", action="store_true",
+                       help="Run the multi-user HTTP/WebSocket chat server instead of the console")
+    parser.add_argument("--host", default=None, help="Server listen address (default: SERVER_HOST)")
+    parser.add_argument("--port", type=int, default=None, help="Server port (default: SERVER_PORT)")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                       help="Maximum chat turns processed at once (default: SERVER_MAX_CONCURRENCY)")
+    parser.add_argument("--workers", type=int, default=None,
+                       help="Worker processes that own users' sessions, 0 runs them in the server process "
+                            "(default: SERVER_WORKERS)")
+    parser.add_argument("--replay", metavar="JSONL",
+                       help="Replay a JSONL file of {user_id, message, timestamp} records, users in parallel")
+    parser.add_argument("--output", default="-", help="Where --replay writes one JSON result per turn (default: stdout)")
+    parser.add_argument("--user-field", default=None, help="Record field holding the user ID for --replay")
+    parser.add_argument("--message-field", default=None, help="Record field holding the message for --replay")
+    parser.add_argument("--timestamp-field", default=None,
+                       help="Record field holding the timestamp for --replay; timestamps only order each user's "
+                            "messages, turns run and are remembered at the current time")
     
     args = parser.parse_args()
+    if not args.serve and not args.replay and not args.user_id:
+        parser.error("--user-id is required unless --serve or --replay is given")
     
     # 如果通过命令行参数指定了模型，则设置环境变量
     if args.model:
         os.environ["MODEL_PROVIDER"] = args.model
         print(f"使用命令行参数指定的模型: {args.model}")
+    elif args.serve or args.replay:
+        # 服务和回放模式不交互，使用环境变量中的模型配置
+        pass
     else:
         # 否则让用户选择模型
         select_model_provider()
     
-    # 创建AI心理学家实例
+    if args.serve:
+        from chat_server import run_server
+        run_server(args.host, args.port, args.max_concurrency, args.workers)
+        return
+    
+    if args.replay:
+        from batch_replay import run_replay
+        run_replay(args.replay, args.output, args.max_concurrency, args.workers, user_field=args.user_field,
+                   message_field=args.message_field, timestamp_field=args.timestamp_field)
+        return
+    
+    # 创建AI心理学家实例（同时在后台预加载模型）
     psychologist = AIPsychologist(args.user_id)
     
+    # 模型驻留后再接受输入，避免首轮对话承担模型加载耗时
+    if not psychologist.llm_client.is_ready():
+        print("正在加载模型，请稍候...")
+        if not psychologist.llm_client.wait_until_ready(Config.OLLAMA_WARMUP_TIMEOUT):
+            print("模型加载超时，首轮回复可能较慢")
+    
     # 显示当前使用的模型信息（从环境变量获取）
     model_provider = os.environ.get("MODEL_PROVIDER", "openrouter")
     model_info = "OpenRouter" if model_provider.lower() == "openrouter" else "Ollama"
@@ -107,6 +149,8 @@ def main():
                     response = psychologist.chat(user_input)
                     print(f"\nAI Psychologist: {response}")
                     
+            except AdmissionRejected as e:
+                print(f"\n系统繁忙，请在 {math.ceil(e.retry_after)} 秒后重试。")
             except KeyboardInterrupt:
                 print("\n\nAI Psychologist: Take care! Feel free to come back anytime you need support.")
                 break
@@ -117,6 +161,7 @@ def main():
                 traceback.print_exc()
     finally:
         # Clean up resources
+        psychologist.close()
         if speech_recognizer:
             try:
                 speech_recognizer.close()
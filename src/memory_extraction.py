@@ -0,0 +1,211 @@
+"""
+批量记忆提取模块 - 在对话路径之外用LLM精炼情绪、偏好和活动信息
+
+关键词提取在对话中同步完成；本模块把已完成的对话轮次放入队列，
+由后台线程攒批后一次性发送给LLM（每个提示包含多轮对话，要求结构化JSON输出），
+再把精炼后的emotional_insights和用户档案更新写回记忆系统，不增加对话延迟。
+"""
+
+import json
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from config import Config
+
+EXTRACTION_PROMPT = """你是心理咨询记录的分析助手。下面是若干轮用户与AI心理学家的对话，每轮有一个id。
+请逐轮分析用户的情绪、话题、活动和偏好，只输出一个JSON数组，不要输出其他内容。数组中每个元素的格式为:
+{"id": "轮次id",
+ "emotions": ["sadness" | "anxiety" | "anger" | "happiness" | "loneliness" 中的若干项],
+ "intensity": 0到10的整数,
+ "topics": ["career" | "relationships" | "health" | "learning" 中的若干项],
+ "activity": "实习" | "学习" | "旅行" | "休息" | "运动" | "社交" | "其他活动",
+ "preferences": {"communication_style": "text" | "voice", "preferred_time": "morning" | "evening"},
+ "concerns": ["stress_and_anxiety" | "sleep_issues" 中的若干项]}
+无法判断的字段可以省略。"""
+
+VALID_EMOTIONS = {"sadness", "anxiety", "anger", "happiness", "loneliness"}
+VALID_TOPICS = {"career", "relationships", "health", "learning"}
+VALID_CONCERNS = {"stress_and_anxiety", "sleep_issues"}
+# 与关键词提取一致：无法归类的活动记为默认值
+DEFAULT_ACTIVITY = "其他活动"
+VALID_ACTIVITIES = {"实习", "学习", "旅行", "休息", "运动", "社交", DEFAULT_ACTIVITY}
+VALID_PREFERENCES = {
+    "communication_style": {"text", "voice"},
+    "preferred_time": {"morning", "evening"}
+}
+
+
+class _Flush:
+    """刷新请求：让后台线程立即处理当前批次并通知调用方"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class BatchedMemoryExtractor:
+    """攒批调用LLM进行记忆提取的后台任务"""
+
+    def __init__(self, llm_client, batch_size: Optional[int] = None,
+                 flush_interval: Optional[float] = None):
+        self.llm_client = llm_client
+        self.batch_size = batch_size or Config.LLM_EXTRACTION_BATCH_SIZE
+        self.flush_interval = flush_interval if flush_interval is not None else Config.LLM_EXTRACTION_FLUSH_SECONDS
+        self.stats = {"queued": 0, "batches": 0, "turns_refined": 0, "failed_batches": 0}
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="memory-extractor", daemon=True)
+        self._thread.start()
+
+    def submit(self, memory_system, episode_id: Optional[str], user_message: str, ai_response: str,
+               keyword_results: Dict[str, Any]):
+        """将一轮已完成的对话放入提取队列"""
+        if not episode_id:
+            return
+        self.stats["queued"] += 1
+        self._queue.put({
+            "memory_system": memory_system,
+            "episode_id": episode_id,
+            "user_message": user_message,
+            "ai_response": ai_response,
+            "keyword_results": keyword_results
+        })
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """立即处理队列中的所有轮次，等待写回完成"""
+        request = _Flush()
+        self._queue.put(request)
+        return request.done.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, _Flush):
+                item.done.set()
+                continue
+
+            batch = [item]
+            flush_request = None
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if isinstance(item, _Flush):
+                    flush_request = item
+                    break
+                batch.append(item)
+
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                self.stats["failed_batches"] += 1
+                print(f"Warning: Batched memory extraction failed: {e}")
+            # 队列先进先出，刷新请求之前入队的轮次都已在本批次中处理完毕
+            if flush_request is not None:
+                flush_request.done.set()
+
+    def _process_batch(self, batch: List[Dict[str, Any]]):
+        """一次LLM调用处理整批对话"""
+        turns = []
+        by_id = {}
+        for i, item in enumerate(batch):
+            turn_id = f"t{i + 1}"
+            by_id[turn_id] = item
+            turns.append({
+                "id": turn_id,
+                "user": item["user_message"],
+                "assistant": item["ai_response"][:300]
+            })
+
+        response = self.llm_client.chat_completion([
+            {"role": "system", "content": EXTRACTION_PROMPT},
+            {"role": "user", "content": json.dumps(turns, ensure_ascii=False)}
+        ])
+        results = parse_extraction_response(response["choices"][0]["message"]["content"])
+        self.stats["batches"] += 1
+        if results is None:
+            # 模型没有返回可解析的JSON（例如使用模拟回复时），保留关键词提取的结果
+            self.stats["failed_batches"] += 1
+            return
+
+        for result in results:
+            item = by_id.get(str(result.get("id")))
+            if item is None:
+                continue
+            item["memory_system"].apply_extracted_insights(
+                item["episode_id"], normalize_extraction(result), item["keyword_results"], item["user_message"]
+            )
+            self.stats["turns_refined"] += 1
+
+
+def parse_extraction_response(text: str) -> Optional[List[Dict[str, Any]]]:
+    """从模型回复中解析JSON数组，兼容代码块包裹和前后多余文字"""
+    if not text:
+        return None
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, list):
+        return None
+    return [entry for entry in data if isinstance(entry, dict)]
+
+
+def normalize_extraction(result: Dict[str, Any]) -> Dict[str, Any]:
+    """过滤模型输出中不在约定取值范围内的字段"""
+    def valid_list(key, allowed):
+        values = result.get(key) or []
+        if not isinstance(values, list):
+            return []
+        # 模型可能返回嵌套的列表或对象，先过滤掉非字符串再去重
+        return [v for v in dict.fromkeys(v for v in values if isinstance(v, str)) if v in allowed]
+
+    try:
+        intensity = max(0, min(10, int(result.get("intensity", 0))))
+    except (TypeError, ValueError):
+        intensity = 0
+
+    preferences = {}
+    raw_preferences = result.get("preferences") or {}
+    if isinstance(raw_preferences, dict):
+        for key, allowed in VALID_PREFERENCES.items():
+            value = raw_preferences.get(key)
+            if isinstance(value, str) and value in allowed:
+                preferences[key] = raw_preferences[key]
+
+    # 省略时不覆盖关键词提取的结果，约定之外的取值记为默认活动
+    activity = result.get("activity")
+    if activity in (None, ""):
+        activity = None
+    elif not isinstance(activity, str) or activity not in VALID_ACTIVITIES:
+        activity = DEFAULT_ACTIVITY
+    return {
+        "emotions": valid_list("emotions", VALID_EMOTIONS),
+        "topics": valid_list("topics", VALID_TOPICS),
+        "intensity": intensity,
+        "activity": activity,
+        "preferences": preferences,
+        "concerns": valid_list("concerns", VALID_CONCERNS)
+    }
+
+
+_extractor = None
+_extractor_lock = threading.Lock()
+
+
+def get_memory_extractor(llm_client) -> BatchedMemoryExtractor:
+    """获取进程内共享的提取任务，多个用户的对话轮次合并成批"""
+    global _extractor
+    with _extractor_lock:
+        if _extractor is None:
+            _extractor = BatchedMemoryExtractor(llm_client)
+        return _extractor
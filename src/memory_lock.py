@@ -0,0 +1,183 @@
+"""
+记忆锁模块 - 同一用户的记忆修改在进程内和进程间都互斥
+
+进程内：同一用户的所有MemorySystem实例共用一把可重入锁，不同用户互不影响。
+进程间：修改记忆时在用户目录下的锁文件上加fcntl咨询锁（flock），命令行和服务同时运行时
+也不会交错地读-改-写记忆文件。没有fcntl的平台（Windows）只使用进程内锁。
+等待文件锁超过MEMORY_LOCK_TIMEOUT时抛出MemoryLockTimeout，不会在没有文件锁的情况下写入。
+每把锁记录获取次数、发生等待的次数和等待时间，用于观察锁竞争。
+"""
+
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+from config import Config
+
+# 跨进程文件锁依赖fcntl，仅在类Unix系统上可用
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    fcntl = None
+    FCNTL_AVAILABLE = False
+
+LOCK_FILE_NAME = ".memory.lock"
+
+
+class MemoryLockTimeout(TimeoutError):
+    """其他进程持有用户的记忆文件锁超过MEMORY_LOCK_TIMEOUT秒，本次修改没有执行"""
+
+
+class UserLock:
+    """
+    单个用户的记忆锁
+
+    with lock: 只在进程内互斥（读取或修改内存中的数据）；
+    with lock.exclusive(): 同时持有跨进程文件锁（修改并保存记忆文件），最外层才加文件锁。
+    """
+
+    def __init__(self, user_id: str, user_dir: str):
+        self.user_id = user_id
+        self.lock_path = os.path.join(user_dir, LOCK_FILE_NAME)
+        self._lock = threading.RLock()
+        self._depth = 0  # exclusive()的嵌套层数，只由持锁线程修改
+        self._fd = None
+        self._file_locked = False
+        self.stats = {
+            "acquisitions": 0,
+            "contended": 0,          # 进程内需要等待的次数
+            "wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "file_acquisitions": 0,
+            "file_contended": 0,     # 文件锁被其他进程持有而需要等待的次数
+            "file_wait_ms": 0.0,
+            "file_timeouts": 0
+        }
+
+    def acquire(self):
+        if not self._lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self._lock.acquire()
+            waited_ms = (time.perf_counter() - start) * 1000
+            self.stats["contended"] += 1
+            self.stats["wait_ms"] += waited_ms
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], waited_ms)
+        self.stats["acquisitions"] += 1
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self) -> "UserLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[bool]:
+        """进程内互斥并持有跨进程文件锁，产出是否为最外层"""
+        self.acquire()
+        try:
+            outermost = self._depth == 0
+            if outermost:
+                self._lock_file()
+            self._depth += 1
+            try:
+                yield outermost
+            finally:
+                self._depth -= 1
+                if outermost:
+                    self._unlock_file()
+        finally:
+            self.release()
+
+    def _lock_file(self):
+        if not FCNTL_AVAILABLE or not Config.MEMORY_FILE_LOCKS:
+            return
+        try:
+            if self._fd is None:
+                self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                # 锁文件描述符在整个UserLock生命周期内保持打开（每次加锁只调用flock），
+                # UserLock被回收时由finalize关闭；关闭描述符也会释放仍持有的flock
+                weakref.finalize(self, os.close, self._fd)
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                acquired = self._wait_for_file()
+            else:
+                acquired = True
+        except OSError as e:
+            # 无法打开锁文件或文件系统不支持flock：退回到只有进程内锁
+            print(f"Warning: Could not lock memory files for {self.user_id}: {e}")
+            return
+        if not acquired:
+            self.stats["file_timeouts"] += 1
+            raise MemoryLockTimeout(f"Timed out after {Config.MEMORY_LOCK_TIMEOUT}s waiting for the memory "
+                                    f"file lock of {self.user_id}")
+        self._file_locked = True
+        self.stats["file_acquisitions"] += 1
+
+    def _wait_for_file(self) -> bool:
+        """其他进程持有文件锁时退避重试，返回是否在MEMORY_LOCK_TIMEOUT内取得"""
+        start = time.perf_counter()
+        deadline = time.monotonic() + Config.MEMORY_LOCK_TIMEOUT
+        delay = 0.001
+        self.stats["file_contended"] += 1
+        try:
+            while True:
+                time.sleep(delay)
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return True
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        return False
+                    delay = min(delay * 2, 0.05)
+        finally:
+            self.stats["file_wait_ms"] += (time.perf_counter() - start) * 1000
+
+    def _unlock_file(self):
+        if self._file_locked:
+            self._file_locked = False
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+# 用户目录 -> 锁；没有MemorySystem引用时自动回收
+_user_locks: "weakref.WeakValueDictionary[str, UserLock]" = weakref.WeakValueDictionary()
+_user_locks_lock = threading.Lock()
+
+
+def get_user_lock(user_id: str, user_dir: str) -> UserLock:
+    """获取用户的记忆锁，同一用户目录在进程内共用一把锁"""
+    key = os.path.abspath(user_dir)
+    with _user_locks_lock:
+        lock = _user_locks.get(key)
+        if lock is None:
+            lock = UserLock(user_id, user_dir)
+            _user_locks[key] = lock
+        return lock
+
+
+def lock_stats(top: int = 5) -> Dict[str, Any]:
+    """汇总进程内所有记忆锁的竞争情况，并列出等待时间最长的用户"""
+    with _user_locks_lock:
+        locks = list(_user_locks.values())
+    totals: Dict[str, Any] = {"users": len(locks), "file_locks": FCNTL_AVAILABLE and Config.MEMORY_FILE_LOCKS}
+    for lock in locks:
+        for name, value in lock.stats.items():
+            if name == "max_wait_ms":
+                totals[name] = max(totals.get(name, 0.0), value)
+            else:
+                totals[name] = totals.get(name, 0) + value
+    busiest = sorted(locks, key=lambda lock: lock.stats["wait_ms"] + lock.stats["file_wait_ms"], reverse=True)
+    totals["most_contended"] = [
+        {"user_id": lock.user_id, "contended": lock.stats["contended"] + lock.stats["file_contended"],
+         "wait_ms": round(lock.stats["wait_ms"] + lock.stats["file_wait_ms"], 2)}
+        for lock in busiest[:top] if lock.stats["contended"] or lock.stats["file_contended"]
+    ]
+    return totals
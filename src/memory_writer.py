@@ -0,0 +1,88 @@
+"""
+后台记忆写入模块 - 把每轮对话后的记忆更新移出响应路径
+
+写入任务按用户分组：同一用户的任务严格按提交顺序串行执行，不同用户的任务由线程池并行处理。
+对话在构建下一轮上下文之前调用wait()等待该用户的写入全部完成，从而保证读到自己上一轮的写入。
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from config import Config
+
+
+class MemoryUpdateQueue:
+    """按用户保序的后台写入队列"""
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or Config.MEMORY_WRITER_THREADS,
+                                            thread_name_prefix="memory-writer")
+        self._lock = threading.Lock()
+        # 有未完成任务的用户 -> 尚未开始执行的任务
+        self._pending: Dict[str, Deque[Tuple[Callable[..., Any], tuple]]] = {}
+        self._idle: Dict[str, threading.Event] = {}
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "update_ms": 0.0, "wait_ms": 0.0}
+
+    def submit(self, key: str, fn: Callable[..., Any], *args):
+        """提交一个写入任务，同一key的任务按提交顺序执行"""
+        with self._lock:
+            self.stats["submitted"] += 1
+            jobs = self._pending.get(key)
+            if jobs is not None:
+                jobs.append((fn, args))
+                return
+            self._pending[key] = deque([(fn, args)])
+            self._idle.setdefault(key, threading.Event()).clear()
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str):
+        """依次执行某个key的全部任务，队列为空时标记为空闲"""
+        while True:
+            with self._lock:
+                jobs = self._pending[key]
+                if not jobs:
+                    del self._pending[key]
+                    self._idle[key].set()
+                    return
+                fn, args = jobs.popleft()
+
+            start = time.perf_counter()
+            try:
+                fn(*args)
+                self.stats["completed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Warning: Background memory update failed: {e}")
+            self.stats["update_ms"] += (time.perf_counter() - start) * 1000
+
+    def pending(self, key: str) -> bool:
+        """该key是否还有未完成的写入"""
+        with self._lock:
+            return key in self._pending
+
+    def wait(self, key: str, timeout: Optional[float] = None) -> bool:
+        """等待该key之前提交的写入全部完成，超时返回False"""
+        with self._lock:
+            if key not in self._pending:
+                return True
+            event = self._idle[key]
+        start = time.perf_counter()
+        done = event.wait(timeout)
+        self.stats["wait_ms"] += (time.perf_counter() - start) * 1000
+        return done
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_memory_writer() -> MemoryUpdateQueue:
+    """获取进程内共享的写入队列，所有用户共用同一个线程池"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = MemoryUpdateQueue()
+        return _writer
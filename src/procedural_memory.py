@@ -1,75 +1,350 @@
 """
 程序性记忆模块 - 管理预设的治疗技术和案例
+
+首次使用时加载治疗技术并预先构建检索索引：中文按相邻两字、其他文字按单词切分的倒排索引（BM25打分），
+可选地再为每个技术计算句向量。检索时只访问消息中出现的词项的倒排表，
+耗时与技术库大小基本无关，可支持数千个技术和案例。
 """
 
+import heapq
 import json
+import math
 import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
 from config import Config
+from token_budget import count_tokens
 
-class ProceduralMemory:
-    """管理预设的治疗技术和案例库"""
+# 句向量为可选功能，依赖sentence-transformers和numpy
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    EMBEDDINGS_AVAILABLE = True
+except ImportError:
+    EMBEDDINGS_AVAILABLE = False
+    np = None
+    SentenceTransformer = None
+
+# 句向量模型按名称缓存，热加载重建索引时复用已加载的模型
+_encoders: Dict[str, Any] = {}
+_encoders_lock = threading.Lock()
+
+
+def _get_encoder(model_name: str):
+    with _encoders_lock:
+        encoder = _encoders.get(model_name)
+        if encoder is None:
+            encoder = _encoders[model_name] = SentenceTransformer(model_name)
+        return encoder
+
+
+# 各字段在打分时的权重
+FIELD_WEIGHTS = {"name": 3.0, "keywords": 3.0, "description": 2.0, "steps": 1.0, "examples": 0.5}
+
+_TOKEN_PATTERN = re.compile(r"[㐀-䶿一-鿿]+|[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """中文连续片段切成相邻两字（单字片段保留单字），其他文字按单词切分"""
+    terms = []
+    for run in _TOKEN_PATTERN.findall(text.lower()):
+        if run.isascii():
+            terms.append(run)
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def _technique_fields(name: str, technique: Dict[str, Any]) -> Dict[str, str]:
+    examples = technique.get("examples", [])
+    return {
+        "name": name,
+        "keywords": " ".join(technique.get("keywords", [])),
+        "description": technique.get("description", ""),
+        "steps": " ".join(technique.get("steps", [])),
+        "examples": " ".join(example.get("scenario", "") for example in examples if isinstance(example, dict))
+    }
+
+
+class TechniqueIndex:
+    """治疗技术的倒排索引（BM25）及可选的句向量索引"""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, techniques: Dict[str, Dict[str, Any]], use_embeddings: bool = False):
+        start = time.perf_counter()
+        self.names = list(techniques)
+        # 词项 -> [(技术序号, 加权词频)]
+        self.postings: Dict[str, List[Tuple[int, float]]] = {}
+        self.idf: Dict[str, float] = {}
+        self.embeddings = None
+        self._encoder = None
+
+        lengths = []
+        for doc_id, name in enumerate(self.names):
+            frequencies: Dict[str, float] = {}
+            length = 0.0
+            for field, text in _technique_fields(name, techniques[name]).items():
+                weight = FIELD_WEIGHTS[field]
+                for term in tokenize(text):
+                    frequencies[term] = frequencies.get(term, 0.0) + weight
+                    length += weight
+            lengths.append(length)
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, []).append((doc_id, frequency))
+
+        count = len(self.names)
+        average_length = sum(lengths) / count if count else 0.0
+        self._length_norm = [
+            self.K1 * (1 - self.B + self.B * length / average_length) if average_length else self.K1
+            for length in lengths
+        ]
+        for term, postings in self.postings.items():
+            df = len(postings)
+            self.idf[term] = math.log(1 + (count - df + 0.5) / (df + 0.5))
+
+        if use_embeddings and count:
+            self._build_embeddings(techniques)
+
+        self.stats = {
+            "techniques": count,
+            "terms": len(self.postings),
+            "embeddings": self.embeddings is not None,
+            "build_ms": (time.perf_counter() - start) * 1000
+        }
+
+    def _build_embeddings(self, techniques: Dict[str, Dict[str, Any]]):
+        """为每个技术计算归一化的句向量，失败时只使用倒排索引"""
+        if not EMBEDDINGS_AVAILABLE:
+            print("⚠️  sentence-transformers未安装，治疗技术检索只使用关键词索引")
+            return
+        try:
+            self._encoder = _get_encoder(Config.PROCEDURAL_EMBEDDING_MODEL)
+            documents = [f"{name} {techniques[name].get('description', '')}" for name in self.names]
+            self.embeddings = np.asarray(self._encoder.encode(documents, normalize_embeddings=True))
+        except Exception as e:
+            print(f"⚠️  治疗技术句向量构建失败，只使用关键词索引: {e}")
+            self._encoder = None
+            self.embeddings = None
+
+    def lexical_scores(self, text: str) -> Dict[int, float]:
+        """BM25打分，只累加消息中出现的词项"""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(text)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for doc_id, frequency in postings:
+                score = idf * frequency * (self.K1 + 1) / (frequency + self._length_norm[doc_id])
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        return scores
+
+    def search(self, text: str, top_k: int) -> List[Tuple[str, float]]:
+        """返回得分最高的top_k个技术名称及得分"""
+        scores = self.lexical_scores(text)
+        if self.embeddings is not None and scores:
+            # 句向量相似度作为加权项，只对有词项命中的技术重新排序
+            maximum = max(scores.values())
+            query = np.asarray(self._encoder.encode([text], normalize_embeddings=True))[0]
+            similarities = self.embeddings @ query
+            weight = Config.PROCEDURAL_EMBEDDING_WEIGHT
+            scores = {doc_id: (1 - weight) * score / maximum + weight * float(similarities[doc_id])
+                      for doc_id, score in scores.items()}
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [(self.names[doc_id], score) for doc_id, score in best]
+
+
+def _render_technique(name, technique) -> str:
+    """将治疗技术格式化为提示词格式"""
+    lines = [f"治疗技术: {name}", f"描述: {technique.get('description', '')}", "步骤:"]
+    lines.extend(f"  {i}. {step}" for i, step in enumerate(technique.get('steps', []), 1))
+    lines.append("应用示例:")
+    for example in technique.get('examples', [])[:2]:  # 限制示例数量
+        lines.append(f"  场景: {example.get('scenario', '')}")
+        lines.append(f"  回应: {example.get('response', '')}")
+    return "\n".join(lines) + "\n"
+
+
+class TechniqueLibrary:
+    """
+    一次加载得到的治疗技术快照：技术、检索索引和预先格式化的提示片段
     
-    def __init__(self):
-        """初始化程序性记忆"""
-        self.techniques = {}
-        self.load_therapeutic_techniques()
+    快照创建后不再修改，重新加载时整体替换，正在处理的请求继续使用手里的旧快照。
+    """
+
+    def __init__(self, techniques: Dict[str, Dict[str, Any]], mtime: Optional[float] = None):
+        self.techniques = techniques
+        self.mtime = mtime
+        self.index = TechniqueIndex(techniques, use_embeddings=Config.PROCEDURAL_EMBEDDINGS)
+        # 技术名称 -> (格式化后的提示片段, token数)
+        self.fragments: Dict[str, Tuple[str, int]] = {}
+        for name, technique in techniques.items():
+            fragment = _render_technique(name, technique)
+            self.fragments[name] = (fragment, count_tokens(fragment))
+
+    def search(self, text: str, top_k: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+        """最相关的治疗技术，按相关度从高到低排列"""
+        top_k = top_k or Config.PROCEDURAL_TOP_K
+        return {name: self.techniques[name] for name, _ in self.index.search(text, top_k)}
+
+
+class ProceduralMemory:
+    """
+    管理预设的治疗技术和案例库
     
-    def load_therapeutic_techniques(self):
-        """加载预设的治疗技术"""
+    首次使用时才读取配置文件；开启热加载后，按间隔检查文件修改时间，
+    文件变化时在后台线程中构建新快照并原子替换（请求在此期间继续使用旧快照，不等待重建），
+    解析失败或格式不对时保留旧快照。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """初始化程序性记忆（不读取文件）"""
+        self.path = path
+        self._library: Optional[TechniqueLibrary] = None
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._reload_thread: Optional[threading.Thread] = None
+        # 上次热加载失败的文件版本，文件再次修改之前不重复尝试
+        self._failed_mtime: Optional[float] = None
+        self.reloads = 0
+
+    @property
+    def techniques_file(self) -> str:
+        return self.path or Config.THERAPEUTIC_TECHNIQUES_FILE
+
+    def snapshot(self) -> TechniqueLibrary:
+        """获取当前的技术库快照，需要时加载或热加载"""
+        library = self._library
+        if library is None:
+            with self._lock:
+                if self._library is None:
+                    self._library = self._load(initial=True)
+                return self._library
+        if Config.PROCEDURAL_HOT_RELOAD and time.monotonic() >= self._next_check:
+            self._reload_if_changed()
+        return library
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.techniques_file).st_mtime_ns / 1e9
+        except OSError:
+            return None
+
+    def _reload_if_changed(self):
+        # 只有一个线程负责检查；重建索引（以及计算句向量）可能远超上下文阶段的期限，放到后台线程中执行
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = time.monotonic() + Config.PROCEDURAL_RELOAD_INTERVAL
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return
+            mtime = self._file_mtime()
+            if mtime is None or mtime == self._library.mtime or mtime == self._failed_mtime:
+                return
+            self._reload_thread = threading.Thread(target=self._reload, args=(mtime,),
+                                                   name="procedural-reload", daemon=True)
+            self._reload_thread.start()
+        finally:
+            self._lock.release()
+
+    def _reload(self, mtime: float):
+        library = self._load(initial=False)
+        with self._lock:
+            if library is None:
+                self._failed_mtime = mtime
+            else:
+                self._library = library
+                self.reloads += 1
+
+    def wait_for_reload(self, timeout: Optional[float] = None) -> bool:
+        """等待正在进行的后台热加载结束，返回是否已结束"""
+        thread = self._reload_thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    def _load(self, initial: bool) -> Optional[TechniqueLibrary]:
+        """读取配置文件构建快照；热加载失败时返回None以保留旧快照"""
+        path = self.techniques_file
+        mtime = self._file_mtime()
+        techniques = {}
         try:
             # 确保配置文件存在
-            if os.path.exists(Config.THERAPEUTIC_TECHNIQUES_FILE):
-                with open(Config.THERAPEUTIC_TECHNIQUES_FILE, 'r', encoding='utf-8') as f:
-                    self.techniques = json.load(f)
-                print(f"✓ 成功加载 {len(self.techniques)} 个治疗技术")
+            if mtime is not None:
+                with open(path, 'r', encoding='utf-8') as f:
+                    techniques = json.load(f)
+                # 顶层必须是 技术名称 -> 技术 的对象
+                if not isinstance(techniques, dict):
+                    raise ValueError(f"expected a JSON object of techniques, got {type(techniques).__name__}")
+                invalid = [name for name, technique in techniques.items() if not isinstance(technique, dict)]
+                if invalid:
+                    raise ValueError(f"techniques must be JSON objects: {invalid[:5]}")
             else:
-                print(f"! 未找到治疗技术配置文件: {Config.THERAPEUTIC_TECHNIQUES_FILE}")
-                self.techniques = {}
+                print(f"! 未找到治疗技术配置文件: {path}")
+            library = TechniqueLibrary(techniques, mtime)
         except Exception as e:
             print(f"✗ 加载治疗技术时出错: {e}")
-            self.techniques = {}
-    
+            if not initial:
+                return None
+            techniques = {}
+            library = TechniqueLibrary(techniques, mtime)
+
+        if techniques:
+            action = "成功加载" if initial else "重新加载"
+            print(f"✓ {action} {len(techniques)} 个治疗技术"
+                  f"（索引 {library.index.stats['terms']} 个词项，构建耗时 {library.index.stats['build_ms']:.1f}ms）")
+        return library
+
+    def load_therapeutic_techniques(self):
+        """立即（重新）加载预设的治疗技术"""
+        with self._lock:
+            library = self._load(initial=self._library is None)
+            if library is not None:
+                self._library = library
+
+    @property
+    def techniques(self) -> Dict[str, Dict[str, Any]]:
+        return self.snapshot().techniques
+
+    @property
+    def index(self) -> TechniqueIndex:
+        return self.snapshot().index
+
+    @property
+    def fragments(self) -> Dict[str, Tuple[str, int]]:
+        return self.snapshot().fragments
+
     def get_all_techniques(self):
         """获取所有治疗技术"""
-        return self.techniques
-    
+        return self.snapshot().techniques
+
     def get_technique(self, name):
         """根据名称获取特定治疗技术"""
-        return self.techniques.get(name)
-    
-    def get_relevant_techniques(self, keywords):
-        """根据关键词获取相关治疗技术"""
-        relevant = {}
-        keywords = keywords.lower()
-        
-        for name, technique in self.techniques.items():
-            # 检查技术名称和描述是否包含关键词
-            if (keywords in name.lower() or 
-                keywords in technique.get('description', '').lower()):
-                relevant[name] = technique
-            
-            # 检查步骤中是否包含关键词
-            for step in technique.get('steps', []):
-                if keywords in step.lower():
-                    relevant[name] = technique
-                    break
-        
-        return relevant
-    
+        return self.snapshot().techniques.get(name)
+
+    def get_relevant_techniques(self, keywords, top_k: Optional[int] = None):
+        """根据关键词或整条消息获取最相关的治疗技术，按相关度从高到低排列"""
+        return self.snapshot().search(keywords, top_k)
+
+    def get_technique_fragment(self, name) -> Optional[Tuple[str, int]]:
+        """获取预先格式化的提示片段及其token数"""
+        return self.snapshot().fragments.get(name)
+
     def format_technique_for_prompt(self, name, technique):
-        """将治疗技术格式化为提示词格式"""
-        formatted = f"治疗技术: {name}\n"
-        formatted += f"描述: {technique.get('description', '')}\n"
-        formatted += "步骤:\n"
-        for i, step in enumerate(technique.get('steps', []), 1):
-            formatted += f"  {i}. {step}\n"
-        
-        formatted += "应用示例:\n"
-        for example in technique.get('examples', [])[:2]:  # 限制示例数量
-            formatted += f"  场景: {example.get('scenario', '')}\n"
-            formatted += f"  回应: {example.get('response', '')}\n"
-        
-        return formatted
-
-# 全局实例
-procedural_memory = ProceduralMemory()
\ No newline at end of file
+        """将治疗技术格式化为提示词格式，库中的技术直接返回缓存的片段"""
+        library = self.snapshot()
+        cached = library.fragments.get(name)
+        if cached is not None and library.techniques.get(name) is technique:
+            return cached[0]
+        return _render_technique(name, technique)
+
+# 全局实例，首次使用时才加载
+procedural_memory = ProceduralMemory()
@@ -0,0 +1,286 @@
+"""
+会话管理模块 - 在进程内缓存活跃用户的AIPsychologist实例
+
+创建会话需要建目录、初始化向量库集合并加载记忆文件，每个请求重复一次代价太高。
+会话按最近使用顺序（LRU）缓存，同时受会话数和估算内存字节数限制；超过空闲时间的会话
+由后台线程定期清理。被淘汰的会话在后台把记忆写回磁盘，写回完成前同一用户不会重新加载，
+以免读到旧文件。正在处理请求的会话不会被淘汰。
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from config import Config
+
+# 会话大小的估算需要遍历全部记忆数据，每归还这么多次才重新估算一次（加载后的第一次归还总会估算）
+SIZE_REFRESH_TURNS = 8
+
+# 只展开这些内置容器，其他对象只计算自身大小，避免统计到共享的客户端和线程池
+_CONTAINERS = (dict, list, tuple, set, frozenset, deque)
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """估算对象及其包含的内置容器、字符串、数字占用的字节数"""
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, _CONTAINERS):
+            stack.extend(item)
+    return total
+
+
+def session_footprint(session) -> int:
+    """估算一个会话持有的记忆数据的字节数（共享的模型、向量库和技术库不计入）"""
+    memory = session.memory_system
+    seen: set = set()
+    with memory.lock:
+        parts = [
+            memory.semantic_memory,
+            memory.episodic_memory,
+            memory.session_summary,
+            memory.summary_pending,
+            list(memory.working_memory.items()),
+            memory._time_index,
+            memory._episodes_by_id,
+            memory._ids_by_time_reference,
+        ]
+        total = sum(deep_sizeof(part, seen) for part in parts)
+    return total + deep_sizeof(getattr(session, "_last_prompt", ""), seen)
+
+
+class _Entry:
+    __slots__ = ("session", "bytes", "last_used", "in_use", "releases")
+
+    def __init__(self, session, size: int):
+        self.session = session
+        self.bytes = size
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.releases = 0
+
+
+class SessionManager:
+    """
+    按用户缓存会话的LRU，受会话数、内存字节数和空闲时间限制
+
+    acquire()取得会话并标记为使用中，处理完后调用release()；
+    release时（定期）重新估算会话大小，超出限制时从最久未使用的空闲会话开始淘汰。
+    """
+
+    def __init__(self, factory: Optional[Callable[[str], Any]] = None,
+                 max_sessions: Optional[int] = None, max_bytes: Optional[int] = None,
+                 idle_ttl: Optional[float] = None, reap_interval: Optional[float] = None):
+        self.factory = factory or self._default_factory
+        self.max_sessions = max_sessions or Config.SESSION_CACHE_MAX_SESSIONS
+        self.max_bytes = max_bytes or Config.SESSION_CACHE_MAX_MB * 1024 * 1024
+        self.idle_ttl = Config.SESSION_IDLE_TTL if idle_ttl is None else idle_ttl
+        self.reap_interval = reap_interval or Config.SESSION_REAPER_INTERVAL
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.total_bytes = 0
+        # 正在创建的会话（避免同一用户并发创建两次）和正在写回的会话
+        self._loading: Dict[str, threading.Event] = {}
+        self._flushing: Dict[str, threading.Event] = {}
+        self._flush_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-flush")
+        self.stats = {"hits": 0, "misses": 0, "evicted_capacity": 0, "evicted_bytes": 0,
+                      "evicted_idle": 0, "load_ms": 0.0, "flush_ms": 0.0}
+
+        self._stop = threading.Event()
+        self._reaper = None
+        if self.idle_ttl > 0:
+            self._reaper = threading.Thread(target=self._reap_loop, name="session-reaper", daemon=True)
+            self._reaper.start()
+
+    @staticmethod
+    def _default_factory(user_id: str):
+        from ai_psychologist import AIPsychologist
+        return AIPsychologist(user_id)
+
+    # ---- 取用与归还 ----
+
+    def acquire(self, user_id: str):
+        """取得用户的会话并标记为使用中，不在缓存中时加载（同一用户只加载一次）"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    self._entries.move_to_end(user_id)
+                    entry.in_use += 1
+                    entry.last_used = time.monotonic()
+                    self.stats["hits"] += 1
+                    return entry.session
+                pending = self._loading.get(user_id) or self._flushing.get(user_id)
+                if pending is None:
+                    loading = self._loading[user_id] = threading.Event()
+                    self.stats["misses"] += 1
+                    break
+            # 等待其他线程加载完成，或等待被淘汰的旧会话写回完成
+            pending.wait()
+
+        start = time.perf_counter()
+        try:
+            session = self.factory(user_id)
+            size = session_footprint(session)
+        except BaseException:
+            with self._lock:
+                del self._loading[user_id]
+            loading.set()
+            raise
+
+        with self._lock:
+            self.stats["load_ms"] += (time.perf_counter() - start) * 1000
+            entry = _Entry(session, size)
+            entry.in_use = 1
+            self._entries[user_id] = entry
+            self.total_bytes += size
+            del self._loading[user_id]
+            evicted = self._evict_over_limits()
+        loading.set()
+        self._flush(evicted)
+        return session
+
+    def release(self, user_id: str):
+        """归还会话：更新大小估算和最近使用时间，必要时淘汰其他会话"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        size = session_footprint(entry.session) if entry.releases % SIZE_REFRESH_TURNS == 0 else entry.bytes
+        with self._lock:
+            if self._entries.get(user_id) is not entry:
+                return
+            entry.in_use = max(0, entry.in_use - 1)
+            entry.last_used = time.monotonic()
+            entry.releases += 1
+            self.total_bytes += size - entry.bytes
+            entry.bytes = size
+            evicted = self._evict_over_limits()
+        self._flush(evicted)
+
+    def peek(self, user_id: str):
+        """查看缓存中的会话，不影响LRU顺序和命中统计"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry.session if entry is not None else None
+
+    def sessions(self) -> Dict[str, Any]:
+        with self._lock:
+            return {user_id: entry.session for user_id, entry in self._entries.items()}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._entries
+
+    # ---- 淘汰与写回 ----
+
+    def _evict_over_limits(self) -> List[tuple]:
+        """在持锁状态下从最久未使用的一端淘汰空闲会话，直到满足会话数和字节数限制"""
+        evicted = []
+        for user_id in list(self._entries):
+            over_count = len(self._entries) > self.max_sessions
+            over_bytes = self.total_bytes > self.max_bytes
+            if not over_count and not over_bytes:
+                break
+            if self._entries[user_id].in_use:
+                continue
+            evicted.append(self._remove(user_id, "evicted_capacity" if over_count else "evicted_bytes"))
+        return evicted
+
+    def _remove(self, user_id: str, reason: Optional[str] = None) -> tuple:
+        entry = self._entries.pop(user_id)
+        self.total_bytes -= entry.bytes
+        if reason is not None:
+            self.stats[reason] += 1
+        self._flushing[user_id] = threading.Event()
+        return user_id, entry.session
+
+    def _flush(self, evicted: List[tuple]):
+        for user_id, session in evicted:
+            self._flush_executor.submit(self._close_session, user_id, session)
+
+    def _close_session(self, user_id: str, session):
+        start = time.perf_counter()
+        try:
+            session.close()
+        except Exception as e:
+            print(f"Warning: Failed to flush session for {user_id}: {e}")
+        finally:
+            with self._lock:
+                self.stats["flush_ms"] += (time.perf_counter() - start) * 1000
+                done = self._flushing.pop(user_id)
+            done.set()
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """淘汰空闲超过idle_ttl秒的会话，返回淘汰数量"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [user_id for user_id, entry in self._entries.items()
+                     if not entry.in_use and now - entry.last_used >= self.idle_ttl]
+            evicted = [self._remove(user_id, "evicted_idle") for user_id in idle]
+        self._flush(evicted)
+        return len(evicted)
+
+    def _reap_loop(self):
+        while not self._stop.wait(self.reap_interval):
+            self.evict_idle()
+
+    def flush_pending(self, timeout: Optional[float] = None) -> bool:
+        """等待所有被淘汰的会话写回完成"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                pending = list(self._flushing.values())
+            if not pending:
+                return True
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not pending[0].wait(remaining):
+                return False
+
+    def close(self):
+        """停止清理线程，写回并移除所有会话"""
+        self._stop.set()
+        if self._reaper is not None:
+            self._reaper.join()
+        with self._lock:
+            evicted = [self._remove(user_id) for user_id in list(self._entries)]
+        self._flush(evicted)
+        self._flush_executor.shutdown(wait=True)
+
+    # ---- 统计 ----
+
+    def get_stats(self, per_session: bool = False) -> Dict[str, Any]:
+        """命中率、淘汰次数和内存估算；per_session为True时附带每个会话的大小和空闲时间"""
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            result = {
+                **self.stats,
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+                "sessions": len(self._entries),
+                "max_sessions": self.max_sessions,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes
+            }
+            if per_session:
+                now = time.monotonic()
+                result["per_session"] = {
+                    user_id: {"bytes": entry.bytes, "idle_seconds": round(now - entry.last_used, 1),
+                              "in_use": entry.in_use}
+                    for user_id, entry in self._entries.items()
+                }
+        return result
@@ -0,0 +1,149 @@
+"""
+会话滚动摘要模块 - 把移出工作记忆的对话轮次折叠进一段持续更新的会话摘要
+
+工作记忆按条数和token数淘汰旧消息，被淘汰的消息先攒批，再在后台按用户顺序折叠进摘要；
+待折叠的消息和摘要一起写入session_state.json，进程中断后恢复会话时继续折叠，不会丢失。
+开启LLM摘要时一次调用合并整批消息（要求JSON输出），调用失败或输出无法解析时
+退化为抽取式摘要（每条用户消息取第一句）。摘要始终限制在固定token数以内，
+因此无论会话多长，提示中的历史部分大小保持不变。
+"""
+
+import json
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from memory_writer import get_memory_writer
+from token_budget import count_tokens, tokenizer_name, truncate_to_tokens
+
+SUMMARY_PROMPT = """你负责维护一段心理咨询会话的滚动摘要。输入是一个JSON对象，summary为已有摘要，turns为之后新增的对话。
+请把新增对话中的重要信息（用户的处境、情绪、关心的问题、已经讨论过的建议）合并进摘要，删去重复和次要内容，
+摘要不超过{max_chars}个字。只输出一个JSON对象：{{"summary": "更新后的摘要"}}，不要输出其他内容。"""
+
+_SENTENCE_END = re.compile(r"[。！？!?；;\n]|\.(?:\s|$)")
+
+
+def first_sentence(text: str, max_chars: int = 40) -> str:
+    """取文本的第一句，超过max_chars时截断"""
+    text = text.strip()
+    match = _SENTENCE_END.search(text)
+    sentence = text[:match.start()] if match else text
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars] + "…"
+
+
+def extractive_summary(summary: str, messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """抽取式摘要：每条用户消息取第一句追加为一行，超出预算时丢弃最旧的行"""
+    lines = [line for line in summary.split("\n") if line] if summary else []
+    for message in messages:
+        if message.get("role") == "user" and message.get("content", "").strip():
+            lines.append(f"- 用户提到：{first_sentence(message['content'])}")
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return truncate_to_tokens("\n".join(lines), max_tokens)
+
+
+def parse_summary_response(text: str) -> Optional[str]:
+    """从模型回复中解析 {"summary": ...}，兼容代码块包裹和前后多余文字"""
+    if not text:
+        return None
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    summary = data.get("summary") if isinstance(data, dict) else None
+    return summary.strip() if isinstance(summary, str) and summary.strip() else None
+
+
+def summary_char_limit(max_tokens: int) -> int:
+    """把摘要的token上限换算成提示中给模型的字数：cl100k下一个汉字约1.5个token，估算模式下每字一个token"""
+    return max_tokens if tokenizer_name() == "estimate" else max_tokens * 2 // 3
+
+
+class SessionSummarizer:
+    """
+    把淘汰的工作记忆增量折叠进会话摘要，折叠在后台写入队列中按用户顺序执行
+
+    待折叠的消息保存在memory_system.summary_pending中，随会话状态一起持久化，
+    一批折叠完成后才与更新后的摘要一起从中移除。
+    """
+
+    def __init__(self, memory_system, llm_client=None, use_llm: Optional[bool] = None,
+                 batch_size: Optional[int] = None, max_tokens: Optional[int] = None):
+        self.memory_system = memory_system
+        self.llm_client = llm_client
+        self.use_llm = Config.SESSION_SUMMARY_LLM if use_llm is None else use_llm
+        self.batch_size = batch_size or Config.SESSION_SUMMARY_BATCH
+        self.max_tokens = max_tokens or Config.SESSION_SUMMARY_TOKENS
+        self.writer = get_memory_writer()
+        self.key = f"{memory_system.user_id}:session-summary"
+        self.stats = {"folded_messages": 0, "llm_batches": 0, "extractive_batches": 0}
+        # summary_pending中已提交后台折叠的消息条数
+        self._submitted = 0
+        self._lock = threading.Lock()
+
+    def add(self, messages: List[Dict[str, str]]):
+        """登记被淘汰的消息，攒够一批后提交后台折叠"""
+        if not messages:
+            return
+        with self._lock:
+            pending = self.memory_system.summary_pending
+            pending.extend(messages)
+            if len(pending) - self._submitted < self.batch_size:
+                return
+            batch = self._take_batch()
+        self.writer.submit(self.key, self._fold, batch)
+
+    def _take_batch(self) -> List[Dict[str, str]]:
+        """取出尚未提交的待折叠消息（调用方持有self._lock）"""
+        batch = self.memory_system.summary_pending[self._submitted:]
+        self._submitted += len(batch)
+        return batch
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """折叠所有待处理的消息并等待完成"""
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self.writer.submit(self.key, self._fold, batch)
+        return self.writer.wait(self.key, timeout)
+
+    def reset(self):
+        """等待进行中的折叠结束，然后丢弃待处理的消息"""
+        self.writer.wait(self.key)
+        with self._lock:
+            self.memory_system.summary_pending = []
+            self._submitted = 0
+
+    def _fold(self, batch: List[Dict[str, str]]):
+        summary = self.memory_system.session_summary
+        updated = self._llm_fold(summary, batch) if self.use_llm and self.llm_client is not None else None
+        if updated is None:
+            updated = extractive_summary(summary, batch, self.max_tokens)
+            self.stats["extractive_batches"] += 1
+        else:
+            self.stats["llm_batches"] += 1
+        with self._lock:
+            self.memory_system.session_summary = updated
+            del self.memory_system.summary_pending[:len(batch)]
+            self._submitted -= len(batch)
+        self.memory_system.save_session_state()
+        self.stats["folded_messages"] += len(batch)
+
+    def _llm_fold(self, summary: str, batch: List[Dict[str, str]]) -> Optional[str]:
+        """一次LLM调用把整批消息合并进摘要，失败时返回None"""
+        turns = [{"role": m.get("role"), "content": m.get("content", "")[:500]} for m in batch]
+        try:
+            response = self.llm_client.chat_completion([
+                {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=summary_char_limit(self.max_tokens))},
+                {"role": "user", "content": json.dumps({"summary": summary, "turns": turns}, ensure_ascii=False)}
+            ])
+            updated = parse_summary_response(response["choices"][0]["message"]["content"])
+        except Exception as e:
+            print(f"Warning: Session summary LLM call failed, using extractive summary: {e}")
+            return None
+        return truncate_to_tokens(updated, self.max_tokens) if updated else None
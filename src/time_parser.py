@@ -0,0 +1,159 @@
+"""
+中文时间表达式解析模块
+
+所有时间表达式编译为一个正则交替式，对消息只扫描一次；
+解析结果为带起止时间戳的时间段（结束时间不包含在内），并按 (表达式, 参考日期) 缓存。
+支持相对时间（昨天、上周、下个月、明年……）、绝对日期（2025年7月1日、2025-07-01、7/1/2025、7月1日、2025年7月）
+以及节假日（暑假、寒假、春节、国庆、元旦，可带年份或“今年/去年/明年”前缀）。
+"""
+
+import re
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+HOLIDAYS = "暑假|寒假|春节|国庆|元旦"
+
+# 同一位置上更长、更具体的写法排在前面
+TIME_EXPRESSION_PATTERN = re.compile(
+    # 先用首字符集合快速跳过不可能开始匹配的位置
+    r"(?=[\d上这本下大前昨今明后去暑寒春国元])(?:"
+    r"(?P<ymd>(?P<ymd_y>\d{4})年(?P<ymd_m>\d{1,2})月(?P<ymd_d>\d{1,2})[日号])"
+    r"|(?P<iso>(?P<iso_y>\d{4})-(?P<iso_m>\d{1,2})-(?P<iso_d>\d{1,2}))"
+    r"|(?P<us>(?P<us_m>\d{1,2})/(?P<us_d>\d{1,2})/(?P<us_y>\d{4}))"
+    r"|(?P<year_holiday>(?P<yh_y>\d{4})年(?P<yh_h>" + HOLIDAYS + r"))"
+    r"|(?P<ym>(?P<ym_y>\d{4})年(?P<ym_m>\d{1,2})月)"
+    r"|(?P<md>(?P<md_m>\d{1,2})月(?P<md_d>\d{1,2})[日号])"
+    r"|(?P<rel_holiday>(?P<rh_y>今年|去年|明年|前年)(?P<rh_h>" + HOLIDAYS + r"))"
+    # “然后/最后/之后/以后/先后”紧跟“天”、以及“后天性”“后天形成”中的“后天”不是时间表达式
+    r"|(?P<rel_day>大前天|前天|昨天|今天|明天|(?<![然最之以先])后天(?!性|形成|天天))"
+    r"|(?P<rel_week>上个?星期|上周|这个?星期|这周|本周|下个?星期|下周)"
+    r"|(?P<rel_month>上个月|这个月|本月|下个月)"
+    r"|(?P<rel_year>前年|去年|今年|明年)"
+    r"|(?P<holiday>" + HOLIDAYS + r"))"
+)
+
+DAY_OFFSETS = {"大前天": -3, "前天": -2, "昨天": -1, "今天": 0, "明天": 1, "后天": 2}
+YEAR_OFFSETS = {"前年": -2, "去年": -1, "今年": 0, "明年": 1}
+MONTH_OFFSETS = {"上个月": -1, "这个月": 0, "本月": 0, "下个月": 1}
+
+# 春节（正月初一）公历日期，表外年份退化为一月下旬至二月下旬的范围
+SPRING_FESTIVAL = {
+    2015: (2, 19), 2016: (2, 8), 2017: (1, 28), 2018: (2, 16), 2019: (2, 5),
+    2020: (1, 25), 2021: (2, 12), 2022: (2, 1), 2023: (1, 22), 2024: (2, 10),
+    2025: (1, 29), 2026: (2, 17), 2027: (2, 6), 2028: (1, 26), 2029: (2, 13),
+    2030: (2, 3), 2031: (1, 23), 2032: (2, 11), 2033: (1, 31), 2034: (2, 19),
+    2035: (2, 8),
+}
+
+
+class TimeSpan(NamedTuple):
+    """时间表达式对应的时间段，end不包含在内"""
+    expression: str
+    kind: str  # "relative" / "absolute" / "holiday"
+    start: float
+    end: float
+
+    @property
+    def start_datetime(self) -> datetime:
+        return datetime.fromtimestamp(self.start)
+
+    @property
+    def end_datetime(self) -> datetime:
+        return datetime.fromtimestamp(self.end)
+
+
+def _ts(day: date) -> float:
+    return datetime(day.year, day.month, day.day).timestamp()
+
+
+def _add_months(day: date, months: int) -> date:
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _holiday_range(holiday: str, year: int):
+    if holiday == "暑假":
+        return date(year, 7, 1), date(year, 9, 1)
+    if holiday == "寒假":
+        return date(year, 1, 1), date(year, 3, 1)
+    if holiday == "国庆":
+        return date(year, 10, 1), date(year, 10, 8)
+    if holiday == "元旦":
+        return date(year, 1, 1), date(year, 1, 2)
+    # 春节：除夕到正月初七
+    if year in SPRING_FESTIVAL:
+        new_year = date(year, *SPRING_FESTIVAL[year])
+        return new_year - timedelta(days=1), new_year + timedelta(days=7)
+    return date(year, 1, 21), date(year, 2, 21)
+
+
+def _span_from_match(match: "re.Match", reference: date) -> Optional[TimeSpan]:
+    """把一个匹配转换为时间段，日期不合法时返回None"""
+    kind = match.lastgroup
+    expression = match.group(0)
+    g = match.group
+    try:
+        if kind in ("ymd", "iso", "us", "md"):
+            prefix = {"ymd": "ymd", "iso": "iso", "us": "us", "md": "md"}[kind]
+            year = int(g(f"{prefix}_y")) if kind != "md" else reference.year
+            day = date(year, int(g(f"{prefix}_m")), int(g(f"{prefix}_d")))
+            return TimeSpan(expression, "absolute", _ts(day), _ts(day + timedelta(days=1)))
+        if kind == "ym":
+            first = date(int(g("ym_y")), int(g("ym_m")), 1)
+            return TimeSpan(expression, "absolute", _ts(first), _ts(_add_months(first, 1)))
+        if kind in ("year_holiday", "rel_holiday", "holiday"):
+            if kind == "year_holiday":
+                year, holiday = int(g("yh_y")), g("yh_h")
+            elif kind == "rel_holiday":
+                year, holiday = reference.year + YEAR_OFFSETS[g("rh_y")], g("rh_h")
+            else:
+                year, holiday = reference.year, expression
+            start, end = _holiday_range(holiday, year)
+            return TimeSpan(expression, "holiday", _ts(start), _ts(end))
+        if kind == "rel_day":
+            day = reference + timedelta(days=DAY_OFFSETS[expression])
+            return TimeSpan(expression, "relative", _ts(day), _ts(day + timedelta(days=1)))
+        if kind == "rel_week":
+            offset = -1 if expression[0] == "上" else 1 if expression[0] == "下" else 0
+            monday = reference - timedelta(days=reference.weekday()) + timedelta(weeks=offset)
+            return TimeSpan(expression, "relative", _ts(monday), _ts(monday + timedelta(days=7)))
+        if kind == "rel_month":
+            first = _add_months(reference.replace(day=1), MONTH_OFFSETS[expression])
+            return TimeSpan(expression, "relative", _ts(first), _ts(_add_months(first, 1)))
+        if kind == "rel_year":
+            year = reference.year + YEAR_OFFSETS[expression]
+            return TimeSpan(expression, "relative", _ts(date(year, 1, 1)), _ts(date(year + 1, 1, 1)))
+    except ValueError:
+        return None
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _parse_cached(expression: str, reference: date) -> Optional[TimeSpan]:
+    match = TIME_EXPRESSION_PATTERN.fullmatch(expression)
+    return _span_from_match(match, reference) if match else None
+
+
+def parse_time_expression(expression: str, reference: Optional[date] = None) -> Optional[TimeSpan]:
+    """解析单个时间表达式，结果按 (表达式, 参考日期) 缓存"""
+    if not expression:
+        return None
+    return _parse_cached(expression, reference or date.today())
+
+
+def extract_time_expression(text: str) -> Optional[str]:
+    """返回消息中最靠前的时间表达式"""
+    match = TIME_EXPRESSION_PATTERN.search(text)
+    return match.group(0) if match else None
+
+
+def extract_time_spans(text: str, reference: Optional[date] = None) -> List[TimeSpan]:
+    """解析消息中的全部时间表达式"""
+    reference = reference or date.today()
+    spans = []
+    for match in TIME_EXPRESSION_PATTERN.finditer(text):
+        span = _parse_cached(match.group(0), reference)
+        if span is not None:
+            spans.append(span)
+    return spans
@@ -0,0 +1,165 @@
+"""
+Token预算模块 - 统计提示词token数并按区段裁剪上下文
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# tiktoken可用时使用真实的分词器，否则退化为按字符估算
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+    tiktoken = None
+
+# 每条消息的角色标记等格式开销
+MESSAGE_OVERHEAD = 4
+
+TRUNCATION_MARK = "…"
+
+_encoding = None
+
+
+def _get_encoding():
+    """延迟加载分词器，加载失败时退化为估算"""
+    global _encoding, TIKTOKEN_AVAILABLE
+    if _encoding is None and TIKTOKEN_AVAILABLE:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"Warning: Could not load tokenizer, falling back to estimation: {e}")
+            TIKTOKEN_AVAILABLE = False
+    return _encoding
+
+
+def tokenizer_name() -> str:
+    """当前使用的计数方式，缓存的token数只在计数方式相同时可以复用"""
+    return "cl100k_base" if _get_encoding() is not None else "estimate"
+
+
+def _is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or
+            0x3000 <= code <= 0x303F or 0xFF00 <= code <= 0xFFEF)
+
+
+def _estimate_tokens(text: str) -> int:
+    """估算token数：中日韩字符按每字一个token，其余字符按每4个一个token"""
+    cjk = sum(1 for char in text if _is_cjk(char))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    """统计文本的token数"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return _estimate_tokens(text)
+
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    """统计单条消息的token数（含格式开销）"""
+    return count_tokens(message.get("content", "")) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """将文本截断到不超过max_tokens个token，截断处添加省略标记"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        return encoding.decode(tokens[:max(0, max_tokens - 1)]) + TRUNCATION_MARK
+
+    # 估算模式下逐字累加，与_estimate_tokens的计算方式保持一致
+    limit = max_tokens - 1
+    cjk = 0
+    other = 0
+    for i, char in enumerate(text):
+        if _is_cjk(char):
+            cjk += 1
+        else:
+            other += 1
+        if cjk + (other + 3) // 4 > limit:
+            return text[:i] + TRUNCATION_MARK
+    return text
+
+
+# 区段裁剪函数：给定token上限，返回裁剪后的内容和实际占用的token数
+SectionFitter = Callable[[int], Tuple[Any, int]]
+
+
+class TokenBudget:
+    """
+    按区段分配token预算
+
+    每个区段先按自身预算裁剪；如果总量仍超过全局上限，
+    则按drop_order（价值从低到高）依次压缩区段，直到满足上限。
+    """
+
+    def __init__(self, total: int, section_limits: Dict[str, int], drop_order: List[str]):
+        self.total = total
+        self.section_limits = section_limits
+        self.drop_order = drop_order
+
+    def fit(self, fitters: Dict[str, SectionFitter], reserved: int = 0) -> Tuple[Dict[str, Any], Dict[str, int]]:
+        """
+        裁剪所有区段
+
+        reserved为不可裁剪部分（系统人设、当前消息）已占用的token数。
+        返回 (区段内容, 各区段token数报告)。
+        """
+        limits = {name: self.section_limits.get(name, self.total) for name in fitters}
+        results = {}
+        used = {}
+        for name, fitter in fitters.items():
+            results[name], used[name] = fitter(limits[name])
+
+        overflow = reserved + sum(used.values()) - self.total
+        for name in self.drop_order:
+            if overflow <= 0:
+                break
+            if name not in fitters or used[name] == 0:
+                continue
+            limits[name] = max(0, used[name] - overflow)
+            results[name], new_used = fitters[name](limits[name])
+            overflow -= used[name] - new_used
+            used[name] = new_used
+
+        report = dict(used)
+        report["reserved"] = reserved
+        report["total"] = reserved + sum(used.values())
+        return results, report
+
+
+def fit_messages(messages: Sequence[Dict[str, str]], max_tokens: int,
+                 token_counts: Optional[Sequence[int]] = None) -> Tuple[List[Dict[str, str]], int]:
+    """保留最新的消息，丢弃最旧的消息直到满足预算；token_counts为各消息已缓存的token数（可选）"""
+    kept = []
+    used = 0
+    # 只反向迭代，不按下标访问，可以直接传入工作记忆的视图
+    counts = reversed(token_counts) if token_counts is not None else None
+    for message in reversed(messages):
+        tokens = next(counts) if counts is not None else count_message_tokens(message)
+        if used + tokens > max_tokens:
+            break
+        kept.append(message)
+        used += tokens
+    kept.reverse()
+    return kept, used
+
+
+def fit_text(text: str, max_tokens: int, prefix: str = "") -> Tuple[Optional[str], int]:
+    """将文本截断到预算内，预算不足以容纳任何内容时返回None"""
+    if not text:
+        return None, 0
+    budget = max_tokens - MESSAGE_OVERHEAD - count_tokens(prefix)
+    if budget <= 0:
+        return None, 0
+    content = prefix + truncate_to_tokens(text, budget)
+    return content, count_tokens(content) + MESSAGE_OVERHEAD
@@ -0,0 +1,18 @@
+"""
+聊天服务、离线回放和压测脚本共用的小工具（不依赖服务端模块）
+"""
+
+import math
+import re
+
+# 用户ID同时用作数据目录名，只允许安全字符
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+def percentile(values, q: float) -> float:
+    """最近秩法计算分位数，q取0~100"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
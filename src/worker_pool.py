@@ -0,0 +1,402 @@
+"""
+分片工作进程池 - 按用户把对话轮次分配到多个工作进程，使用全部CPU核心
+
+关键词提取、JSON序列化和句向量计算都受GIL限制，单进程只能用满一个核心。
+前端（聊天服务的事件循环）按 crc32(user_id) % N 把用户固定分配给一个工作进程，
+每个工作进程独占自己用户的会话和记忆文件，文件锁在进程内不会发生争用，
+仍按MEMORY_FILE_LOCKS保留，以便命令行或离线回放同时修改同一用户时互斥；
+向量库客户端、嵌入模型和治疗技术库在每个工作进程启动时各加载一次。
+准入控制在前端（派发轮次之前）执行，ADMISSION_MAX_CONCURRENT是所有工作进程合计的上限。
+
+消息协议（通过multiprocessing管道传递元组）：
+    前端 -> 工作进程: ("turn", id, user_id, message, stream) / ("cancel", id) / ("stats", id, per_session) / ("stop",)
+    工作进程 -> 前端: ("ready", index, pid) / ("delta", id, text) / ("done", id, (reply, timings)) /
+                      ("error", id, message) / ("rejected", id, (reason, retry_after)) / ("cancelled", id, None) /
+                      ("stats", id, stats) / ("stopped",)
+"""
+
+import itertools
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from admission import AdmissionRejected, admission_slot, get_admission_controller
+from cancellation import CancelToken, TurnCancelled
+from config import Config
+
+# 等待工作进程启动（导入模块并预加载模型）和停止的最长秒数
+WORKER_START_TIMEOUT = 120
+WORKER_STOP_TIMEOUT = 60
+
+
+def shard_index(user_id: str, workers: int) -> int:
+    """用户所属的工作进程编号（与进程无关的稳定哈希，内置hash()每个进程的种子不同）"""
+    return zlib.crc32(user_id.encode("utf-8")) % workers
+
+
+# ---- 工作进程 ----
+
+def _preload():
+    """启动时加载进程内共享的重资源，避免第一个请求承担加载时间"""
+    from ai_psychologist import CHROMA_AVAILABLE, get_vector_resources
+    from procedural_memory import procedural_memory
+    if CHROMA_AVAILABLE:
+        try:
+            get_vector_resources()
+        except Exception as e:
+            print(f"Warning: Could not preload vector database: {e}")
+    procedural_memory.snapshot()
+
+
+class _ShardWorker:
+    """工作进程内的请求循环：主线程读取管道，对话轮次在线程池中执行"""
+
+    def __init__(self, index: int, conn):
+        from session_manager import SessionManager
+        self.index = index
+        self.conn = conn
+        self.llm_client = None
+        self._client_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self.session_manager = SessionManager(self._create_session)
+        self.executor = ThreadPoolExecutor(max_workers=Config.SERVER_WORKER_THREADS,
+                                           thread_name_prefix=f"shard-{index}")
+        # 正在执行的请求 -> 取消标记
+        self._tokens: Dict[int, CancelToken] = {}
+        self._state_lock = threading.Lock()
+
+    def _create_session(self, user_id: str):
+        from ai_psychologist import AIPsychologist, LLMClient
+        with self._client_lock:
+            if self.llm_client is None:
+                self.llm_client = LLMClient()
+                if Config.OLLAMA_PRELOAD:
+                    self.llm_client.warm_up()
+        return AIPsychologist(user_id, llm_client=self.llm_client)
+
+    def _send(self, message: tuple):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def serve(self):
+        self._send(("ready", self.index, os.getpid()))
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break  # 前端已退出
+            op = message[0]
+            if op == "turn":
+                cancel = CancelToken()
+                with self._state_lock:
+                    self._tokens[message[1]] = cancel
+                self.executor.submit(self._run_turn, *message[1:], cancel)
+            elif op == "cancel":
+                with self._state_lock:
+                    cancel = self._tokens.get(message[1])
+                if cancel is not None:
+                    cancel.cancel()
+            elif op == "stats":
+                self._send(("stats", message[1], self.get_stats(message[2])))
+            elif op == "stop":
+                break
+        self.executor.shutdown(wait=True)
+        self.session_manager.close()
+        try:
+            self._send(("stopped",))
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _run_turn(self, request_id: int, user_id: str, message: str, stream: bool, cancel: CancelToken):
+        try:
+            session = self.session_manager.acquire(user_id)
+            try:
+                if stream:
+                    parts = []
+                    for delta in session.chat_stream(message, cancel=cancel):
+                        parts.append(delta)
+                        self._send(("delta", request_id, delta))
+                    reply = "".join(parts)
+                else:
+                    # 与聊天服务一致：非流式轮次只有在可能被取代时才可取消
+                    reply = session.chat(message, cancel=cancel if Config.CANCEL_SUPERSEDED_TURNS else None)
+                timings = session.turn_timings()
+            finally:
+                self.session_manager.release(user_id)
+            self._send(("done", request_id, (reply, timings)))
+        except TurnCancelled:
+            self._send(("cancelled", request_id, None))
+        except AdmissionRejected as e:
+            self._send(("rejected", request_id, (e.reason, e.retry_after)))
+        except Exception as e:
+            self._send(("error", request_id, f"{type(e).__name__}: {e}"))
+        finally:
+            with self._state_lock:
+                self._tokens.pop(request_id, None)
+
+    def get_stats(self, per_session: bool = False) -> Dict[str, Any]:
+        from memory_lock import lock_stats
+        return {
+            "index": self.index,
+            "pid": os.getpid(),
+            "session_cache": self.session_manager.get_stats(per_session),
+            "memory_locks": lock_stats()
+        }
+
+
+def _worker_main(index: int, conn, config_values: Dict[str, Any]):
+    """工作进程入口：应用前端的配置，预加载资源后开始处理请求"""
+    # Ctrl+C会发给整个进程组，由前端统一通知工作进程写回并退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in config_values.items():
+        setattr(Config, name, value)
+    # 准入控制由前端统一执行，否则每个工作进程各有一组名额，全局上限随工作进程数成倍增加
+    Config.ADMISSION_CONTROL = False
+    _preload()
+    _ShardWorker(index, conn).serve()
+
+
+# ---- 前端 ----
+
+class _Shard:
+    __slots__ = ("index", "process", "conn", "send_lock", "reader", "alive", "requests", "errors",
+                 "in_flight")
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.reader: Optional[threading.Thread] = None
+        self.alive = True
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+
+class ShardedSessionPool:
+    """
+    按用户哈希分片的工作进程池
+
+    chat()和stream()是阻塞调用，在前端的线程池中执行；同一用户的轮次由调用方保证串行。
+    每轮先在前端取得准入名额再派发给工作进程，过载时按ADMISSION_OVERLOAD_MODE拒绝或返回降级回复。
+    传入的cancel被取消时通知工作进程取消本轮，调用方收到TurnCancelled。
+    每轮完成后把工作进程返回的各阶段耗时交给on_timings（如聊天服务的阶段统计）。
+    """
+
+    def __init__(self, workers: int, on_timings: Optional[Callable[[Dict[str, float]], None]] = None):
+        self.workers = workers
+        self.on_timings = on_timings
+        self._shards: List[_Shard] = []
+        self._pending: Dict[int, Tuple[_Shard, "queue.Queue"]] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def start(self):
+        """启动工作进程并等待它们完成预加载"""
+        # spawn在各平台上行为一致，也避免fork时复制前端线程持有的锁
+        context = multiprocessing.get_context("spawn")
+        config_values = {name: value for name, value in vars(Config).items() if name.isupper()}
+        for index in range(self.workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_main, args=(index, child_conn, config_values),
+                                      name=f"chat-shard-{index}", daemon=True)
+            process.start()
+            child_conn.close()
+            self._shards.append(_Shard(index, process, parent_conn))
+
+        for shard in self._shards:
+            try:
+                if not shard.conn.poll(WORKER_START_TIMEOUT):
+                    raise RuntimeError(f"Worker {shard.index} did not start within {WORKER_START_TIMEOUT}s")
+                shard.conn.recv()  # ("ready", index, pid)
+            except (EOFError, OSError) as e:
+                shard.alive = False
+                self.close()
+                raise RuntimeError(f"Worker {shard.index} exited during startup") from e
+            except RuntimeError:
+                self.close()
+                raise
+            shard.reader = threading.Thread(target=self._read_loop, args=(shard,),
+                                            name=f"chat-shard-reader-{shard.index}", daemon=True)
+            shard.reader.start()
+        print(f"✓ 已启动 {self.workers} 个工作进程: {[shard.process.pid for shard in self._shards]}")
+
+    def shard_for(self, user_id: str) -> _Shard:
+        return self._shards[shard_index(user_id, len(self._shards))]
+
+    def _read_loop(self, shard: _Shard):
+        """把工作进程的回复转交给等待中的请求；进程退出时让它的请求全部失败"""
+        while True:
+            try:
+                message = shard.conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == "stopped":
+                break
+            with self._lock:
+                pending = self._pending.get(message[1])
+            if pending is not None:
+                pending[1].put(message)
+        shard.alive = False
+        with self._lock:
+            orphans = [(request_id, replies) for request_id, (owner, replies) in self._pending.items()
+                       if owner is shard]
+        for request_id, replies in orphans:
+            replies.put(("error", request_id, f"Worker {shard.index} exited"))
+
+    def _send(self, shard: _Shard, message: tuple):
+        if not shard.alive:
+            raise RuntimeError(f"Worker {shard.index} is not running")
+        with shard.send_lock:
+            shard.conn.send(message)
+
+    def _submit(self, shard: _Shard, make_message) -> Tuple[int, "queue.Queue"]:
+        request_id = next(self._ids)
+        replies: "queue.Queue" = queue.Queue()
+        with self._lock:
+            self._pending[request_id] = (shard, replies)
+        try:
+            self._send(shard, make_message(request_id))
+        except Exception:
+            self._finish(request_id)
+            raise
+        return request_id, replies
+
+    def _finish(self, request_id: int):
+        with self._lock:
+            self._pending.pop(request_id, None)
+
+    def _cancel_sender(self, shard: _Shard, request_id: int) -> Callable[[], None]:
+        def send_cancel():
+            try:
+                self._send(shard, ("cancel", request_id))
+            except (RuntimeError, OSError):
+                pass
+        return send_cancel
+
+    def _turn(self, user_id: str, message: str, stream: bool,
+              cancel: Optional[CancelToken] = None) -> Iterator[Tuple[str, Any]]:
+        shard = self.shard_for(user_id)
+        request_id, replies = self._submit(shard, lambda rid: ("turn", rid, user_id, message, stream))
+        with self._lock:
+            shard.requests += 1
+            shard.in_flight += 1
+        send_cancel = self._cancel_sender(shard, request_id)
+        if cancel is not None:
+            cancel.add_callback(send_cancel)
+        finished = False
+        try:
+            while True:
+                kind, _, payload = replies.get()
+                if kind != "delta":
+                    finished = True
+                    if kind == "cancelled":
+                        raise TurnCancelled()
+                    if kind == "rejected":
+                        raise AdmissionRejected(*payload)
+                    if kind == "error":
+                        with self._lock:
+                            shard.errors += 1
+                        raise RuntimeError(payload)
+                    payload, timings = payload
+                    if self.on_timings is not None:
+                        self.on_timings(timings)
+                yield kind, payload
+                if finished:
+                    return
+        finally:
+            if not finished:
+                # 调用方提前停止：通知工作进程取消本轮，并等待本轮结束，保证同一用户的轮次不交错
+                send_cancel()
+                while replies.get()[0] == "delta":
+                    pass
+            if cancel is not None:
+                cancel.remove_callback(send_cancel)
+            self._finish(request_id)
+            with self._lock:
+                shard.in_flight -= 1
+
+    def _admitted(self, user_id: str, cancel: Optional[CancelToken] = None):
+        controller = get_admission_controller() if Config.ADMISSION_CONTROL else None
+        return admission_slot(controller, user_id, cancel)
+
+    @staticmethod
+    def _degraded_reply(message: str) -> str:
+        """过载时不派发给工作进程，返回与AIPsychologist降级时相同的模拟回复"""
+        from ai_psychologist import mock_completion
+        return mock_completion([{"role": "user", "content": message}])["choices"][0]["message"]["content"]
+
+    def chat(self, user_id: str, message: str, cancel: Optional[CancelToken] = None) -> str:
+        """在用户所属的工作进程中执行一轮对话，返回回复"""
+        with self._admitted(user_id, cancel) as admitted:
+            if not admitted:
+                return self._degraded_reply(message)
+            for kind, payload in self._turn(user_id, message, False, cancel):
+                if kind == "done":
+                    return payload
+        raise RuntimeError("Worker returned no reply")
+
+    def stream(self, user_id: str, message: str, cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        """在用户所属的工作进程中流式执行一轮对话，逐段产出回复"""
+        with self._admitted(user_id, cancel) as admitted:
+            if not admitted:
+                yield self._degraded_reply(message)
+                return
+            for kind, payload in self._turn(user_id, message, True, cancel):
+                if kind == "delta":
+                    yield payload
+
+    # ---- 统计与停止 ----
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """
+        前端记录的每个工作进程的请求数和进行中的请求数
+
+        前端不记录分配过的用户（长时间运行时会无限增长），各工作进程当前缓存的会话数见worker_stats()。
+        """
+        with self._lock:
+            return [{"index": shard.index, "pid": shard.process.pid, "alive": shard.alive,
+                     "requests": shard.requests, "errors": shard.errors, "in_flight": shard.in_flight}
+                    for shard in self._shards]
+
+    def worker_stats(self, per_session: bool = False, timeout: float = 5.0) -> List[Dict[str, Any]]:
+        """向每个工作进程查询会话缓存和记忆锁统计"""
+        results = []
+        for shard in self._shards:
+            try:
+                request_id, replies = self._submit(shard, lambda rid: ("stats", rid, per_session))
+            except (RuntimeError, OSError) as e:
+                results.append({"index": shard.index, "error": str(e)})
+                continue
+            try:
+                kind, _, payload = replies.get(timeout=timeout)
+                results.append(payload if kind == "stats" else {"index": shard.index, "error": payload})
+            except queue.Empty:
+                results.append({"index": shard.index, "error": "timeout"})
+            finally:
+                self._finish(request_id)
+        return results
+
+    def close(self):
+        """通知工作进程写回会话并退出"""
+        for shard in self._shards:
+            try:
+                self._send(shard, ("stop",))
+            except (RuntimeError, OSError):
+                pass
+        for shard in self._shards:
+            shard.process.join(WORKER_STOP_TIMEOUT)
+            if shard.process.is_alive():
+                print(f"Warning: Worker {shard.index} did not stop, terminating it")
+                shard.process.terminate()
+                shard.process.join()
+            if shard.reader is not None:
+                shard.reader.join()
+            shard.conn.close()
+        self._shards = []
@@ -0,0 +1,141 @@
+"""
+工作记忆模块 - 同时按消息条数和token数限制的环形缓冲区
+
+每条消息写入时计算一次token数并缓存，超出任一上限时从最旧的一端淘汰；
+单条消息本身超过token上限时截断后再写入。构建上下文时直接读取缓冲区视图，
+按缓存的token数从最新消息向前选取，不再每轮复制整个列表或重新计算token。
+"""
+
+import time
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from token_budget import MESSAGE_OVERHEAD, count_message_tokens, fit_messages, truncate_to_tokens
+
+
+class WorkingMemoryItem(NamedTuple):
+    """工作记忆中的一条消息及其缓存的token数（含格式开销）"""
+    message: Dict[str, str]
+    tokens: int
+    timestamp: float
+
+
+class WorkingMemoryView(Sequence):
+    """工作记忆的只读视图，不复制底层缓冲区"""
+
+    def __init__(self, items: Deque[WorkingMemoryItem]):
+        self._items = items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return (item.message for item in self._items)
+
+    def __reversed__(self) -> Iterator[Dict[str, str]]:
+        return (item.message for item in reversed(self._items))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [item.message for item in islice(self._items, *index.indices(len(self._items)))]
+        return self._items[index].message
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+    # 视图内容随缓冲区变化，不可哈希
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"WorkingMemoryView({list(self)!r})"
+
+    @property
+    def token_counts(self) -> "TokenCountView":
+        """与消息一一对应的缓存token数，同样不复制底层缓冲区"""
+        return TokenCountView(self._items)
+
+
+class TokenCountView(Sequence):
+    """工作记忆中各消息缓存的token数的只读视图"""
+
+    def __init__(self, items: Deque[WorkingMemoryItem]):
+        self._items = items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[int]:
+        return (item.tokens for item in self._items)
+
+    def __reversed__(self) -> Iterator[int]:
+        return (item.tokens for item in reversed(self._items))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [item.tokens for item in islice(self._items, *index.indices(len(self._items)))]
+        return self._items[index].tokens
+
+
+class WorkingMemoryBuffer:
+    """按消息条数和token总数限制的工作记忆环形缓冲区"""
+
+    def __init__(self, max_messages: int, max_tokens: int):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self._items: Deque[WorkingMemoryItem] = deque()
+        self.total_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def append(self, message: Dict[str, str], timestamp: Optional[float] = None) -> List[WorkingMemoryItem]:
+        """写入一条消息，返回因超出上限而被淘汰的旧消息（由旧到新）"""
+        tokens = count_message_tokens(message)
+        if tokens > self.max_tokens:
+            content = truncate_to_tokens(message.get("content", ""), self.max_tokens - MESSAGE_OVERHEAD)
+            message = dict(message, content=content)
+            tokens = count_message_tokens(message)
+        self._items.append(WorkingMemoryItem(message, tokens, timestamp or time.time()))
+        self.total_tokens += tokens
+
+        evicted = []
+        while len(self._items) > 1 and (len(self._items) > self.max_messages or self.total_tokens > self.max_tokens):
+            item = self._items.popleft()
+            self.total_tokens -= item.tokens
+            evicted.append(item)
+        return evicted
+
+    def to_state(self) -> List[List[Any]]:
+        """紧凑的可序列化快照：[角色, 内容, token数, 时间戳]"""
+        return [[item.message.get("role", ""), item.message.get("content", ""), item.tokens, item.timestamp]
+                for item in self._items]
+
+    def restore(self, state: List[List[Any]], recount: bool = False):
+        """从快照恢复，recount为True时（分词方式变化）重新计算token数；恢复后仍遵守当前上限"""
+        self.clear()
+        for role, content, tokens, timestamp in state[-self.max_messages:]:
+            message = {"role": role, "content": content}
+            if recount or tokens > self.max_tokens:
+                self.append(message, timestamp)
+                continue
+            self._items.append(WorkingMemoryItem(message, tokens, timestamp))
+            self.total_tokens += tokens
+        while len(self._items) > 1 and self.total_tokens > self.max_tokens:
+            self.total_tokens -= self._items.popleft().tokens
+
+    def clear(self):
+        self._items.clear()
+        self.total_tokens = 0
+
+    def items(self) -> Iterator[WorkingMemoryItem]:
+        return iter(self._items)
+
+    def view(self) -> WorkingMemoryView:
+        """当前消息的只读视图"""
+        return WorkingMemoryView(self._items)
+
+    def fit(self, max_tokens: int) -> Tuple[List[Dict[str, str]], int]:
+        """按缓存的token数保留最新的消息，丢弃最旧的消息直到满足预算（从最新一端遍历视图，不复制缓冲区）"""
+        view = self.view()
+        return fit_messages(view, max_tokens, view.token_counts)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+测试对话轮次的准入控制（并发上限、有界等待队列和过载降级）
+"""
+
+import sys
+import os
+import json
+import time
+import threading
+import http.client
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+class SlowLLMClient:
+    """每次调用固定耗时的模拟客户端，用来模拟变慢的LLM后端"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def chat_completion(self, messages, model=None, cancel=None):
+        from ai_psychologist import mock_completion
+        time.sleep(self.delay)
+        return mock_completion(messages)
+
+    def chat_completion_stream(self, messages, model=None, usage=None, cancel=None):
+        from ai_psychologist import mock_stream
+        time.sleep(self.delay)
+        yield from mock_stream(messages)
+
+
+def _acquire_in_thread(controller, user_id, results):
+    def run():
+        try:
+            results[user_id] = controller.acquire(user_id)
+        except Exception as e:
+            results[user_id] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_limits_and_queue():
+    """测试全局与单用户上限、FIFO放行、队列已满和排队超时"""
+    from admission import AdmissionController, AdmissionRejected
+    controller = AdmissionController(max_concurrent=2, max_per_user=1, max_queue=2, queue_timeout=5)
+    assert controller.acquire("alice") == 0.0
+    results = {}
+
+    # alice达到单用户上限而排队，不阻塞排在后面的bob
+    waiting_alice = _acquire_in_thread(controller, "alice", results)
+    time.sleep(0.05)
+    assert controller.acquire("bob") == 0.0 and "alice" not in results
+    assert controller.get_stats()["active"] == 2
+
+    # 全局名额已满：carol排队，队列满后dave立即被拒绝
+    waiting_carol = _acquire_in_thread(controller, "carol", results)
+    time.sleep(0.05)
+    try:
+        controller.acquire("dave")
+        assert False, "dave should have been rejected"
+    except AdmissionRejected as e:
+        assert e.reason == "queue_full" and e.retry_after >= 1.0
+    stats = controller.get_stats()
+    assert stats["queue_depth"] == 2 and stats["max_queue_depth"] == 2
+
+    # bob结束后按到达顺序放行：alice仍受单用户上限，carol先行
+    controller.release("bob", 10.0)
+    waiting_carol.join(5)
+    assert isinstance(results["carol"], float) and results["carol"] > 0 and "alice" not in results
+    controller.release("alice", 10.0)
+    waiting_alice.join(5)
+    assert isinstance(results["alice"], float)
+
+    # 名额一直被占用时排队超时
+    try:
+        controller.acquire("erin", timeout=0.1)
+        assert False, "erin should have timed out"
+    except AdmissionRejected as e:
+        assert e.reason == "timeout"
+    stats = controller.get_stats()
+    print(f"准入统计: {stats}")
+    assert stats["rejected_queue_full"] == 1 and stats["rejected_timeout"] == 1 and stats["queued"] == 3
+    assert stats["queue_depth"] == 0 and stats["wait_p99_ms"] > 0
+
+    # 排队结束（放行或超时）后注销取消回调，长期存在的取消标记上不会积累回调
+    from cancellation import CancelToken
+    cancel = CancelToken()
+    for _ in range(3):
+        try:
+            controller.acquire("erin", timeout=0.05, cancel=cancel)
+        except AdmissionRejected:
+            pass
+    assert not cancel._callbacks
+
+
+def test_degraded_reply():
+    """测试degrade模式下过载时返回降级回复且不写入记忆；默认的reject模式下抛出异常"""
+    from config import Config
+    assert Config.ADMISSION_OVERLOAD_MODE == "reject"
+    from admission import AdmissionController, AdmissionRejected
+    from ai_psychologist import AIPsychologist, DEFAULT_MOCK_RESPONSE
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    slow, fast = AIPsychologist("slow_user", SlowLLMClient(0.3)), AIPsychologist("fast_user", SlowLLMClient(0.0))
+    slow.admission = fast.admission = controller
+
+    thread = threading.Thread(target=slow.chat, args=("我最近很焦虑。",))
+    thread.start()
+    time.sleep(0.1)
+    try:
+        fast.chat("还在吗？")
+        assert False, "the turn should have been rejected"
+    except AdmissionRejected as e:
+        assert e.retry_after >= 1.0
+
+    original_mode = Config.ADMISSION_OVERLOAD_MODE
+    Config.ADMISSION_OVERLOAD_MODE = "degrade"
+    try:
+        start = time.perf_counter()
+        reply = fast.chat("我今天有点难过。")
+        assert time.perf_counter() - start < 0.2 and reply
+        assert fast.last_turn_stats == {"degraded": True}
+        assert len(fast.memory_system.get_working_memory_context()) == 0
+        assert "".join(fast.chat_stream("你好")) == DEFAULT_MOCK_RESPONSE
+    finally:
+        Config.ADMISSION_OVERLOAD_MODE = original_mode
+    thread.join()
+    assert len(slow.memory_system.get_working_memory_context()) == 2
+    assert controller.get_stats()["degraded"] == 2 and controller.get_stats()["active"] == 0
+
+
+def test_server_rejects_with_503():
+    """测试默认的reject模式下聊天服务返回503和建议的重试间隔（响应体和Retry-After头）"""
+    from admission import AdmissionController
+    from ai_psychologist import AIPsychologist
+    from chat_server import ChatServer
+    controller = AdmissionController(max_concurrent=1, max_queue=0)
+    llm_client = SlowLLMClient(0.3)
+
+    def factory(user_id):
+        session = AIPsychologist(user_id, llm_client=llm_client)
+        session.admission = controller
+        return session
+
+    server = ChatServer(host="127.0.0.1", port=0, session_factory=factory).start_in_thread()
+    try:
+        def post(user_id, results):
+            connection = http.client.HTTPConnection(server.host, server.port, timeout=30)
+            connection.request("POST", "/v1/chat", body=json.dumps({"user_id": user_id, "message": "你好"}))
+            response = connection.getresponse()
+            results[user_id] = (response.status, json.loads(response.read()))
+            results[f"{user_id}_retry_after"] = response.getheader("Retry-After")
+            connection.close()
+
+        results = {}
+        first = threading.Thread(target=post, args=("first", results))
+        first.start()
+        time.sleep(0.15)
+        post("second", results)
+        first.join()
+        assert results["first"][0] == 200
+        status, body = results["second"]
+        assert status == 503 and body["reason"] == "queue_full" and body["retry_after"] >= 1.0
+        assert int(results["second_retry_after"]) >= body["retry_after"]
+        assert server.get_stats()["rejected"] == 1
+    finally:
+        server.stop()
+
+
+def main():
+    print("准入控制测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_limits_and_queue)
+        run_isolated(test_degraded_reply)
+        run_isolated(test_server_rejects_with_503)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 准入控制测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
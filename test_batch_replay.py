@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+测试批量对话回放
+"""
+
+import sys
+import os
+import io
+import json
+import time
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+class EchoLLMClient:
+    """回复中带上用户最后一句话的模拟客户端，用来检查回放顺序"""
+
+    def chat_completion(self, messages, model=None, cancel=None):
+        time.sleep(0.01)
+        return {"choices": [{"message": {"role": "assistant", "content": f"收到：{messages[-1]['content']}"}}]}
+
+
+def test_load_records():
+    """测试字段识别、按时间戳排序、跳过无效行，以及requests.jsonl格式"""
+    from batch_replay import load_records
+    lines = [
+        json.dumps({"user_id": "alice", "message": "第二条", "timestamp": "2024-03-02T09:00:00"}),
+        json.dumps({"user": "bob", "text": "你好"}),
+        "",
+        "not json",
+        json.dumps({"user_id": "alice", "message": "第一条", "timestamp": 1700000000}),
+        json.dumps({"user_id": "carol"}),
+        json.dumps({"request_id": "user-001", "title": "标题", "body": "请求内容"}),
+    ]
+    by_user = load_records(lines)
+    assert list(by_user) == ["alice", "bob", "user-001"]
+    assert [r["message"] for r in by_user["alice"]] == ["第一条", "第二条"]
+    assert by_user["bob"][0]["timestamp"] is None and by_user["user-001"][0]["message"] == "请求内容"
+
+    # 有记录缺少时间戳时保持文件中的顺序
+    lines = [json.dumps({"user_id": "dave", "message": "甲", "timestamp": 200}),
+             json.dumps({"user_id": "dave", "message": "乙"}),
+             json.dumps({"user_id": "dave", "message": "丙", "timestamp": 100})]
+    assert [r["message"] for r in load_records(lines)["dave"]] == ["甲", "乙", "丙"]
+    by_user = load_records([json.dumps({"uid": "erin", "q": "在吗"})], user_field="uid", message_field="q")
+    assert by_user["erin"][0]["message"] == "在吗"
+
+
+def test_replay():
+    """测试用户并行回放、同一用户按顺序执行、失败轮次和非法用户ID被记录、结束时写回记忆"""
+    from config import Config
+    from ai_psychologist import AIPsychologist
+    from batch_replay import replay
+
+    input_path = os.path.join(Config.DATA_STORAGE_PATH, "input.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for turn in range(4):
+            for user in range(5):
+                f.write(json.dumps({"user_id": f"user{user}", "message": f"第{turn}轮"}, ensure_ascii=False) + "\n")
+        f.write(json.dumps({"user_id": "../escaped", "message": "越界"}, ensure_ascii=False) + "\n")
+
+    def factory(user_id):
+        session = AIPsychologist(user_id, llm_client=EchoLLMClient())
+        if user_id == "user4":
+            session.chat = lambda message: (_ for _ in ()).throw(RuntimeError("backend down"))
+        return session
+
+    output = io.StringIO()
+    result = replay(input_path, output, concurrency=3, workers=0, session_factory=factory)
+    print(f"回放统计: {result}")
+    assert result["users"] == 6 and result["turns"] == 21 and result["errors"] == 5
+    assert result["turns_per_second"] > 0 and result["latency_ms"]["p99"] > 0
+
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert len(results) == 21
+    assert [r["error"] for r in results if r["user_id"] == "../escaped"] == ["Invalid user_id"]
+    assert not os.path.exists(os.path.join(os.path.dirname(Config.DATA_STORAGE_PATH), "escaped"))
+    for user in range(4):
+        replies = [r["reply"] for r in results if r["user_id"] == f"user{user}"]
+        assert replies == [f"收到：第{turn}轮" for turn in range(4)]
+    assert all("backend down" in r["error"] for r in results if r["user_id"] == "user4")
+
+    with open(os.path.join(Config.DATA_STORAGE_PATH, "user0", "session_state.json"), encoding="utf-8") as f:
+        working = json.load(f)["working_memory"]
+    assert [content for role, content, *_ in working if role == "user"] == [f"第{turn}轮" for turn in range(4)]
+
+
+def main():
+    print("批量对话回放测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_load_records)
+        run_isolated(test_replay)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 批量对话回放测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+测试取消被新消息取代的对话轮次
+"""
+
+import sys
+import os
+import json
+import time
+import threading
+import http.client
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+class SlowStreamClient:
+    """逐段缓慢输出的模拟客户端；取消时像真实客户端一样关闭"连接"并停止生成"""
+
+    def __init__(self, delay: float = 0.05, chunks: int = 10):
+        self.delay = delay
+        self.chunks = chunks
+        self.closed = 0
+
+    def _close(self):
+        self.closed += 1
+
+    def chat_completion(self, messages, model=None, cancel=None):
+        content = "".join(self.chat_completion_stream(messages, model, cancel=cancel))
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+    def chat_completion_stream(self, messages, model=None, usage=None, cancel=None):
+        from cancellation import raise_if_cancelled
+        if cancel is not None:
+            cancel.add_callback(self._close)
+        for i in range(self.chunks):
+            time.sleep(self.delay)
+            raise_if_cancelled(cancel)
+            yield f"第{i}段。"
+
+
+def _chat_in_thread(session, message, results, key):
+    def run():
+        try:
+            results[key] = session.chat(message)
+        except Exception as e:
+            results[key] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_superseded_turn():
+    """测试同一会话的新消息取消仍在生成的上一轮：连接被关闭，只有新的一轮写入记忆"""
+    from config import Config
+    from ai_psychologist import AIPsychologist
+    from cancellation import TurnCancelled
+
+    client = SlowStreamClient()
+    session = AIPsychologist("alice", llm_client=client)
+    original = Config.CANCEL_SUPERSEDED_TURNS
+    Config.CANCEL_SUPERSEDED_TURNS = True
+    try:
+        results = {}
+        first = _chat_in_thread(session, "我今天和同事吵架了，", results, "first")
+        time.sleep(0.15)
+        start = time.perf_counter()
+        second = _chat_in_thread(session, "算了，其实我是想说最近睡不好。", results, "second")
+        first.join(5)
+        # 旧的一轮在下一个检查点就结束，不必等到整段回复生成完
+        assert time.perf_counter() - start < 0.3
+        second.join(5)
+    finally:
+        Config.CANCEL_SUPERSEDED_TURNS = original
+
+    assert isinstance(results["first"], TurnCancelled), results["first"]
+    assert results["second"].startswith("第0段")
+    assert client.closed == 1 and session.cancelled_turns == 1
+    working = session.memory_system.get_working_memory_context()
+    assert [m["content"] for m in working if m["role"] == "user"] == ["算了，其实我是想说最近睡不好。"]
+
+
+def test_cancel_turn():
+    """测试从其他线程取消正在流式输出的一轮，以及默认不取消上一轮"""
+    from ai_psychologist import AIPsychologist
+    from cancellation import TurnCancelled
+
+    session = AIPsychologist("bob", llm_client=SlowStreamClient())
+    assert not session.cancel_turn()
+    stream = session.chat_stream("我有点焦虑。")
+    assert next(stream)
+    assert session.cancel_turn()
+    try:
+        list(stream)
+        assert False, "the stream should have been cancelled"
+    except TurnCancelled:
+        pass
+    assert session.last_turn_stats == {"cancelled": True}
+    assert len(session.memory_system.get_working_memory_context()) == 0
+
+    # CANCEL_SUPERSEDED_TURNS关闭时，同一会话的两轮都完成
+    results = {}
+    threads = [_chat_in_thread(session, f"第{i}条消息", results, i) for i in range(2)]
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(reply, str) for reply in results.values())
+    assert len(session.memory_system.get_working_memory_context()) == 4
+
+
+class RecordingClient:
+    """记录调用的是流式还是非流式接口"""
+
+    def __init__(self):
+        self.calls = []
+
+    def chat_completion(self, messages, model=None, cancel=None):
+        from ai_psychologist import mock_completion
+        self.calls.append("stream" if cancel is not None else "completion")
+        return mock_completion(messages)
+
+    def chat_completion_stream(self, messages, model=None, usage=None, cancel=None):
+        from ai_psychologist import mock_stream
+        self.calls.append("stream")
+        yield from mock_stream(messages)
+
+
+class _BrokenResponse:
+    """输出一段内容后连接断开的Ollama流式响应"""
+    status_code = 200
+
+    def iter_lines(self):
+        yield json.dumps({"message": {"content": "我理解你"}}).encode("utf-8")
+        raise ConnectionError("connection reset")
+
+    def close(self):
+        pass
+
+
+def test_not_cancellable_by_default():
+    """测试默认配置下chat()使用非流式请求；流式输出中途失败时不返回也不保存不完整的回复"""
+    import types
+    import ai_psychologist
+    from ai_psychologist import AIPsychologist, LLMClient, OllamaClient, StreamInterrupted, mock_completion
+    from cancellation import CancelToken
+
+    client = RecordingClient()
+    session = AIPsychologist("dave", llm_client=client)
+    session.chat("你好")
+    assert client.calls == ["completion"]
+    assert not session.cancel_turn()
+
+    original_requests = ai_psychologist.requests
+    ai_psychologist.requests = types.SimpleNamespace(post=lambda *args, **kwargs: _BrokenResponse())
+    try:
+        llm_client = LLMClient()
+        llm_client.client = OllamaClient()
+        llm_client.client.available = True
+        messages = [{"role": "user", "content": "我有点难过"}]
+        # 可取消的chat()拼接流式输出：中途失败时与非流式请求一样退回模拟回复
+        reply = llm_client.chat_completion(messages, cancel=CancelToken())
+        assert reply["choices"][0]["message"]["content"] == mock_completion(messages)["choices"][0]["message"]["content"]
+
+        session = AIPsychologist("erin", llm_client=llm_client)
+        stream = session.chat_stream("我有点难过")
+        assert next(stream) == "我理解你"
+        try:
+            list(stream)
+            assert False, "the interrupted stream should raise"
+        except StreamInterrupted:
+            pass
+        assert len(session.memory_system.get_working_memory_context()) == 0
+    finally:
+        ai_psychologist.requests = original_requests
+
+
+def test_server_superseded():
+    """测试聊天服务对被取代的请求返回409，新请求正常完成"""
+    from config import Config
+    from ai_psychologist import AIPsychologist
+    from chat_server import ChatServer
+
+    client = SlowStreamClient()
+    original = Config.CANCEL_SUPERSEDED_TURNS
+    Config.CANCEL_SUPERSEDED_TURNS = True
+    server = ChatServer(host="127.0.0.1", port=0,
+                        session_factory=lambda user_id: AIPsychologist(user_id, llm_client=client)).start_in_thread()
+    try:
+        def post(message, results, key):
+            connection = http.client.HTTPConnection(server.host, server.port, timeout=30)
+            connection.request("POST", "/v1/chat", body=json.dumps({"user_id": "carol", "message": message}))
+            response = connection.getresponse()
+            results[key] = (response.status, json.loads(response.read()))
+            connection.close()
+
+        results = {}
+        first = threading.Thread(target=post, args=("我想聊聊工作。", results, "first"))
+        first.start()
+        time.sleep(0.15)
+        post("还是聊聊家里的事吧。", results, "second")
+        first.join()
+        assert results["first"] == (409, {"error": "Superseded by a newer message", "cancelled": True})
+        assert results["second"][0] == 200 and results["second"][1]["reply"]
+        assert server.get_stats()["cancelled"] == 1 and client.closed == 1
+    finally:
+        Config.CANCEL_SUPERSEDED_TURNS = original
+        server.stop()
+
+
+def test_websocket_disconnect_cancels():
+    """测试WebSocket客户端在流式输出中途断开时，本轮被立即取消，不再等待后续输出"""
+    import socket
+    import base64
+    from ai_psychologist import AIPsychologist
+    from chat_server import ChatServer
+
+    client = SlowStreamClient(delay=0.1, chunks=50)
+    server = ChatServer(host="127.0.0.1", port=0,
+                        session_factory=lambda user_id: AIPsychologist(user_id, llm_client=client)).start_in_thread()
+    try:
+        sock = socket.create_connection((server.host, server.port), timeout=30)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        sock.sendall((f"GET /ws?user_id=frank HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                      f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        sock_file = sock.makefile("rb")
+        while sock_file.readline() not in (b"\r\n", b""):
+            pass
+        payload = "我今天很难过。".encode("utf-8")
+        mask = os.urandom(4)
+        sock.sendall(bytes([0x81, 0x80 | len(payload)]) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+        first, second = sock_file.read(2)
+        assert first & 0x0F == 0x1
+        sock_file.close()
+        sock.close()
+
+        # 50段输出需要5秒；断开后发送失败即取消，连接很快被关闭
+        deadline = time.time() + 3
+        while client.closed == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        assert client.closed == 1
+        time.sleep(0.3)
+        assert len(server.sessions["frank"].memory_system.get_working_memory_context()) == 0
+    finally:
+        server.stop()
+
+
+def main():
+    print("轮次取消测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_superseded_turn)
+        run_isolated(test_cancel_turn)
+        run_isolated(test_not_cancellable_by_default)
+        run_isolated(test_server_superseded)
+        run_isolated(test_websocket_disconnect_cancels)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 轮次取消测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
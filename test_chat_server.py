@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+测试多用户聊天服务（HTTP、流式输出和WebSocket）
+"""
+
+import sys
+import os
+import json
+import base64
+import socket
+import threading
+import http.client
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def _start_server(**kwargs):
+    from chat_server import ChatServer
+    return ChatServer(host="127.0.0.1", port=0, **kwargs).start_in_thread()
+
+
+def _post(server, payload, connection=None):
+    own_connection = connection is None
+    if own_connection:
+        connection = http.client.HTTPConnection(server.host, server.port, timeout=30)
+    try:
+        connection.request("POST", "/v1/chat", body=json.dumps(payload), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        if own_connection:
+            connection.close()
+
+
+def _websocket_send(sock, text, opcode=0x1, fin=True):
+    """发送一个加掩码的文本帧（客户端发出的帧必须加掩码）"""
+    payload = text.encode("utf-8")
+    mask = os.urandom(4)
+    header = bytes([(0x80 if fin else 0) | opcode])
+    if len(payload) < 126:
+        header += bytes([0x80 | len(payload)])
+    else:
+        header += bytes([0x80 | 126]) + len(payload).to_bytes(2, "big")
+    sock.sendall(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+
+def _websocket_receive(sock_file):
+    first, second = sock_file.read(2)
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(sock_file.read(2), "big")
+    elif length == 127:
+        length = int.from_bytes(sock_file.read(8), "big")
+    return first & 0x0F, sock_file.read(length)
+
+
+def test_http_chat_and_sessions():
+    """测试普通请求、请求校验以及多个用户共享同一个LLM客户端"""
+    server = _start_server()
+    try:
+        connection = http.client.HTTPConnection(server.host, server.port, timeout=30)
+        status, body = _post(server, {"user_id": "alice", "message": "我最近感到很焦虑。"}, connection)
+        assert status == 200 and body["reply"] and body["user_id"] == "alice"
+        # 同一连接保持复用
+        status, body = _post(server, {"user_id": "bob", "message": "我睡不好。"}, connection)
+        assert status == 200
+
+        assert _post(server, {"user_id": "../etc", "message": "hi"})[0] == 400
+        assert _post(server, {"user_id": "alice", "message": "  "})[0] == 400
+        connection.request("GET", "/nowhere")
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 404
+
+        alice, bob = server.sessions["alice"], server.sessions["bob"]
+        assert alice.llm_client is bob.llm_client
+        assert alice.memory_system is not bob.memory_system
+        assert len(alice.memory_system.get_working_memory_context()) == 2
+
+        connection.request("GET", "/v1/stats")
+        stats = json.loads(connection.getresponse().read())
+        print(f"统计: {stats}")
+        assert stats["sessions"] == 2 and stats["requests"] == 2 and stats["errors"] >= 1
+        assert stats["latency_ms"]["samples"] == 2
+        assert stats["stages"]["context.total"]["samples"] == 2 and "memory_update" in stats["stages"]
+        connection.close()
+    finally:
+        server.stop()
+
+
+def test_streaming_and_concurrency():
+    """测试流式输出，以及并发请求下同一用户的轮次仍按顺序执行"""
+    server = _start_server(max_concurrency=4)
+    try:
+        connection = http.client.HTTPConnection(server.host, server.port, timeout=30)
+        connection.request("POST", "/v1/chat", body=json.dumps(
+            {"user_id": "carol", "message": "我和朋友吵架了。", "stream": True}))
+        response = connection.getresponse()
+        assert response.getheader("Content-Type").startswith("text/event-stream")
+        events = [block for block in response.read().decode("utf-8").split("\n\n") if block]
+        deltas = [json.loads(e[len("data: "):])["delta"] for e in events if e.startswith("data: ")]
+        done = json.loads(events[-1].split("data: ", 1)[1])
+        assert events[-1].startswith("event: done") and len(deltas) > 1
+        assert "".join(deltas) == done["reply"]
+        connection.close()
+
+        errors = []
+
+        def worker(user_id, count):
+            try:
+                for i in range(count):
+                    status, _ = _post(server, {"user_id": user_id, "message": f"第{i}条消息。"})
+                    assert status == 200
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(user_id, 3)) for user_id in ["u1", "u2", "u3"] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+        # 每个用户的6轮对话全部写入，且用户消息与回复成对交替（同一用户的轮次没有交错）
+        from config import Config
+        for user_id in ["u1", "u2", "u3"]:
+            working_memory = list(server.sessions[user_id].memory_system.get_working_memory_context())
+            assert len(working_memory) == min(12, Config.WORKING_MEMORY_SIZE)
+            assert [m["role"] for m in working_memory] == ["user", "assistant"] * (len(working_memory) // 2)
+            assert server.sessions[user_id].memory_update_stats["turns"] == 6
+        assert server.get_stats()["active"] == 0
+    finally:
+        server.stop()
+
+
+def _websocket_connect(server, user_id):
+    sock = socket.create_connection((server.host, server.port), timeout=30)
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    sock.sendall((f"GET /ws?user_id={user_id} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                  f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+    sock_file = sock.makefile("rb")
+    status_line = sock_file.readline()
+    assert b"101" in status_line
+    while sock_file.readline() not in (b"\r\n", b""):
+        pass
+    return sock, sock_file
+
+
+def test_websocket():
+    """测试WebSocket握手、流式推送和ping/close"""
+    server = _start_server()
+    try:
+        sock, sock_file = _websocket_connect(server, "dave")
+
+        _websocket_send(sock, json.dumps({"message": "我今天很难过。"}))
+        deltas = []
+        while True:
+            opcode, payload = _websocket_receive(sock_file)
+            message = json.loads(payload)
+            if message["type"] == "delta":
+                deltas.append(message["content"])
+            else:
+                break
+        assert message["type"] == "done" and "".join(deltas) == message["reply"]
+
+        _websocket_send(sock, "纯文本消息也可以。")
+        while json.loads(_websocket_receive(sock_file)[1])["type"] != "done":
+            pass
+        assert len(server.sessions["dave"].memory_system.get_working_memory_context()) == 4
+
+        # ping -> pong，close -> close
+        mask = os.urandom(4)
+        sock.sendall(bytes([0x89, 0x80]) + mask)
+        assert _websocket_receive(sock_file)[0] == 0xA
+        sock.sendall(bytes([0x88, 0x80]) + mask)
+        assert _websocket_receive(sock_file)[0] == 0x8
+        sock_file.close()
+        sock.close()
+    finally:
+        server.stop()
+
+
+def test_websocket_protocol_errors():
+    """测试未加掩码的帧以1002关闭，分片拼接后超过上限的消息以1009关闭"""
+    server = _start_server()
+    server.max_request_bytes = 1024
+    try:
+        sock, sock_file = _websocket_connect(server, "erin")
+        sock.sendall(bytes([0x81, 0x02]) + b"hi")
+        opcode, payload = _websocket_receive(sock_file)
+        assert opcode == 0x8 and int.from_bytes(payload, "big") == 1002
+        sock_file.close()
+        sock.close()
+
+        # 每一片都在上限之内，但总长度超出
+        sock, sock_file = _websocket_connect(server, "erin")
+        _websocket_send(sock, "a" * 600, opcode=0x1, fin=False)
+        _websocket_send(sock, "a" * 600, opcode=0x0, fin=False)
+        opcode, payload = _websocket_receive(sock_file)
+        assert opcode == 0x8 and int.from_bytes(payload, "big") == 1009
+        sock_file.close()
+        sock.close()
+    finally:
+        server.stop()
+
+
+def main():
+    print("多用户聊天服务测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_http_chat_and_sessions)
+        run_isolated(test_streaming_and_concurrency)
+        run_isolated(test_websocket)
+        run_isolated(test_websocket_protocol_errors)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 多用户聊天服务测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
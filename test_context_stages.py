@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+测试上下文检索阶段的并发执行与期限
+"""
+
+import sys
+import os
+import time
+import threading
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def _make_psychologist(user_id):
+    from ai_psychologist import AIPsychologist
+    return AIPsychologist(user_id)
+
+
+def test_stages_run_concurrently():
+    """测试各阶段并发执行，总耗时接近最慢的阶段而不是各阶段之和"""
+    psychologist = _make_psychologist("stages_user")
+    psychologist.chat("我最近工作压力很大，晚上睡不着")
+
+    memory = psychologist.memory_system
+    original_query = memory.get_relevant_episodic_memories
+    original_time = psychologist._process_time_reference
+
+    def slow_query(query, limit=5):
+        time.sleep(0.08)
+        return original_query(query, limit)
+
+    threads = {}
+
+    def slow_time_reference(user_message):
+        threads["time_reference"] = threading.current_thread()
+        time.sleep(0.08)
+        return original_time(user_message)
+
+    memory.get_relevant_episodic_memories = slow_query
+    psychologist._process_time_reference = slow_time_reference
+
+    context = psychologist._build_context("压力还是很大")
+    timings = psychologist.last_context_timings
+    print(f"各阶段耗时: {timings}")
+    assert all(timings[stage]["status"] == "ok" for stage in ("time_reference", "episodic", "techniques", "profile"))
+    assert timings["total"]["ms"] < 150
+    # 只读内存的阶段在请求线程上执行，与线程池中的相关记忆检索重叠
+    assert threads["time_reference"] is threading.current_thread()
+    assert any("相关的过往对话" in m["content"] for m in context)
+    assert any(m["content"].startswith("用户档案") for m in context)
+
+
+def test_slow_stage_is_dropped():
+    """测试超过期限的阶段被丢弃，不拖慢本轮对话"""
+    psychologist = _make_psychologist("stages_slow_user")
+    psychologist.chat("我最近工作压力很大")
+    psychologist.context_stage_deadlines["episodic"] = 30
+
+    def stuck_query(query, limit=5):
+        time.sleep(0.5)
+        return [{"summary": "不应出现"}]
+
+    def broken_techniques(user_message):
+        raise RuntimeError("index unavailable")
+
+    psychologist.memory_system.get_relevant_episodic_memories = stuck_query
+    psychologist._technique_fragments = broken_techniques
+
+    start = time.perf_counter()
+    context = psychologist._build_context("压力还是很大")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    timings = psychologist.last_context_timings
+    print(f"耗时 {elapsed_ms:.1f}ms, 各阶段: {timings}")
+    assert elapsed_ms < 200
+    assert timings["episodic"]["status"] == "timeout"
+    assert timings["techniques"]["status"] == "error"
+    assert timings["profile"]["status"] == "ok"
+    assert not any("不应出现" in m["content"] for m in context)
+    assert context[-1] == {"role": "user", "content": "压力还是很大"}
+
+
+def test_stable_prefix_layout():
+    """测试用户档案区段不含每轮变化的计数和时间戳，治疗技术排在工作记忆之后"""
+    psychologist = _make_psychologist("stages_layout_user")
+    psychologist.chat("我最近工作压力很大，很焦虑")
+    first = psychologist._build_context("还是很焦虑")
+    psychologist.chat("工作上的事让我很焦虑")
+    second = psychologist._build_context("还是很焦虑")
+
+    # 计数增加时排名不变，档案区段只在心理历史末尾追加新的一条，之前的内容都留在前缀中
+    profile = psychologist.memory_system.get_user_profile()
+    assert profile["personality_insights"]["anxiety"] == 2
+    assert first[1]["content"].startswith("用户档案") and "timestamp" not in second[1]["content"]
+    assert second[1]["content"].startswith(first[1]["content"][:-2])
+    assert second[1]["content"].endswith('"context": "工作上的事让我很焦虑"}]}')
+
+    roles = [m["role"] for m in second]
+    last_working = len(roles) - 1 - roles[:-1][::-1].index("assistant") - 1
+    techniques = [i for i, m in enumerate(second) if m["content"].startswith("治疗技术参考")]
+    assert techniques and techniques[0] > last_working
+
+
+def main():
+    print("上下文并发检索测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_stages_run_concurrently)
+        run_isolated(test_slow_stage_is_dropped)
+        run_isolated(test_stable_prefix_layout)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 上下文并发检索测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
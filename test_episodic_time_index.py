@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+测试情景记忆的时间索引
+"""
+
+import sys
+import os
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def _make_memory_system(user_id):
+    from ai_psychologist import MemorySystem
+    return MemorySystem(user_id)
+
+
+def test_lookup_and_merge():
+    """测试按时间参考和时间戳查找，以及24小时内的合并"""
+    memory = _make_memory_system("time_index_user")
+    summer_id = memory.add_time_based_episodic_memory("2025年暑假", {"activity": "实习"})
+    new_year_id = memory.add_time_based_episodic_memory("2025年元旦", {"activity": "旅行"})
+    assert summer_id != new_year_id
+
+    # 2025年7月1日与2025年暑假的起点相同，合并到同一条记忆
+    merged_id = memory.add_time_based_episodic_memory("2025年7月1日", {"activity": "学习"})
+    assert merged_id == summer_id
+    assert len(memory.episodic_memory) == 2
+    assert memory.get_episode(summer_id)["activity"] == "学习"
+
+    assert memory.get_episodic_memory_by_time("2025年暑假")["id"] == summer_id
+    assert memory.get_episodic_memory_by_time("2025年7月1日")["id"] == summer_id
+    assert memory.get_episodic_memory_by_time("2025-01-01")["id"] == new_year_id
+    assert memory.get_episodic_memory_by_time("2025年3月1日") is None
+
+    # 重新加载后索引从文件重建
+    from ai_psychologist import MemorySystem
+    reloaded = MemorySystem("time_index_user")
+    assert reloaded.get_episodic_memory_by_time("2025年元旦")["id"] == new_year_id
+
+    assert memory.remove_episodic_memory(new_year_id)
+    assert memory.get_episode(new_year_id) is None
+    assert memory.get_episodic_memory_by_time("2025年元旦") is None
+    assert not memory.remove_episodic_memory(new_year_id)
+
+    memory.reset_memory()
+    assert memory.get_episodic_memory_by_time("2025年暑假") is None
+
+
+def test_nearest_match():
+    """测试在大量记忆中查找最接近的时间点"""
+    memory = _make_memory_system("time_index_nearest_user")
+    day = 24 * 60 * 60
+    base = memory._parse_time_reference("2025年1月1日")
+    for i in range(500):
+        entry = {"id": f"e{i}", "timestamp": base + i * 3 * day}
+        memory.episodic_memory.append(entry)
+        memory._index_episode(entry)
+
+    assert memory._nearest_episode(base + 30 * day + 3600, day)["id"] == "e10"
+    assert memory._nearest_episode(base + 32 * day + 3600, day)["id"] == "e11"
+    assert memory._nearest_episode(base + 31.5 * day, day) is None
+    assert [memory._time_index[i][1] for i in memory._time_window(base, base + 6 * day)] == ["e0", "e1", "e2"]
+
+
+def test_range_query():
+    """测试时间段查询、排序、数量限制和流式遍历"""
+    from datetime import datetime
+    memory = _make_memory_system("time_index_range_user")
+    day = 24 * 60 * 60
+    base = datetime(2025, 7, 1).timestamp()
+    for i in range(1000):
+        entry = {"id": f"e{i}", "timestamp": base + i * day / 4}
+        memory.episodic_memory.append(entry)
+        memory._index_episode(entry)
+
+    july = memory._parse_time_span("2025年7月")
+    in_july = memory.get_episodes_in_range(july.start, july.end)
+    assert len(in_july) == 31 * 4
+    assert in_july[0]["id"] == "e0" and in_july[-1]["id"] == "e123"
+
+    latest = memory.get_episodes_in_range(datetime(2025, 7, 1), datetime(2025, 8, 1), limit=3, order="desc")
+    assert [e["id"] for e in latest] == ["e123", "e122", "e121"]
+    assert memory.get_episodes_in_range(july.end, july.start) == []
+
+    # 小分段流式遍历，与一次性查询结果一致
+    streamed = list(memory.iter_episodes_in_range(july.start, july.end, chunk_size=7))
+    assert streamed == in_july
+    streamed_desc = list(memory.iter_episodes_in_range(july.start, july.end, order="desc", chunk_size=7))
+    assert streamed_desc == in_july[::-1]
+
+
+def test_period_summary():
+    """测试时间参考汇总整个时间段内的记忆"""
+    from ai_psychologist import AIPsychologist
+    psychologist = AIPsychologist("time_index_summary_user")
+    memory = psychologist.memory_system
+    memory.add_time_based_episodic_memory("2025年7月1日", {"activity": "实习"})
+    memory.add_time_based_episodic_memory("2025年7月10日", {"activity": "实习"})
+    memory.add_time_based_episodic_memory("2025年8月20日", {"activity": "旅行",
+                                          "emotional_insights": {"emotions": ["happiness"]}})
+
+    context = psychologist._process_time_reference("还记得我2025年暑假做了什么吗")
+    print(f"时间段汇总: {context}")
+    assert "共3条记录" in context and "实习×2" in context and "旅行" in context and "happiness" in context
+    assert "进行了旅行" in psychologist._process_time_reference("2025年8月21日那天呢")
+    psychologist.close()
+
+
+def test_bulk_import():
+    """测试批量导入保留原有时间戳、建立时间索引，并且只保存一次记忆文件"""
+    memory = _make_memory_system("time_index_bulk_user")
+    base = memory._parse_time_reference("2025年1月1日")
+    saves = []
+    original_save = memory.save_memories
+    memory.save_memories = lambda: (saves.append(1), original_save())
+    ids = memory.add_episodic_memories([
+        {"timestamp": base + i * 86400, "summary": "用户表达了 anxiety", "activity": "学习"} for i in range(20)
+    ], batch_size=8)
+    assert len(ids) == len(set(ids)) == 20 and len(saves) == 1
+    assert memory.get_episode(ids[3])["timestamp"] == base + 3 * 86400
+    assert memory.get_episodic_memory_by_time("2025年1月4日")["id"] == ids[3]
+
+    from ai_psychologist import MemorySystem
+    assert len(MemorySystem("time_index_bulk_user").episodic_memory) == 20
+
+
+def main():
+    print("情景记忆时间索引测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_lookup_and_merge)
+        run_isolated(test_nearest_match)
+        run_isolated(test_range_query)
+        run_isolated(test_period_summary)
+        run_isolated(test_bulk_import)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 情景记忆时间索引测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+测试本地模拟LLM服务
+"""
+
+import sys
+import os
+import json
+import threading
+import urllib.error
+import urllib.request
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+MESSAGES = [
+    {"role": "system", "content": "你是一位AI心理学家。"},
+    {"role": "user", "content": "我最近感到很焦虑。"}
+]
+
+
+def _post(url, payload):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.read().decode("utf-8")
+
+
+def test_ollama_api():
+    """测试Ollama接口的普通与流式输出，以及前缀缓存模拟"""
+    from fake_llm_server import FakeLLMServer, FakeLLMBackend, DEFAULT_REPLY
+
+    backend = FakeLLMBackend(tokens_per_second=1000)
+    server = FakeLLMServer(backend=backend).start()
+    try:
+        data = json.loads(_post(f"{server.url}/api/chat", {"model": "m", "messages": MESSAGES, "stream": False}))
+        print(f"Ollama回复: {data['message']['content']}")
+        assert data["message"]["content"] == DEFAULT_REPLY
+        first_eval = data["prompt_eval_count"]
+
+        # 第二次请求共享前缀，只需评估新增的部分
+        lines = _post(f"{server.url}/api/chat", {"model": "m", "messages": MESSAGES + [
+            {"role": "assistant", "content": DEFAULT_REPLY},
+            {"role": "user", "content": "谢谢"}
+        ]}).splitlines()
+        chunks = [json.loads(line) for line in lines if line]
+        assert chunks[-1]["done"]
+        assert "".join(c["message"]["content"] for c in chunks) == DEFAULT_REPLY
+        second_total = backend.metrics["prompt_tokens"] - first_eval
+        print(f"第二次请求提示token: {second_total}, 实际评估: {chunks[-1]['prompt_eval_count']}")
+        assert chunks[-1]["prompt_eval_count"] < second_total
+
+        warm = json.loads(_post(f"{server.url}/api/generate", {"model": "m", "keep_alive": "30m"}))
+        assert warm["done"] and warm["response"] == ""
+    finally:
+        server.stop()
+
+
+def test_openai_api():
+    """测试OpenAI兼容接口的普通与流式输出"""
+    from fake_llm_server import FakeLLMServer, DEFAULT_REPLY
+
+    server = FakeLLMServer().start()
+    try:
+        data = json.loads(_post(f"{server.url}/v1/chat/completions", {"model": "m", "messages": MESSAGES}))
+        assert data["choices"][0]["message"]["content"] == DEFAULT_REPLY
+        assert data["usage"]["prompt_tokens"] > 0
+
+        body = _post(f"{server.url}/v1/chat/completions", {"model": "m", "messages": MESSAGES, "stream": True})
+        events = [line[len("data: "):] for line in body.splitlines() if line.startswith("data: ")]
+        assert events[-1] == "[DONE]"
+        content = "".join(json.loads(e)["choices"][0]["delta"].get("content", "") for e in events[:-1])
+        print(f"流式回复: {content}")
+        assert content == DEFAULT_REPLY
+    finally:
+        server.stop()
+
+
+def test_errors_and_concurrency():
+    """测试错误注入和并发上限"""
+    from fake_llm_server import FakeLLMServer, FakeLLMBackend
+
+    server = FakeLLMServer(backend=FakeLLMBackend(error_rate=1.0, error_status=503)).start()
+    try:
+        try:
+            _post(f"{server.url}/api/chat", {"model": "m", "messages": MESSAGES, "stream": False})
+            assert False, "expected injected failure"
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+    finally:
+        server.stop()
+
+    backend = FakeLLMBackend(latency="fixed:0.2", max_concurrency=1, overflow="reject")
+    server = FakeLLMServer(backend=backend).start()
+    statuses = []
+
+    def call():
+        try:
+            _post(f"{server.url}/api/chat", {"model": "m", "messages": MESSAGES, "stream": False})
+            statuses.append(200)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+
+    try:
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        server.stop()
+    print(f"并发请求状态码: {sorted(statuses)}")
+    assert statuses.count(200) >= 1 and 429 in statuses
+    assert backend.metrics["max_in_flight"] == 1
+
+
+def main():
+    print("本地模拟LLM服务测试")
+    print("=" * 30)
+    try:
+        test_ollama_api()
+        test_openai_api()
+        test_errors_and_concurrency()
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 本地模拟LLM服务测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+测试Aho-Corasick关键词引擎
+"""
+
+import sys
+import os
+import random
+import time
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+MESSAGES = [
+    "我最近感到很焦虑，晚上总是失眠。",
+    "I feel sad and lonely, kind of depressed by myself.",
+    "明天有面试，压力很大，但也有点excited",
+    "周末和朋友聚会聊天，很开心也很快乐",
+    "我喜欢语音说话，早上跑步健身",
+    "",
+]
+
+
+def _naive_labels(message, labels):
+    """逐表逐词扫描的参考实现"""
+    lowered = message.lower()
+    return [(label, keyword) for label, keywords in labels.items()
+            for keyword in keywords if keyword in lowered]
+
+
+def test_matches_naive_scan():
+    """测试单遍扫描与逐词扫描结果一致"""
+    from keyword_engine import keyword_engine, KEYWORD_TABLES
+
+    for message in MESSAGES:
+        hits = keyword_engine.scan(message)
+        for table, labels in KEYWORD_TABLES.items():
+            expected = _naive_labels(message, labels)
+            actual = [(entry.label, entry.keyword) for entry in hits.entries(table)]
+            assert actual == expected, (message, table, actual, expected)
+            assert hits.first(table) == (expected[0][0] if expected else None)
+    print(f"✓ {len(MESSAGES)} 条消息的命中结果与逐词扫描一致")
+
+
+def test_extractors():
+    """测试提取器使用命中结果后行为不变"""
+    from ai_psychologist import AIPsychologist, mock_completion, MOCK_RESPONSES
+
+    insights = AIPsychologist._extract_emotional_insights(None, "I feel sad and depressed, 很焦虑")
+    print(f"情绪洞察: {insights}")
+    assert insights["emotions"] == ["sadness", "sadness", "anxiety"]  # "sad" 与 "depressed" 各计一次
+    assert insights["intensity"] == len("depressed")
+
+    assert AIPsychologist._extract_activity(None, "今天去上课复习") == "学习"
+    assert AIPsychologist._extract_activity(None, "今天什么也没做") == "其他活动"
+
+    profile = {}
+    topics = AIPsychologist._extract_and_store_preferences(None, "晚上想和家人聊天，也想多锻炼", profile)
+    assert topics == ["relationships", "health"]
+    assert profile["preferences"]["communication_style"] == "text"
+    assert profile["preferences"]["preferred_time"] == "evening"
+
+    concerns = AIPsychologist._extract_and_store_interests(None, "压力大又焦虑，睡眠也差", profile)
+    assert concerns == ["stress_and_anxiety", "sleep_issues"]
+    assert len(profile["psychological_history"]) == 2
+
+    reply = mock_completion([{"role": "user", "content": "I am so stressed and anxious"}])
+    assert reply["choices"][0]["message"]["content"] == MOCK_RESPONSES["anxious"]
+
+
+def test_large_dictionary():
+    """测试数万条关键词的构建与扫描"""
+    from keyword_engine import KeywordEngine
+
+    rng = random.Random(42)
+    alphabet = "焦虑压力失眠朋友家人工作学习考试运动休息快乐难过孤独担心生气"
+    tables = {"large": {}}
+    for i in range(30000):
+        keyword = "".join(rng.choice(alphabet) for _ in range(rng.randint(2, 5)))
+        tables["large"].setdefault(f"label_{i % 500}", []).append(keyword)
+
+    start = time.perf_counter()
+    engine = KeywordEngine(tables)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    message = "".join(rng.choice(alphabet) for _ in range(200))
+    start = time.perf_counter()
+    hits = engine._scan(message)
+    scan_ms = (time.perf_counter() - start) * 1000
+    print(f"30000 条关键词: 构建 {build_ms:.1f} ms, 扫描200字消息 {scan_ms:.2f} ms, 命中 {len(hits)} 次")
+
+    expected = {(label, kw) for label, kws in tables["large"].items() for kw in kws if kw in message}
+    assert {(e.label, e.keyword) for e in hits.entries("large")} == expected
+
+
+def main():
+    print("关键词引擎测试")
+    print("=" * 30)
+    try:
+        test_matches_naive_scan()
+        test_extractors()
+        test_large_dictionary()
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 关键词引擎测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
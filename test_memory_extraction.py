@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+测试后台批量LLM记忆提取
+"""
+
+import sys
+import os
+import json
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+class ScriptedLLMClient:
+    """按轮次id返回固定提取结果的LLM客户端，同时记录调用次数"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def chat_completion(self, messages, model=None):
+        self.calls += 1
+        turns = json.loads(messages[-1]["content"])
+        results = [{
+            "id": turn["id"],
+            "emotions": ["loneliness", "unknown_emotion"],
+            "intensity": 7,
+            "topics": ["relationships"],
+            "activity": "社交",
+            "preferences": {"preferred_time": "evening"},
+            "concerns": ["sleep_issues"]
+        } for turn in turns]
+        content = "```json\n" + json.dumps(results, ensure_ascii=False) + "\n```"
+        return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+def test_batched_extraction():
+    """测试多轮对话合并为一次LLM调用并写回记忆"""
+    from ai_psychologist import AIPsychologist
+    from memory_extraction import BatchedMemoryExtractor
+
+    psychologist = AIPsychologist("extraction_user")
+    llm = ScriptedLLMClient()
+    psychologist.memory_extractor = BatchedMemoryExtractor(llm, batch_size=8, flush_interval=60)
+
+    messages = ["最近一个人待着", "周末没有人陪我", "我不知道该和谁说话"]
+    for message in messages:
+        psychologist.chat(message)
+    psychologist.close()
+
+    print(f"LLM调用次数: {llm.calls}, 统计: {psychologist.memory_extractor.stats}")
+    assert llm.calls == 1
+    assert psychologist.memory_extractor.stats["turns_refined"] == len(messages)
+
+    episode = psychologist.memory_system.episodic_memory[-1]
+    insights = episode["interaction"]["emotional_insights"]
+    print(f"精炼后的情绪洞察: {insights}")
+    assert insights["emotions"] == ["loneliness"] and insights["source"] == "llm"
+
+    profile = psychologist.memory_system.get_user_profile()
+    print(f"用户档案: {profile['preferences']}, {profile['personality_insights']}")
+    assert profile["personality_insights"]["loneliness"] == len(messages)
+    assert profile["preferences"]["preferred_time"] == "evening"
+    assert sum(1 for h in profile["psychological_history"] if h["concern"] == "sleep_issues") == len(messages)
+
+
+def test_unparseable_response():
+    """测试模型返回非JSON时保留关键词提取结果"""
+    from memory_extraction import parse_extraction_response
+
+    assert parse_extraction_response("我听到了你的话") is None
+    assert parse_extraction_response('结果如下: [{"id": "t1"}] 以上') == [{"id": "t1"}]
+
+
+def test_normalize_activity():
+    """测试约定之外的活动记为默认活动，省略时保持为空"""
+    from memory_extraction import DEFAULT_ACTIVITY, normalize_extraction
+
+    assert normalize_extraction({"activity": "旅行"})["activity"] == "旅行"
+    assert normalize_extraction({"activity": "打游戏"})["activity"] == DEFAULT_ACTIVITY
+    assert normalize_extraction({"activity": ["运动"]})["activity"] == DEFAULT_ACTIVITY
+    assert normalize_extraction({"activity": ""})["activity"] is None
+    assert normalize_extraction({})["activity"] is None
+
+
+def test_normalize_nested_values():
+    """测试模型返回嵌套列表或对象时只保留合法的字符串取值，不影响整批结果"""
+    from memory_extraction import normalize_extraction
+
+    result = normalize_extraction({
+        "emotions": [["焦虑"], {"name": "anxiety"}, "anxiety", "anxiety"],
+        "topics": [{"name": "career"}, "career"],
+        "concerns": [["sleep_issues"]],
+        "preferences": {"communication_style": ["text"], "preferred_time": "evening"}
+    })
+    assert result["emotions"] == ["anxiety"] and result["topics"] == ["career"]
+    assert result["concerns"] == []
+    assert result["preferences"] == {"preferred_time": "evening"}
+
+
+def main():
+    print("批量记忆提取测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_batched_extraction)
+        run_isolated(test_unparseable_response)
+        run_isolated(test_normalize_activity)
+        run_isolated(test_normalize_nested_values)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 批量记忆提取测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
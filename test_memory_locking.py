@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+测试记忆修改的进程内锁和跨进程文件锁
+"""
+
+import sys
+import os
+import json
+import time
+import threading
+import subprocess
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+# 子进程：对同一用户反复读-改-写计数器，并添加情景记忆
+CHILD_SCRIPT = """
+import sys, time
+sys.path.append(sys.argv[1])
+from config import Config
+Config.DATA_STORAGE_PATH = sys.argv[2]
+from ai_psychologist import MemorySystem
+memory = MemorySystem("shared_user")
+while time.time() < float(sys.argv[4]):
+    time.sleep(0.001)
+for i in range(int(sys.argv[3])):
+    with memory.mutation():
+        memory.semantic_memory["counter"] = memory.semantic_memory.get("counter", 0) + 1
+        memory.save_memories()
+    memory.add_episodic_memory({"summary": "进程写入", "index": i})
+"""
+
+
+def test_cross_process_updates():
+    """测试多个进程同时修改同一用户的记忆文件时不丢失更新"""
+    from config import Config
+    storage = Config.DATA_STORAGE_PATH
+    processes, count = 3, 40
+    start_at = str(time.time() + 1.0)
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+    children = [subprocess.Popen([sys.executable, "-c", CHILD_SCRIPT, src_dir, storage, str(count), start_at],
+                                 stdout=subprocess.DEVNULL)
+                for _ in range(processes)]
+    for child in children:
+        assert child.wait(timeout=120) == 0
+
+    from ai_psychologist import MemorySystem
+    memory = MemorySystem("shared_user")
+    assert memory.semantic_memory["counter"] == processes * count
+    assert len(memory.episodic_memory) == processes * count
+    assert len({m["id"] for m in memory.episodic_memory}) == processes * count
+
+
+def test_in_process_instances_share_lock():
+    """测试同一用户的多个实例共用一把锁，并在修改前读取其他实例保存的数据"""
+    from ai_psychologist import MemorySystem
+    first, second = MemorySystem("alice"), MemorySystem("alice")
+    assert first.lock is second.lock and MemorySystem("bob").lock is not first.lock
+
+    def worker(memory):
+        for _ in range(100):
+            with memory.mutation():
+                memory.semantic_memory["counter"] = memory.semantic_memory.get("counter", 0) + 1
+                memory.save_memories()
+
+    threads = [threading.Thread(target=worker, args=(memory,)) for memory in (first, second) * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with first.mutation():
+        assert first.semantic_memory["counter"] == 400
+    print(f"锁统计: {first.lock.stats}")
+    assert first.lock.stats["acquisitions"] >= 400
+
+
+def test_users_do_not_block_each_other():
+    """测试一个用户持锁时其他用户的修改不受影响"""
+    from ai_psychologist import MemorySystem
+    alice, bob = MemorySystem("alice"), MemorySystem("bob")
+    holding, release = threading.Event(), threading.Event()
+
+    def hold():
+        with alice.mutation():
+            holding.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait(5)
+    try:
+        start = time.perf_counter()
+        bob.add_episodic_memory({"summary": "不受影响"})
+        assert time.perf_counter() - start < 1.0
+        assert bob.lock.stats["contended"] == 0 and bob.lock.stats["file_contended"] == 0
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_file_lock_contention_and_timeout():
+    """测试其他进程持有文件锁时等待，超时后抛出MemoryLockTimeout且不写入"""
+    import memory_lock
+    if not memory_lock.FCNTL_AVAILABLE:
+        print("⚠️  fcntl不可用，跳过文件锁测试")
+        return
+    import fcntl
+    from config import Config
+    from ai_psychologist import MemorySystem
+    memory = MemorySystem("carol")
+    # 另一个打开的文件描述等同于另一个进程持有锁
+    fd = os.open(memory.lock.lock_path, os.O_RDWR | os.O_CREAT)
+    original_timeout = Config.MEMORY_LOCK_TIMEOUT
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        timer = threading.Timer(0.1, fcntl.flock, args=(fd, fcntl.LOCK_UN))
+        timer.start()
+        memory.update_semantic_memory("note", "等待后写入")
+        timer.join()
+        stats = memory.lock.stats
+        assert stats["file_contended"] == 1 and stats["file_wait_ms"] >= 50 and stats["file_timeouts"] == 0
+
+        Config.MEMORY_LOCK_TIMEOUT = 0.2
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            memory.update_semantic_memory("note", "超时后写入")
+            assert False, "the update should have timed out"
+        except memory_lock.MemoryLockTimeout:
+            pass
+        assert stats["file_timeouts"] == 1 and memory.semantic_memory["note"] == "等待后写入"
+        with open(os.path.join(memory.user_dir, "semantic_memory.json"), encoding="utf-8") as f:
+            assert json.load(f)["note"] == "等待后写入"
+
+        # 其他进程释放锁后可以正常写入，进程内锁也没有被超时遗留
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        memory.update_semantic_memory("note", "释放后写入")
+        assert memory.lock.stats["file_acquisitions"] == 2 and memory.lock._depth == 0
+    finally:
+        Config.MEMORY_LOCK_TIMEOUT = original_timeout
+        os.close(fd)
+
+    summary = memory_lock.lock_stats()
+    print(f"进程内锁汇总: {summary}")
+    assert summary["file_contended"] >= 2 and summary["most_contended"][0]["user_id"] == "carol"
+
+
+def main():
+    print("记忆锁测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_cross_process_updates)
+        run_isolated(test_in_process_instances_share_lock)
+        run_isolated(test_users_do_not_block_each_other)
+        run_isolated(test_file_lock_contention_and_timeout)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 记忆锁测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+测试后台记忆写入队列（流水线模式）
+"""
+
+import sys
+import os
+import time
+import gc
+import threading
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def test_per_user_ordering():
+    """测试同一用户的任务按顺序执行，不同用户的任务并行执行"""
+    from memory_writer import MemoryUpdateQueue
+    writer = MemoryUpdateQueue(max_workers=4)
+    results = {"alice": [], "bob": []}
+    running = set()
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def job(user, i):
+        with lock:
+            assert user not in running, "同一用户的任务不应并行执行"
+            running.add(user)
+            if len(running) > 1:
+                overlapped.set()
+        time.sleep(0.002)
+        results[user].append(i)
+        with lock:
+            running.discard(user)
+
+    for i in range(20):
+        writer.submit("alice", job, "alice", i)
+        writer.submit("bob", job, "bob", i)
+    assert writer.wait("alice", timeout=10) and writer.wait("bob", timeout=10)
+    assert results["alice"] == list(range(20)) and results["bob"] == list(range(20))
+    assert overlapped.is_set(), "不同用户的任务应当并行执行"
+    assert not writer.pending("alice")
+    assert writer.stats["completed"] == 40 and writer.stats["failed"] == 0
+
+
+def test_pipelined_chat():
+    """测试流水线模式下回复先返回，下一轮仍能读到上一轮的写入"""
+    from config import Config
+    Config.PIPELINED_MEMORY_UPDATES = True
+    try:
+        from ai_psychologist import AIPsychologist
+        psychologist = AIPsychologist("pipelined_user")
+    finally:
+        Config.PIPELINED_MEMORY_UPDATES = False
+
+    # 人为放慢记忆更新，模拟向量库写入和JSON落盘的耗时
+    apply = psychologist._apply_memory_update
+
+    def slow_apply(user_message, ai_response):
+        time.sleep(0.05)
+        return apply(user_message, ai_response)
+    psychologist._apply_memory_update = slow_apply
+
+    # 先回收前面测试留下的循环垃圾，避免完整GC恰好落在计时区间内
+    gc.collect()
+    start = time.perf_counter()
+    psychologist.chat("我最近工作压力很大")
+    first_turn_ms = (time.perf_counter() - start) * 1000
+    assert first_turn_ms < 50, f"记忆更新不应阻塞回复: {first_turn_ms:.1f}ms"
+
+    time.sleep(0.1)  # 用户思考时间，后台写入在此期间完成
+    context = psychologist._build_context("然后呢")
+    psychologist.chat("我晚上总是睡不好")
+    working_memory = psychologist.memory_system.get_working_memory_context()
+    assert working_memory[0]["content"] == "我最近工作压力很大"
+    assert any("工作压力" in m["content"] for m in context)
+
+    psychologist.close()
+    assert len(psychologist.memory_system.get_working_memory_context()) == 4
+    stats = psychologist.memory_update_stats
+    print(f"记忆更新统计: {stats}, 本轮: {psychologist.last_turn_stats.get('memory_update_saved_ms')}")
+    assert stats["turns"] == 2 and stats["saved_ms"] > 80
+    assert psychologist.last_turn_stats["memory_update_saved_ms"] > 40
+
+
+def main():
+    print("后台记忆写入测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_per_user_ordering)
+        run_isolated(test_pipelined_chat)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 后台记忆写入测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
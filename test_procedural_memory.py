@@ -51,11 +51,99 @@ def test_procedural_memory():
         traceback.print_exc()
         return False
 
+def test_technique_index():
+    """测试倒排索引在大规模技术库上的排序和检索耗时"""
+    import random
+    import time
+    from procedural_memory import TechniqueIndex, procedural_memory
+
+    ranked = list(procedural_memory.get_relevant_techniques("我控制不住情绪，经常发脾气", top_k=2))
+    assert ranked[0] == "辩证行为疗法"
+    assert list(procedural_memory.get_relevant_techniques("正念疗法"))[0] == "正念疗法"
+    assert procedural_memory.get_relevant_techniques("hello") == {}
+
+    # 提示片段在加载时预先格式化，带有token数
+    from token_budget import count_tokens
+    fragment, tokens = procedural_memory.get_technique_fragment("正念疗法")
+    assert fragment.startswith("治疗技术: 正念疗法\n") and tokens == count_tokens(fragment)
+    assert procedural_memory.format_technique_for_prompt("正念疗法", procedural_memory.get_technique("正念疗法")) is fragment
+
+    # 合成数千个技术，检索耗时应与库大小基本无关
+    rng = random.Random(7)
+    vocabulary = "焦虑抑郁失眠压力愤怒孤独自卑拖延恐惧悲伤内疚羞耻依赖冲动强迫社交工作学习家庭关系情绪思维行为呼吸放松"
+    library = {}
+    for i in range(5000):
+        words = "".join(rng.choice(vocabulary) for _ in range(40))
+        library[f"技术{i}"] = {
+            "description": words[:20],
+            "steps": [words[20:30], words[30:]],
+            "examples": [{"scenario": words[::-1][:10], "response": ""}]
+        }
+    library["睡眠限制疗法"] = {"description": "针对长期失眠的行为干预", "steps": ["固定起床时间", "缩短卧床时间"]}
+    index = TechniqueIndex(library)
+    print(f"\n✓ 索引构建: {index.stats}")
+
+    queries = ["我最近总是失眠，晚上睡不着", "工作压力太大，很焦虑", "和家人的关系让我很难过"] * 100
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, 3)
+    per_query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"✓ 5001个技术的平均检索耗时: {per_query_ms:.3f}ms")
+    assert index.search("长期失眠怎么办", 3)[0][0] == "睡眠限制疗法"
+    assert per_query_ms < 20
+
+
+def test_lazy_hot_reload():
+    """测试首次使用时才加载，文件修改后在后台构建新快照并原子替换"""
+    import json
+    import tempfile
+    from config import Config
+    from procedural_memory import ProceduralMemory
+
+    path = os.path.join(tempfile.mkdtemp(prefix="test_procedural_"), "techniques.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"呼吸练习": {"description": "缓解焦虑", "steps": ["深呼吸"]}}, f, ensure_ascii=False)
+
+    interval = Config.PROCEDURAL_RELOAD_INTERVAL
+    Config.PROCEDURAL_RELOAD_INTERVAL = 0
+    try:
+        memory = ProceduralMemory(path)
+        assert memory._library is None, "构造时不应读取文件"
+        old_snapshot = memory.snapshot()
+        assert list(memory.get_relevant_techniques("我很焦虑")) == ["呼吸练习"]
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"睡眠卫生": {"description": "改善失眠", "steps": ["固定作息"]}}, f, ensure_ascii=False)
+        os.utime(path, (os.path.getmtime(path) + 5, os.path.getmtime(path) + 5))
+        # 重建在后台进行，发现文件变化的这次请求不等待，仍使用当前快照
+        assert memory.snapshot() is old_snapshot
+        assert memory.wait_for_reload(10)
+        assert list(memory.get_relevant_techniques("最近失眠")) == ["睡眠卫生"]
+        assert memory.reloads == 1
+        # 旧快照保持不变，正在处理的请求不受影响
+        assert list(old_snapshot.techniques) == ["呼吸练习"]
+        assert old_snapshot.search("我很焦虑") and old_snapshot.fragments["呼吸练习"][1] > 0
+
+        # 写入不完整的JSON、顶层不是对象或技术不是对象时保留当前快照
+        for offset, content in ((10, "{"), (20, "[]"), (30, '{"睡眠卫生": ["固定作息"]}')):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.utime(path, (os.path.getmtime(path) + offset, os.path.getmtime(path) + offset))
+            memory.snapshot()
+            assert memory.wait_for_reload(10)
+            assert list(memory.get_all_techniques()) == ["睡眠卫生"]
+        assert memory.reloads == 1
+    finally:
+        Config.PROCEDURAL_RELOAD_INTERVAL = interval
+
+
 def main():
     print("程序性记忆系统测试脚本")
     print("=" * 25)
     
     if test_procedural_memory():
+        test_technique_index()
+        test_lazy_hot_reload()
         print("\n✅ 程序性记忆系统测试通过!")
         print("\n使用方法:")
         print("1. 修改 ./config/therapeutic_techniques.json 文件添加新的治疗技术")
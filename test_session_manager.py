@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+测试活跃会话的LRU缓存
+"""
+
+import sys
+import os
+import time
+import threading
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def _make_factory():
+    from ai_psychologist import AIPsychologist, LLMClient
+    llm_client = LLMClient()
+    created = []
+
+    def factory(user_id):
+        created.append(user_id)
+        return AIPsychologist(user_id, llm_client=llm_client)
+    return factory, created
+
+
+def _turn(manager, user_id, message):
+    session = manager.acquire(user_id)
+    try:
+        return session.chat(message)
+    finally:
+        manager.release(user_id)
+
+
+def test_lru_eviction_and_reload():
+    """测试按会话数淘汰最久未使用的会话，淘汰时写回，重新加载后记忆完整"""
+    from session_manager import SessionManager
+    factory, created = _make_factory()
+    manager = SessionManager(factory, max_sessions=2, idle_ttl=0)
+
+    _turn(manager, "alice", "我最近很焦虑。")
+    _turn(manager, "bob", "我睡不好。")
+    _turn(manager, "alice", "主要是工作压力。")  # alice变为最近使用
+    before = list(manager.peek("bob").memory_system.get_working_memory_context())
+    _turn(manager, "carol", "我想换工作。")
+    assert "bob" not in manager and "alice" in manager and "carol" in manager
+
+    manager.flush_pending()
+    stats = manager.get_stats()
+    assert stats["evicted_capacity"] == 1 and stats["hits"] == 1 and stats["misses"] == 3
+    assert abs(stats["hit_rate"] - 0.25) < 1e-9
+
+    # 重新加载bob，工作记忆从写回的快照恢复
+    session = manager.acquire("bob")
+    assert list(session.memory_system.get_working_memory_context()) == before
+    manager.release("bob")
+    assert created == ["alice", "bob", "carol", "bob"]
+    assert "alice" not in manager  # 加载bob时淘汰了此时最久未使用的alice
+    manager.close()
+    assert len(manager) == 0
+
+
+def test_byte_limit_and_in_use():
+    """测试按估算字节数淘汰，正在使用的会话不会被淘汰"""
+    from session_manager import SessionManager, session_footprint
+    factory, _ = _make_factory()
+    manager = SessionManager(factory, idle_ttl=0)
+    _turn(manager, "probe", "测试一下大小。")
+    one_session = session_footprint(manager.peek("probe"))
+    manager.close()
+
+    manager = SessionManager(factory, max_bytes=int(one_session * 2.5), idle_ttl=0)
+    held = manager.acquire("held")
+    held.chat("这个会话一直在使用中。")
+    for i in range(5):
+        _turn(manager, f"user{i}", "我有点累。")
+    stats = manager.get_stats(per_session=True)
+    print(f"会话缓存: {stats}")
+    assert "held" in manager and stats["evicted_bytes"] >= 3
+    assert stats["bytes"] <= manager.max_bytes
+    assert stats["per_session"]["held"]["in_use"] == 1
+    assert stats["bytes"] == sum(s["bytes"] for s in stats["per_session"].values())
+    manager.release("held")
+    manager.close()
+
+
+def test_idle_eviction():
+    """测试空闲超时的会话由后台线程写回并移出缓存"""
+    from session_manager import SessionManager
+    factory, _ = _make_factory()
+    manager = SessionManager(factory, idle_ttl=0.2, reap_interval=0.05)
+    _turn(manager, "idle_user", "今天心情不错。")
+    busy = manager.acquire("busy_user")
+    deadline = time.time() + 5
+    while "idle_user" in manager and time.time() < deadline:
+        time.sleep(0.05)
+    assert "idle_user" not in manager and "busy_user" in manager
+    assert manager.get_stats()["evicted_idle"] == 1
+    manager.release("busy_user")
+    manager.close()
+    assert busy is not None
+
+
+def test_concurrent_load_once():
+    """测试多个线程同时请求同一个未缓存的用户时只加载一次"""
+    from session_manager import SessionManager
+    factory, created = _make_factory()
+
+    def slow_factory(user_id):
+        time.sleep(0.05)
+        return factory(user_id)
+    manager = SessionManager(slow_factory, idle_ttl=0)
+    sessions = []
+
+    def worker():
+        sessions.append(manager.acquire("shared_user"))
+        manager.release("shared_user")
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert created == ["shared_user"] and len({id(s) for s in sessions}) == 1
+    assert manager.get_stats()["hits"] == 7
+    manager.close()
+
+
+def main():
+    print("活跃会话缓存测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_lru_eviction_and_reload)
+        run_isolated(test_byte_limit_and_in_use)
+        run_isolated(test_idle_eviction)
+        run_isolated(test_concurrent_load_once)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 活跃会话缓存测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+测试会话滚动摘要
+"""
+
+import sys
+import os
+import json
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+class SummaryLLMClient:
+    """返回固定格式摘要的LLM客户端，记录每次调用收到的消息数"""
+
+    def __init__(self):
+        self.batches = []
+
+    def chat_completion(self, messages, model=None):
+        self.prompt = messages[0]["content"]
+        payload = json.loads(messages[-1]["content"])
+        self.batches.append(len(payload["turns"]))
+        summary = (payload["summary"] + "；" if payload["summary"] else "") + f"合并了{len(payload['turns'])}条"
+        return {"choices": [{"message": {"role": "assistant", "content": json.dumps({"summary": summary}, ensure_ascii=False)}}]}
+
+
+def _make_psychologist(user_id):
+    from ai_psychologist import AIPsychologist
+    return AIPsychologist(user_id)
+
+
+def test_extractive_summary_keeps_prompt_constant():
+    """测试淘汰的对话折叠进摘要，长会话的提示大小保持稳定"""
+    from config import Config
+    psychologist = _make_psychologist("summary_user")
+    totals = []
+    for i in range(40):
+        psychologist.chat(f"第{i}件事：最近的工作让我很累。其他细节不重要")
+        psychologist.session_summarizer.flush()
+        psychologist._build_context("继续")
+        totals.append(psychologist.last_context_tokens["total"])
+
+    summary = psychologist.memory_system.session_summary
+    print(f"摘要:\n{summary}\n各轮上下文token数(后10轮): {totals[-10:]}")
+    assert "第39件事" not in summary  # 最近的对话仍在工作记忆中
+    assert "用户提到：第30件事：最近的工作让我很累" in summary
+    assert "其他细节" not in summary
+    assert psychologist.last_context_tokens["summary"] <= Config.CONTEXT_BUDGET_SUMMARY
+    assert max(totals[-10:]) - min(totals[-10:]) <= 10
+    context = psychologist._build_context("继续")
+    assert any(m["content"].startswith("之前对话的摘要") for m in context)
+
+    psychologist.reset_memory()
+    assert psychologist.memory_system.session_summary == ""
+    psychologist.close()
+
+
+def test_llm_batches():
+    """测试LLM模式下按批合并，模型输出无法解析时退化为抽取式摘要"""
+    from ai_psychologist import MemorySystem
+    from session_summary import SessionSummarizer, summary_char_limit
+
+    memory = MemorySystem("summary_llm_user")
+    llm = SummaryLLMClient()
+    summarizer = SessionSummarizer(memory, llm, use_llm=True, batch_size=4)
+    messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"消息{i}。"} for i in range(10)]
+    for i in range(0, 10, 2):
+        summarizer.add(messages[i:i + 2])
+    summarizer.flush()
+    assert llm.batches == [4, 4, 2]
+    # 提示中给出的是换算后的字数，而不是token上限本身
+    assert f"不超过{summary_char_limit(summarizer.max_tokens)}个字" in llm.prompt
+    assert memory.session_summary == "合并了4条；合并了4条；合并了2条"
+
+    summarizer.llm_client = type("Broken", (), {"chat_completion": lambda self, m, model=None: {
+        "choices": [{"message": {"content": "我听到了你的话"}}]}})()
+    summarizer.add([{"role": "user", "content": "新的烦恼。后面的话"}])
+    summarizer.flush()
+    assert memory.session_summary.endswith("- 用户提到：新的烦恼")
+    assert summarizer.stats["llm_batches"] == 3 and summarizer.stats["extractive_batches"] == 1
+
+
+def test_pending_survives_restart():
+    """测试攒批中尚未折叠的消息随会话状态保存，进程重启后继续折叠"""
+    from ai_psychologist import AIPsychologist, MemorySystem
+    from session_summary import SessionSummarizer
+
+    psychologist = AIPsychologist("summary_resume_user")
+    psychologist.session_summarizer.batch_size = 100
+    for i in range(12):
+        psychologist.chat(f"第{i}件事：睡不好。")
+    pending = list(psychologist.memory_system.summary_pending)
+    assert pending and psychologist.memory_system.session_summary == ""
+
+    # 不调用close，模拟进程被终止：只有session_state.json留在磁盘上
+    memory = MemorySystem("summary_resume_user")
+    assert memory.summary_pending == pending
+    summarizer = SessionSummarizer(memory, use_llm=False)
+    summarizer.flush()
+    assert "用户提到：第0件事：睡不好" in memory.session_summary
+    assert memory.summary_pending == [] and MemorySystem("summary_resume_user").summary_pending == []
+
+
+def main():
+    print("会话滚动摘要测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_extractive_summary_keeps_prompt_constant)
+        run_isolated(test_llm_batches)
+        run_isolated(test_pending_survives_restart)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 会话滚动摘要测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
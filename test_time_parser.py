@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+测试中文时间表达式解析
+"""
+
+import sys
+import os
+from datetime import date, datetime
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+# 2025-11-19 是星期三
+REFERENCE = date(2025, 11, 19)
+
+
+def _range(span):
+    return span.start_datetime.strftime("%Y-%m-%d"), span.end_datetime.strftime("%Y-%m-%d")
+
+
+def test_extraction():
+    """测试从消息中提取时间表达式"""
+    from time_parser import extract_time_expression, extract_time_spans
+
+    cases = {
+        "我今年暑假，也就是2025年暑假做了3个月的实习。": "今年暑假",
+        "大前天晚上没睡好": "大前天",
+        "2025年7月1日开始实习": "2025年7月1日",
+        "上个月压力很大": "上个月",
+        "我下周要考试": "下周",
+        "最近还好": None,
+        # “然后”“最后”“之后”“以后”之后紧跟“天”时、以及“后天形成”中都不是“后天”
+        "我们吃了饭，然后天气就变了": None,
+        "最后天都黑了才到家": None,
+        "之后天气变冷了": None,
+        "这种性格是后天形成的": None,
+        "以后天天加班": None,
+        "后天要去面试，然后天天都很紧张": "后天",
+        "后天天气怎么样": "后天",
+    }
+    for message, expected in cases.items():
+        actual = extract_time_expression(message)
+        print(f"  {message} -> {actual}")
+        assert actual == expected, (message, actual)
+
+    spans = extract_time_spans("去年春节和今年国庆都回家了", REFERENCE)
+    assert [s.expression for s in spans] == ["去年春节", "今年国庆"]
+
+
+def test_spans():
+    """测试相对时间、绝对日期和节假日的时间段"""
+    from time_parser import parse_time_expression
+
+    cases = {
+        "昨天": ("2025-11-18", "2025-11-19"),
+        "上周": ("2025-11-10", "2025-11-17"),
+        "这周": ("2025-11-17", "2025-11-24"),
+        "下周": ("2025-11-24", "2025-12-01"),
+        "上个月": ("2025-10-01", "2025-11-01"),
+        "下个月": ("2025-12-01", "2026-01-01"),
+        "明年": ("2026-01-01", "2027-01-01"),
+        "2025年7月": ("2025-07-01", "2025-08-01"),
+        "7月1日": ("2025-07-01", "2025-07-02"),
+        "12/25/2024": ("2024-12-25", "2024-12-26"),
+        "暑假": ("2025-07-01", "2025-09-01"),
+        "去年暑假": ("2024-07-01", "2024-09-01"),
+        "2025年春节": ("2025-01-28", "2025-02-05"),
+    }
+    for expression, expected in cases.items():
+        span = parse_time_expression(expression, REFERENCE)
+        assert span is not None, expression
+        print(f"  {expression}: {_range(span)} ({span.kind})")
+        assert _range(span) == expected, (expression, _range(span))
+
+    assert parse_time_expression("2025年2月30日", REFERENCE) is None
+    assert parse_time_expression("最近", REFERENCE) is None
+
+
+def test_memory_system_integration():
+    """测试MemorySystem使用新的解析器"""
+    from ai_psychologist import MemorySystem
+
+    memory = MemorySystem("time_parser_user")
+    timestamp = memory._parse_time_reference("上周")
+    assert timestamp is not None
+    assert datetime.fromtimestamp(timestamp).weekday() == 0
+
+
+def main():
+    print("中文时间表达式解析测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_extraction)
+        run_isolated(test_spans)
+        run_isolated(test_memory_system_integration)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 中文时间表达式解析测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
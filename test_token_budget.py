@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+测试上下文token预算
+"""
+
+import sys
+import os
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def test_truncate_and_fit():
+    """测试文本截断与消息裁剪"""
+    from token_budget import count_tokens, truncate_to_tokens, fit_messages, fit_text
+
+    text = "我最近感到很焦虑，晚上睡不着。" * 20
+    truncated = truncate_to_tokens(text, 30)
+    print(f"截断前: {count_tokens(text)} tokens, 截断后: {count_tokens(truncated)} tokens")
+    assert count_tokens(truncated) <= 30
+    assert truncate_to_tokens("短文本", 30) == "短文本"
+
+    messages = [{"role": "user", "content": f"第{i}条消息，内容比较长一些。"} for i in range(10)]
+    kept, used = fit_messages(messages, 60)
+    print(f"保留 {len(kept)} 条消息, 占用 {used} tokens")
+    assert used <= 60
+    assert kept and kept[-1] is messages[-1]  # 保留最新的消息
+    # 使用缓存的token数时不重新计数（工作记忆的裁剪方式）
+    assert fit_messages(messages, 60, [20] * len(messages)) == (messages[-3:], 60)
+
+    content, used = fit_text(text, 40, prefix="历史背景: ")
+    assert content.startswith("历史背景: ") and used <= 40
+    assert fit_text(text, 2) == (None, 0)
+
+
+def test_global_cap():
+    """测试超出全局上限时按价值从低到高压缩区段"""
+    from token_budget import TokenBudget, fit_text
+
+    long_text = "治疗技术描述" * 100
+    budget = TokenBudget(
+        total=200,
+        section_limits={"techniques": 150, "working_memory": 150},
+        drop_order=["techniques", "working_memory"]
+    )
+    sections, report = budget.fit({
+        "techniques": lambda limit: fit_text(long_text, limit),
+        "working_memory": lambda limit: fit_text(long_text, limit)
+    }, reserved=20)
+    print(f"token分布: {report}")
+    assert report["total"] <= 200
+    assert report["working_memory"] > report["techniques"]
+
+
+def test_context_budget():
+    """测试_build_context遵守预算并报告各区段token数"""
+    from config import Config
+    from ai_psychologist import AIPsychologist
+
+    psychologist = AIPsychologist("token_budget_user")
+    profile = psychologist.memory_system.get_user_profile()
+    profile["psychological_history"] = [
+        {"concern": "stress_and_anxiety", "timestamp": 1700000000 + i, "context": "我因为考试很焦虑" * 5}
+        for i in range(50)
+    ]
+    psychologist.memory_system.update_semantic_memory("user_profile", profile)
+
+    psychologist._build_context("我最近压力很大")
+    report = psychologist.last_context_tokens
+    print(f"上下文token分布: {report}")
+    assert report["profile"] <= Config.CONTEXT_BUDGET_PROFILE
+    assert report["total"] <= Config.CONTEXT_TOKEN_BUDGET
+
+
+def main():
+    print("上下文token预算测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_truncate_and_fit)
+        run_isolated(test_global_cap)
+        run_isolated(test_context_budget)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 上下文token预算测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
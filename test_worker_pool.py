@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+测试按用户分片的多进程聊天服务
+"""
+
+import sys
+import os
+import json
+import http.client
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def _post(connection, payload):
+    connection.request("POST", "/v1/chat", body=json.dumps(payload), headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def test_sharded_server():
+    """测试轮次按用户哈希分配到工作进程，流式输出可用，停止时工作进程写回记忆"""
+    from config import Config
+    from chat_server import ChatServer
+    from memory_lock import lock_stats
+    from worker_pool import shard_index
+
+    users = [f"user{i}" for i in range(6)]
+    server = ChatServer(host="127.0.0.1", port=0, workers=2).start_in_thread()
+    try:
+        connection = http.client.HTTPConnection(server.host, server.port, timeout=60)
+        for user_id in users:
+            status, body = _post(connection, {"user_id": user_id, "message": "我最近睡不好。"})
+            assert status == 200 and json.loads(body)["reply"]
+        status, body = _post(connection, {"user_id": "user0", "message": "还是很焦虑。", "stream": True})
+        events = [block for block in body.decode("utf-8").split("\n\n") if block]
+        deltas = [json.loads(e[len("data: "):])["delta"] for e in events if e.startswith("data: ")]
+        assert status == 200 and len(deltas) > 1
+        assert "".join(deltas) == json.loads(events[-1].split("data: ", 1)[1])["reply"]
+
+        connection.request("GET", "/v1/stats")
+        stats = json.loads(connection.getresponse().read())
+        print(f"工作进程: {stats['workers']}")
+        expected = [0, 0]
+        for user_id in users:
+            expected[shard_index(user_id, 2)] += 1
+        assert sum(worker["requests"] for worker in stats["workers"]) == len(users) + 1
+        assert [w["session_cache"]["sessions"] for w in stats["worker_stats"]] == expected
+        assert len({worker["pid"] for worker in stats["workers"]} | {os.getpid()}) == 3
+        # 工作进程沿用前端的文件锁设置，与命令行或离线回放同时修改同一用户时仍然互斥
+        assert all(w["memory_locks"]["file_locks"] == lock_stats()["file_locks"] for w in stats["worker_stats"])
+        # 工作进程随回复返回各阶段耗时，由前端汇总
+        assert stats["stages"]["context.total"]["samples"] == len(users) + 1
+        connection.close()
+    finally:
+        server.stop()
+
+    # 工作进程使用了前端的存储路径，并在停止时写回了会话
+    with open(os.path.join(Config.DATA_STORAGE_PATH, "user0", "session_state.json"), encoding="utf-8") as f:
+        assert len(json.load(f)["working_memory"]) == 4
+    for user_id in users:
+        assert os.path.exists(os.path.join(Config.DATA_STORAGE_PATH, user_id, "episodic_memory.json"))
+
+
+def test_stream_closed_early():
+    """测试提前停止流式输出后，工作进程结束本轮，同一用户的下一轮正常执行"""
+    from worker_pool import ShardedSessionPool
+
+    pool = ShardedSessionPool(1)
+    pool.start()
+    try:
+        stream = pool.stream("alice", "我和朋友吵架了，心里很难受，不知道该怎么办。")
+        assert next(stream)
+        stream.close()
+        assert pool.chat("alice", "现在好一些了。")
+        stats = pool.get_stats()[0]
+        assert stats["in_flight"] == 0 and stats["requests"] == 2 and stats["errors"] == 0
+    finally:
+        pool.close()
+
+
+def test_admission_in_frontend():
+    """测试准入控制在前端执行：名额是所有工作进程共用的，工作进程内不再另有一组名额"""
+    from config import Config
+    import admission
+    from admission import AdmissionController, AdmissionRejected
+    from ai_psychologist import DEFAULT_MOCK_RESPONSE
+    from worker_pool import ShardedSessionPool
+
+    original_controller, original_mode = admission._controller, Config.ADMISSION_OVERLOAD_MODE
+    controller = admission._controller = AdmissionController(max_concurrent=1, max_queue=0)
+    pool = ShardedSessionPool(2)
+    pool.start()
+    try:
+        # 唯一的名额被占用时，任何工作进程的用户都被拒绝，且不会派发给工作进程
+        controller.acquire("holder")
+        for user_id in ("user0", "user1"):
+            try:
+                pool.chat(user_id, "你好")
+                assert False, "the turn should have been rejected"
+            except AdmissionRejected:
+                pass
+        Config.ADMISSION_OVERLOAD_MODE = "degrade"
+        assert pool.chat("user0", "你好") == DEFAULT_MOCK_RESPONSE
+        assert "".join(pool.stream("user1", "你好")) == DEFAULT_MOCK_RESPONSE
+        assert sum(shard["requests"] for shard in pool.get_stats()) == 0
+
+        controller.release("holder")
+        assert pool.chat("user0", "你好")
+        stats = controller.get_stats()
+        assert stats["active"] == 0 and stats["admitted"] == 2 and stats["degraded"] == 2
+        assert all("admission" not in worker for worker in pool.worker_stats())
+    finally:
+        admission._controller, Config.ADMISSION_OVERLOAD_MODE = original_controller, original_mode
+        pool.close()
+
+
+def main():
+    print("多进程聊天服务测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_sharded_server)
+        run_isolated(test_stream_closed_early)
+        run_isolated(test_admission_in_frontend)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 多进程聊天服务测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
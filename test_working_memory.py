@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+测试工作记忆环形缓冲区
+"""
+
+import sys
+import os
+
+# 添加src目录到路径
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+
+def test_message_and_token_limits():
+    """测试按消息条数和token数淘汰，以及超长消息截断"""
+    from token_budget import count_message_tokens
+    from working_memory import WorkingMemoryBuffer
+
+    buffer = WorkingMemoryBuffer(max_messages=4, max_tokens=100)
+    evicted = []
+    for i in range(6):
+        evicted += buffer.append({"role": "user", "content": f"消息{i}"})
+    assert [m["content"] for m in buffer.view()] == ["消息2", "消息3", "消息4", "消息5"]
+    assert [item.message["content"] for item in evicted] == ["消息0", "消息1"]
+    assert buffer.total_tokens == sum(item.tokens for item in buffer.items())
+
+    # 较长的消息按token数挤出更多旧消息
+    long_message = {"role": "assistant", "content": "很" * 80}
+    before = len(buffer)
+    evicted = buffer.append(long_message)
+    assert buffer.total_tokens <= 100 and len(evicted) >= 2
+    assert len(buffer) == before + 1 - len(evicted)
+    assert [item.message["content"] for item in evicted] == ["消息2", "消息3", "消息4"][:len(evicted)]
+    assert buffer.view()[-1] is long_message
+
+    # 单条超过上限的消息截断后保留
+    buffer.append({"role": "user", "content": "长" * 500})
+    assert len(buffer) == 1
+    assert buffer.total_tokens <= 100
+    assert buffer.view()[-1]["content"].endswith("…")
+    assert buffer.total_tokens == count_message_tokens(buffer.view()[0])
+
+
+def test_view_and_fit():
+    """测试只读视图不复制数据，按缓存token数选取最新消息"""
+    from working_memory import WorkingMemoryBuffer
+
+    buffer = WorkingMemoryBuffer(max_messages=10, max_tokens=1000)
+    view = buffer.view()
+    for i in range(5):
+        buffer.append({"role": "user", "content": f"第{i}条"})
+    assert len(view) == 5 and view[0]["content"] == "第0条"
+    assert [m["content"] for m in view[-2:]] == ["第3条", "第4条"]
+    assert [m["content"] for m in reversed(view)][0] == "第4条"
+
+    per_message = next(buffer.items()).tokens
+    kept, used = buffer.fit(per_message * 2)
+    assert [m["content"] for m in kept] == ["第3条", "第4条"] and used == per_message * 2
+    assert list(reversed(view.token_counts)) == [item.tokens for item in reversed(list(buffer.items()))]
+    try:
+        hash(view)
+        assert False, "视图不应可哈希"
+    except TypeError:
+        pass
+
+    buffer.clear()
+    assert len(view) == 0 and buffer.total_tokens == 0
+
+
+def test_session_resume():
+    """测试工作记忆和会话摘要在重启后恢复"""
+    import json
+    from config import Config
+    from ai_psychologist import AIPsychologist, MemorySystem
+
+    psychologist = AIPsychologist("resume_user")
+    for i in range(8):
+        psychologist.chat(f"第{i}轮：我最近压力很大。")
+    psychologist.close()
+    before = list(psychologist.memory_system.get_working_memory_context())
+    summary = psychologist.memory_system.session_summary
+    assert summary and len(before) == Config.WORKING_MEMORY_SIZE
+
+    # 快照为紧凑JSON，只包含工作记忆和摘要
+    state_file = os.path.join(Config.DATA_STORAGE_PATH, "resume_user", "session_state.json")
+    with open(state_file, encoding="utf-8") as f:
+        state = json.load(f)
+    assert len(state["working_memory"]) == len(before) and state["summary"] == summary
+
+    restored = MemorySystem("resume_user")
+    assert list(restored.get_working_memory_context()) == before
+    assert restored.session_summary == summary
+    assert restored.working_memory.total_tokens == psychologist.memory_system.working_memory.total_tokens
+
+    # 上限变小时恢复后仍遵守新的上限
+    size = Config.WORKING_MEMORY_SIZE
+    Config.WORKING_MEMORY_SIZE = 4
+    try:
+        smaller = MemorySystem("resume_user")
+        assert list(smaller.get_working_memory_context()) == before[-4:]
+    finally:
+        Config.WORKING_MEMORY_SIZE = size
+
+    restored.reset_memory()
+    assert not os.path.exists(state_file)
+    assert len(MemorySystem("resume_user").get_working_memory_context()) == 0
+
+
+def main():
+    print("工作记忆环形缓冲区测试")
+    print("=" * 30)
+    try:
+        from conftest import run_isolated
+        run_isolated(test_message_and_token_limits)
+        run_isolated(test_view_and_fit)
+        run_isolated(test_session_resume)
+    except Exception as e:
+        print(f"\n❌ 测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    print("\n✅ 工作记忆环形缓冲区测试通过!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())